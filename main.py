@@ -32,8 +32,14 @@ def _main():
         from src.inference import main
     elif args.mode == "tflite":
         from src.convert_tflite import main
+    elif args.mode == "verify":
+        from src.verify_dataset import main
+    elif args.mode == "bench-input":
+        from src.bench_input import main
+    elif args.mode == "streaming":
+        from src.streaming import main
     else:
-        raise ValueError(f"Mode is validable (preprocess, train, inference, tflite)")
+        raise ValueError(f"Mode is validable (preprocess, train, inference, tflite, verify, bench-input, streaming)")
 
     main(args.gpusize, args.config)
 
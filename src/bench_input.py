@@ -0,0 +1,83 @@
+"""
+Benchmark of the input pipeline in distrib.load_dataset without the model
+
+    Each stage is added to the previous ones and iterated for bench.steps batches,
+    the latency of a stage is the difference of time per batch with the previous one.
+
+    - read: interleaved TFRecordDataset of the indexed records
+    - batch: serialized records batched
+    - parse: parse_example and decode
+    - stft: stft or reshape to the model input
+    - full utterances(dset.full_utterance) are parsed with stft one by one, then bucketed
+    - pipeline: training dataset of load_dataset with shuffle, parallel map and prefetch
+"""
+import time
+import tensorflow as tf
+from src.distrib import load_dataset, get_input_stages
+from src.utils import load_yaml, limit_gpu_tf
+
+
+def _time_dataset(dataset, steps, warmup):
+    """Seconds per element after warmup elements"""
+    iterator = iter(dataset)
+    for _ in range(warmup):
+        next(iterator)
+    start = time.perf_counter()
+    for _ in range(steps):
+        next(iterator)
+    return (time.perf_counter() - start) / steps
+
+
+def bench_input(args):
+    batch_size = args.batch_size
+    bench = getattr(args, "bench", None)
+    steps = getattr(bench, "steps", None) or 50
+    warmup = getattr(bench, "warmup", None) or 5
+    stages = get_input_stages(args)
+
+    files = tf.data.Dataset.from_tensor_slices(stages["train"]).repeat()
+    records = files.interleave(
+        stages["read"],
+        cycle_length=tf.data.experimental.AUTOTUNE,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+    )
+    if stages["utterance"]:
+        # full utterances are parsed one by one, then batched by length
+        parsed = records.map(stages["parse_utterance"])
+        batches = stages["bucket"](parsed)
+        measured = (("parse+stft", parsed), ("bucket", batches))
+    else:
+        batches = records.batch(batch_size)
+        parsed = batches.map(stages["parse"])
+        features = parsed.map(stages["extract"])
+        measured = (("batch", batches), ("parse", parsed), ("stft", features))
+
+    latency = {}
+    latency["read"] = _time_dataset(records, steps * batch_size, warmup * batch_size) * batch_size
+    total = latency["read"]
+    for name, dataset in measured:
+        if name == "parse+stft":
+            seconds = _time_dataset(dataset, steps * batch_size, warmup * batch_size) * batch_size
+        else:
+            seconds = _time_dataset(dataset, steps, warmup)
+        latency[name] = max(seconds - total, 0.0)
+        total = seconds
+
+    train_dataset, _ = load_dataset(args)
+    seconds = _time_dataset(train_dataset, steps, warmup)
+
+    print(f"Batch size: {batch_size}, steps: {steps}, warmup: {warmup}")
+    for name, value in latency.items():
+        print(f"{name:>10}: {value * 1000:.2f} ms/batch")
+    print(f"{'serial':>10}: {total * 1000:.2f} ms/batch")
+    print(f"{'pipeline':>10}: {seconds * 1000:.2f} ms/batch")
+    print(f"Throughput: {batch_size / seconds:.1f} elements/sec, {1 / seconds:.1f} batches/sec")
+    if not stages["utterance"]:
+        print(f"Throughput: {batch_size * args.dset.segment / seconds:.1f} sec of audio/sec")
+    return latency, seconds
+
+
+def main(gpu_size, path_conf):
+    limit_gpu_tf(gpu_size)
+    config = load_yaml(path_conf)
+    bench_input(config)
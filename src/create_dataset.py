@@ -3,7 +3,8 @@ from src.preprocess.dataset import DatasetVoiceBank
 import os
 import pickle
 import warnings
-from src.utils import load_yaml, limit_gpu_tf
+from src.utils import load_yaml, limit_gpu_tf, get_dataset_path
+from src.preprocess.record_index import verify_records
 
 warnings.filterwarnings(action="ignore")
 
@@ -81,6 +82,9 @@ def preprocess_data(args):
         )
         val_dataset.create_tf_record(prefix="val")
 
+    # check the crc of new or changed record files, training reads only the valid records in the index
+    verify_records(get_dataset_path(args), getattr(args.dset, "compression", None), force=False)
+
 def main(gpu_size, path_conf):
     limit_gpu_tf(gpu_size)
     config = load_yaml(path_conf)
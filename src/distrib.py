@@ -1,5 +1,10 @@
 import os
+import time
+import signal
 import glob
+import json
+import shutil
+import hashlib
 from pathlib import Path
 from datetime import datetime
 import numpy as np
@@ -7,21 +12,17 @@ import numpy as np
 import tensorflow as tf
 import keras.callbacks
 import keras.models
-from .utils import save_json, stft_tensorflow
+from .utils import save_optimizer_state, stft_tensorflow, get_frontend, get_dataset_path, get_num_frames, obj2dict
+from .preprocess.record_index import update_index, INDEX_NAME
 
 
 def save_model_all(path, model: keras.models.Model):
     model_save_path = os.path.join(path, "model")
-    optimizer_save_path = os.path.join(path, "optimizer")
 
     keras.models.save_model(
         model, model_save_path, overwrite=True, include_optimizer=True
     )
-    optimizer_save_path = Path(optimizer_save_path)
-    if not optimizer_save_path.is_dir():
-        optimizer_save_path.mkdir()
-    optimizer_save_path = optimizer_save_path / "optim.json"
-    save_json({"optimizer": model.optimizer.get_weights()}, optimizer_save_path)
+    save_optimizer_state(path, model)
 
 
 def load_callback(path, args):
@@ -51,6 +52,206 @@ def load_callback(path, args):
     ]
 
 
+class InputStallMonitor(keras.callbacks.Callback):
+    """Time of the training loop waiting on the next batch(IteratorGetNext)
+
+    The timestamp is taken in train_step of the model, which starts once the batch is out of
+    the iterator, so the time from the start of a step to it is the wait for input.
+    The dataset is not changed, and its iterator can be saved in the training state.
+    """
+
+    def __init__(self, threshold=0.1, warmup=2):
+        super().__init__()
+        self.threshold = threshold
+        self.warmup = warmup
+        self.timestamp = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+
+    def set_model(self, model):
+        if model is getattr(self, "model", None):
+            return
+        super().set_model(model)
+        train_step = model.train_step
+
+        def stamp_train_step(data):
+            with tf.control_dependencies(tf.nest.flatten(data)):
+                stamp = self.timestamp.assign(tf.timestamp())
+            with tf.control_dependencies([stamp]):
+                return train_step(data)
+
+        model.train_step = stamp_train_step
+        model.train_function = None  # traced again with the timestamp
+
+    def on_train_begin(self, logs=None):
+        self.steps = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.wait_time = 0.0
+        self.step_time = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.begin = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        if self.steps <= self.warmup:  # tracing of train_function, also after resuming in the middle of epoch
+            return
+        self.wait_time += max(float(self.timestamp.numpy()) - self.begin, 0.0)
+        self.step_time += time.time() - self.begin
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.step_time == 0:
+            return
+        ratio = self.wait_time / self.step_time
+        print(f"\nInput wait: {self.wait_time:.2f}/{self.step_time:.2f} sec, {ratio*100:.1f}% of steps")
+        if ratio > self.threshold:
+            print(f"[WARNING] Training is input-bound, waiting on IteratorGetNext for {ratio*100:.1f}% of steps")
+        if logs is not None:
+            logs["input_wait"] = ratio
+
+
+def _get_checkpoint_options():
+    """Write checkpoints in the background if tensorflow supports it"""
+    try:
+        return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+    except TypeError:
+        return tf.train.CheckpointOptions()
+
+
+def _get_state_config(args, steps_per_epoch):
+    """Configuration which the training state depends on, epochs can be changed to train longer"""
+    config = dict(
+        dset=obj2dict(args.dset),
+        model=obj2dict(args.model),
+        optim=obj2dict(args.optim),
+        batch_size=args.batch_size,
+        seed=args.seed,
+        steps_per_epoch=steps_per_epoch,
+        iterator=getattr(args.checkpoint, "iterator", True),
+    )
+    # as saved in json
+    return json.loads(json.dumps(config, sort_keys=True, default=str))
+
+
+def fit_with_checkpoint(model, train_dataset, test_dataset, callbacks_list, args):
+    """model.fit, saving the training state every checkpoint.steps steps
+
+    The state is the model, optimizer, iterator of train_dataset, epoch, step in the epoch
+    and the global random generator. It resumes from the latest state in checkpoint.path,
+    and SIGTERM saves the state at the end of the current step before stopping.
+
+    The default path is keyed by the hash of the configuration, a state of another
+    configuration is not restored, and a finished state is moved aside for a new training.
+    """
+    steps_per_epoch = get_steps_per_epoch(args)
+    config = _get_state_config(args, steps_per_epoch)
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    path = args.checkpoint.path or os.path.join(args.folder, args.model.name, f"state_{key}")
+    max_to_keep = getattr(args.checkpoint, "max_to_keep", None) or 3
+
+    latest = tf.train.latest_checkpoint(path) if os.path.isdir(path) else None
+    if latest:
+        config_path = os.path.join(path, "config.json")
+        if os.path.isfile(config_path):
+            with open(config_path, "r") as tmp:
+                if json.load(tmp) != config:
+                    raise ValueError(
+                        f"Training state {path} is of another configuration, "
+                        f"remove it or set another checkpoint.path..."
+                    )
+        finished = tf.train.load_checkpoint(latest).get_tensor("epoch/.ATTRIBUTES/VARIABLE_VALUE")
+        if finished >= args.epochs:
+            finished_path = f"{path}_finished_{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            print(
+                f"[WARNING] Training state {path} finished {finished} epochs of {args.epochs}, "
+                f"moved to {finished_path}, training starts from the beginning"
+            )
+            os.replace(path, finished_path)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "config.json"), "w") as tmp:
+        json.dump(config, tmp, indent=2, sort_keys=True)
+
+    iterator = iter(train_dataset)
+    epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+    step = tf.Variable(0, dtype=tf.int64, trainable=False)
+    state = dict(
+        model=model,
+        optimizer=model.optimizer,
+        epoch=epoch,
+        step=step,
+        rng=tf.random.get_global_generator(),
+    )
+    # the iterator has the shuffle buffer, large but needed to resume at the exact element
+    if getattr(args.checkpoint, "iterator", True):
+        state["iterator"] = iterator
+    checkpoint = tf.train.Checkpoint(**state)
+    manager = tf.train.CheckpointManager(checkpoint, path, max_to_keep=max_to_keep)
+    options = _get_checkpoint_options()
+
+    if manager.latest_checkpoint:
+        checkpoint.restore(manager.latest_checkpoint)
+        print(f"Resumed from {manager.latest_checkpoint}, epoch {int(epoch)} step {int(step)}")
+    print("Training state: ", path)
+
+    def save():
+        nonlocal options
+        number = int(epoch) * steps_per_epoch + int(step)
+        try:
+            manager.save(checkpoint_number=number, options=options)
+        except ValueError as e:
+            if not options.experimental_enable_async_checkpoint:
+                raise
+            # variables which can't be copied in the background, Keras 3
+            print(f"[WARNING] Checkpoint in the background is not supported, {type(e).__name__}")
+            options = tf.train.CheckpointOptions()
+            manager.save(checkpoint_number=number, options=options)
+
+    preempted = []
+    handler = signal.signal(signal.SIGTERM, lambda signum, frame: preempted.append(signum))
+
+    callbacks = keras.callbacks.CallbackList(
+        callbacks_list,
+        add_history=True,
+        add_progbar=True,
+        model=model,
+        epochs=args.epochs,
+        steps=steps_per_epoch,
+        verbose=1,
+    )
+    model.make_train_function()
+    train_function = model.train_function
+    logs = {}
+    try:
+        callbacks.on_train_begin()
+        while int(epoch) < args.epochs and not model.stop_training:
+            callbacks.on_epoch_begin(int(epoch))
+            model.reset_metrics()
+            while int(step) < steps_per_epoch:
+                callbacks.on_train_batch_begin(int(step))
+                logs = train_function(iterator)
+                logs = {key: float(value) for key, value in logs.items()}
+                step.assign_add(1)
+                callbacks.on_train_batch_end(int(step) - 1, logs)
+                if preempted:
+                    save()
+                    print(f"Preempted, saved at epoch {int(epoch)} step {int(step)}")
+                    return callbacks
+                if int(step) % args.checkpoint.steps == 0:
+                    save()
+
+            val_logs = model.evaluate(test_dataset, return_dict=True, verbose=0)
+            logs.update({f"val_{key}": value for key, value in val_logs.items()})
+            callbacks.on_epoch_end(int(epoch), logs)
+            epoch.assign_add(1)
+            step.assign(0)
+            save()
+        callbacks.on_train_end(logs)
+    finally:
+        if hasattr(manager, "sync"):  # wait for the checkpoint in the background
+            manager.sync()
+        signal.signal(signal.SIGTERM, handler)
+    return callbacks
+
+
 def load_model(args):
     model_name = args.model.name
 
@@ -93,10 +294,51 @@ def load_model(args):
     return model
 
 
-def load_dataset(args):
+def _get_cache_key(args, filenames, **kwargs):
+    """Hash of the settings for parsed features and of the record files"""
+    params = {
+        "model": args.model.name,
+        "frontend": get_frontend(args),
+        "n_feature": args.model.n_feature,
+        "fft_normalization": args.model.fft_normalization,
+        "n_fft": args.dset.n_fft,
+        "hop_length": args.dset.hop_length,
+        "center": args.dset.center,
+        "features": getattr(args.dset, "features", None),
+        "precision": getattr(args.dset, "precision", None),
+        "compression": getattr(args.dset, "compression", None),
+        "files": [
+            [os.path.basename(file), os.path.getsize(file), os.stat(file).st_mtime_ns]
+            for file in sorted(filenames)
+        ],
+        **kwargs,
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_steps_per_epoch(args):
+    """args.steps if it is set, or the number of training batches in the record index"""
+    if args.steps:
+        return args.steps
+    path_to_dataset = get_dataset_path(args)
+    filenames = glob.glob(os.path.join(path_to_dataset, "train_*.tfrecords")) + glob.glob(
+        os.path.join(path_to_dataset, "val_*.tfrecords")
+    )
+    index = update_index(path_to_dataset, filenames, getattr(args.dset, "compression", None))
+    num_records = sum(
+        entry["count"] for name, entry in index["files"].items() if name.startswith("train_")
+    )
+    return max(num_records // args.batch_size, 1)
+
+
+def get_input_stages(args):
+    """Record files and the functions of each stage of the input pipeline
+
+    Returns:
+        dict of path, train/val (filenames, counts), read, parse, extract, parse_batch,
+        shuffle_buffer and the options of the pipeline
+    """
     model_name = args.model.name
-    save_path = args.dset.save_path
-    flag_fft = args.dset.fft
     nfft = args.dset.n_fft
     hop_length = args.dset.hop_length
     center = args.dset.center
@@ -104,39 +346,94 @@ def load_dataset(args):
     segment = args.dset.segment
 
     num_features = args.model.n_feature
-    normalization = args.dset.normalize
     fft_normalization = args.model.fft_normalization
-    top_db = args.dset.top_db
-    train_split = int(args.dset.split * 100)
-    num_segments = int(segment*sample_rate//hop_length + 1)
+    # None: full utterances, parsed one by one and batched by length
+    num_segments = get_num_frames(args)
+    flag_utterance = num_segments is None
 
-    if args.dset.segment_normalization:
-        seg_normalization = args.dset.segment_normalization
-    else:
-        seg_normalization = False
+    # precomputed: real/imag in records, pipeline: stft of samples here, model: samples
+    frontend = get_frontend(args)
+
+    # storage of records, see get_tf_feature_dict
+    precision = getattr(args.dset, "precision", None) or "float32"
+    compression = getattr(args.dset, "compression", None) or ""
+    if precision not in ("float32", "compact"):
+        raise ValueError(f"Precision {precision} should be float32 or compact...")
 
     # 2. Load data
-    path_to_dataset = f"{save_path}/records_seg_{str(segment).replace('.', '-')}_train_{train_split}_norm_{normalization}_segNorm_{seg_normalization}_fft_{flag_fft}_topdB_{top_db}"
-    if args.debug:
-        path_to_dataset = path_to_dataset + "_debug"
-    path_to_dataset = Path(path_to_dataset)
+    path_to_dataset = Path(get_dataset_path(args))
 
     # get training and validation tf record file names
-    train_tfrecords_filenames = glob.glob(os.path.join(path_to_dataset, "train_*"))
-    val_tfrecords_filenames = glob.glob(os.path.join(path_to_dataset, "val_*"))
+    train_tfrecords_filenames = glob.glob(os.path.join(path_to_dataset, "train_*.tfrecords"))
+    val_tfrecords_filenames = glob.glob(os.path.join(path_to_dataset, "val_*.tfrecords"))
+
+    # the number of valid records in each file, scanned once for new or changed files
+    index = update_index(
+        path_to_dataset, train_tfrecords_filenames + val_tfrecords_filenames, compression
+    )
+
+    def get_counts(filenames):
+        return np.array(
+            [index["files"][os.path.basename(filename)]["count"] for filename in filenames],
+            dtype=np.int64,
+        )
 
-    # shuffle the file names for training
-    np.random.shuffle(train_tfrecords_filenames)
     print("Data path: ", path_to_dataset)
-    print("Training file names: ", len(train_tfrecords_filenames))
-    print("Validation file names: ", len(val_tfrecords_filenames))
+    print("Training file names: ", len(train_tfrecords_filenames), "records: ", sum(get_counts(train_tfrecords_filenames)))
+    print("Validation file names: ", len(val_tfrecords_filenames), "records: ", sum(get_counts(val_tfrecords_filenames)))
+    for split, filenames in (("train", train_tfrecords_filenames), ("val", val_tfrecords_filenames)):
+        if sum(get_counts(filenames)) == 0:
+            raise ValueError(
+                f"No valid {split} records in {path_to_dataset}({len(filenames)} files), "
+                f"run create_dataset or see the errors in {INDEX_NAME}..."
+            )
+
+    # parsed validation dataset in memory or in a file, snapshot of parsed training dataset
+    val_cache = getattr(args.dset, "val_cache", None)
+    flag_snapshot = getattr(args.dset, "snapshot", False)
+    if val_cache not in (None, "memory", "disk"):
+        raise ValueError(f"val_cache {val_cache} should be memory or disk...")
 
-    def tf_record_parser(record):
-        if model_name in ("unet", "conv-tasnet"):
-            if flag_fft:
-                raise ValueError(f"{model_name} should flag of fft False in configuration...")
+    # False: faster, but the order of elements is not reproducible
+    deterministic = getattr(args, "deterministic", True)
+    if deterministic is None:
+        deterministic = True
 
-        if flag_fft:
+    flag_pcm = frontend != "precomputed"
+
+    def get_shuffle_buffer(element_bytes):
+        """The number of elements in dset.shuffle_memory(MB), 8192 elements if it is not set"""
+        shuffle_memory = getattr(args.dset, "shuffle_memory", None)
+        if shuffle_memory:
+            buffer_size = max(int(shuffle_memory * 2**20 // element_bytes), args.batch_size)
+        else:
+            buffer_size = 8192
+        print(
+            f"Shuffle buffer: {buffer_size} elements x {element_bytes / 2**10:.1f} KB "
+            f"= {buffer_size * element_bytes / 2**20:.1f} MB"
+        )
+        return buffer_size
+
+    def decode_feature(features, key):
+        """Decode the bytes of key to float32, [batch, ...]"""
+        if precision == "compact" and key in ("noisy", "clean"):
+            pcm = tf.io.decode_raw(features[key], tf.int16)
+            return tf.cast(pcm, tf.float32) * features[f"{key}_scale"][..., tf.newaxis]
+        elif precision == "compact":
+            return tf.cast(tf.io.decode_raw(features[key], tf.float16), tf.float32)
+        return tf.io.decode_raw(features[key], tf.float32)
+
+    def read_tfrecord(filename, count):
+        """Only the valid records in the index, so that no corrupted record is read"""
+        return tf.data.TFRecordDataset(filename, compression_type=compression).take(count)
+
+    def tf_record_parser(records):
+        """Parse a batch of serialized records
+
+        Returns:
+            noisy, clean: samples [batch, samples] or complex stft [batch, frame*freq]
+        """
+        if not flag_pcm:
             keys_to_features = {
                 "noisy_stft_real": tf.io.FixedLenFeature(
                     [], tf.string, default_value=""
@@ -145,40 +442,41 @@ def load_dataset(args):
                 "noisy_stft_imag": tf.io.FixedLenFeature((), tf.string),
                 "clean_stft_imag": tf.io.FixedLenFeature((), tf.string),
             }
-            features = tf.io.parse_single_example(record, keys_to_features)
+            features = tf.io.parse_example(records, keys_to_features)
 
-            noisy_stft_real = tf.io.decode_raw(
-                features["noisy_stft_real"], tf.float32
+            noisy_stft_real = decode_feature(
+                features, "noisy_stft_real"
             )  # phase scaling by clean wav
-            clean_stft_real = tf.io.decode_raw(
-                features["clean_stft_real"], tf.float32
-            )
-            noisy_stft_imag = tf.io.decode_raw(
-                features["noisy_stft_imag"], tf.float32
-            )
-            clean_stft_imag = tf.io.decode_raw(
-                features["clean_stft_imag"], tf.float32
-            )
-            
-            noisy_feature = tf.complex(real=noisy_stft_real, imag=noisy_stft_imag)
-            clean_feature = tf.complex(real=clean_stft_real, imag=clean_stft_imag)
+            clean_stft_real = decode_feature(features, "clean_stft_real")
+            noisy_stft_imag = decode_feature(features, "noisy_stft_imag")
+            clean_stft_imag = decode_feature(features, "clean_stft_imag")
 
-            if fft_normalization:
-                noisy_feature = tf.divide(noisy_feature, nfft)
-                clean_feature = tf.divide(clean_feature, nfft)
-            
+            noisy = tf.complex(real=noisy_stft_real, imag=noisy_stft_imag)
+            clean = tf.complex(real=clean_stft_real, imag=clean_stft_imag)
         else:
             keys_to_features = {
                 "noisy": tf.io.FixedLenFeature((), tf.string, default_value=""),
                 "clean": tf.io.FixedLenFeature((), tf.string),
             }
+            if precision == "compact":
+                keys_to_features["noisy_scale"] = tf.io.FixedLenFeature((), tf.float32)
+                keys_to_features["clean_scale"] = tf.io.FixedLenFeature((), tf.float32)
 
-            features = tf.io.parse_single_example(record, keys_to_features)
+            features = tf.io.parse_example(records, keys_to_features)
 
-            noisy = tf.io.decode_raw(features["noisy"], tf.float32)
-            clean = tf.io.decode_raw(features["clean"], tf.float32)
+            noisy = decode_feature(features, "noisy")
+            clean = decode_feature(features, "clean")
 
+        return noisy, clean
 
+    def extract_feature(noisy, clean):
+        """Input and target of the model from a parsed batch, one stft for the batch"""
+        if frontend == "model":
+            noisy_feature = tf.reshape(noisy, (-1, 1, int(sample_rate*segment)), name="noisy_feature")
+            clean_feature = tf.reshape(clean, (-1, 1, int(sample_rate*segment)), name="clean_feature")
+            return noisy_feature, clean_feature
+
+        if flag_pcm:
             noisy_feature = stft_tensorflow(wav=noisy, 
                                             nfft=nfft, 
                                             hop_length=hop_length, 
@@ -192,41 +490,203 @@ def load_dataset(args):
                                             center=center, 
                                             normalize=fft_normalization
                                             )
-        if model_name in ("unet", "conv-tasnet"):
-            noisy_feature = tf.reshape(noisy, (1, int(sample_rate*segment)), name="noisy_feature")
-            clean_feature = tf.reshape(clean, (1, int(sample_rate*segment)), name="clean_feature")
         else:
-            noisy_feature = tf.reshape(noisy_feature, (1, num_segments, num_features), name="noisy_feature")
-            clean_feature = tf.reshape(clean_feature, (1, num_segments, num_features), name="clean_feature")
+            noisy_feature, clean_feature = noisy, clean
+            if fft_normalization:
+                noisy_feature = tf.divide(noisy_feature, nfft)
+                clean_feature = tf.divide(clean_feature, nfft)
 
+        if flag_utterance:
+            shape = (tf.shape(noisy_feature)[0], 1, -1, num_features)
+        else:
+            shape = (-1, 1, num_segments, num_features)
+        noisy_feature = tf.reshape(noisy_feature, shape, name="noisy_feature")
+        clean_feature = tf.reshape(clean_feature, shape, name="clean_feature")
         return noisy_feature, clean_feature
 
+    def parse_batch(records):
+        return extract_feature(*tf_record_parser(records))
+
+    def parse_utterance(record):
+        """Parse a record of full utterance, [1, frame, freq]"""
+        noisy, clean = extract_feature(*tf_record_parser(record[tf.newaxis]))
+        return noisy[0], clean[0]
+
+    # length boundaries of buckets(sec) to frames
+    bucket_boundaries = sorted(
+        int(sec * sample_rate // hop_length + 1)
+        for sec in (getattr(args.dset, "buckets", None) or [2, 3, 4, 5])
+    )
+
+    def bucket(dataset):
+        """Batch parsed utterances of similar length, zero-padded to the longest in the batch"""
+        return dataset.bucket_by_sequence_length(
+            element_length_func=lambda noisy, clean: tf.shape(noisy)[-2],
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=[args.batch_size] * (len(bucket_boundaries) + 1),
+        )
+
+    return dict(
+        path=path_to_dataset,
+        train=(train_tfrecords_filenames, get_counts(train_tfrecords_filenames)),
+        val=(val_tfrecords_filenames, get_counts(val_tfrecords_filenames)),
+        read=read_tfrecord,
+        parse=tf_record_parser,
+        extract=extract_feature,
+        parse_batch=parse_batch,
+        parse_utterance=parse_utterance,
+        bucket=bucket,
+        utterance=flag_utterance,
+        shuffle_buffer=get_shuffle_buffer,
+        compression=compression,
+        deterministic=deterministic,
+        snapshot=flag_snapshot,
+        val_cache=val_cache,
+    )
+
+
+def load_dataset(args):
+    stages = get_input_stages(args)
+    path_to_dataset = stages["path"]
+    train_tfrecords_filenames, train_counts = stages["train"]
+    val_tfrecords_filenames, val_counts = stages["val"]
+    read_tfrecord = stages["read"]
+    parse_batch = stages["parse_batch"]
+    parse_utterance = stages["parse_utterance"]
+    bucket = stages["bucket"]
+    get_shuffle_buffer = stages["shuffle_buffer"]
+    compression = stages["compression"]
+    deterministic = stages["deterministic"]
+    flag_snapshot = stages["snapshot"]
+    flag_utterance = stages["utterance"]
+    val_cache = stages["val_cache"]
+
+    def parse(dataset):
+        """Parsed elements from records, full utterances one by one, segments by batch"""
+        if flag_utterance:
+            return dataset.map(
+                parse_utterance,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=deterministic,
+            )
+        dataset = dataset.batch(args.batch_size)
+        dataset = dataset.map(
+            parse_batch,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic,
+        )
+        return dataset.unbatch()
+
+    def parse_and_batch(dataset):
+        """Batches from records, full utterances are batched by length after parsing"""
+        if flag_utterance:
+            return bucket(parse(dataset))
+        dataset = dataset.batch(args.batch_size)
+        return dataset.map(
+            parse_batch,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=deterministic,
+        )
+
+    # the size of a serialized record from the first file
+    record_bytes = 1
+    for filename, count in zip(train_tfrecords_filenames, train_counts):
+        if count > 0:
+            record = next(iter(tf.data.TFRecordDataset(filename, compression_type=compression)))
+            record_bytes = len(record.numpy())
+            break
+
     """
     TFRecordDataset
-      map: map between each filenames and custom function
-      shuffle: shuffle the number of data, it can set a seed
+      interleave: read several record files(shards) in parallel
+      shuffle: order of files every epoch, then elements in a buffer of dset.shuffle_memory
       repeat: if repeat 2, then [1, 2] -> [1, 2, 1, 2]
-      batch: same as batch concept
+      batch: same as batch concept, serialized records are batched before parsing
+      map: parse_example and stft for a whole batch, in parallel
+      bucket: full utterances are parsed first, then batched with ones of similar length
       prefetch: prepare while training, if set the buffer size as tf.data.experimental.AUTOTUNE, it use automatic method in keras
+      deterministic: if False, elements which are ready first are produced first
+      snapshot: save parsed elements once, read them instead of records from then on
+      cache: keep parsed validation batches in memory or in a file
     """
-    train_dataset = tf.data.TFRecordDataset([train_tfrecords_filenames])
-    train_dataset = train_dataset.map(tf_record_parser)
-    train_dataset = train_dataset.shuffle(8192)
-    train_dataset = train_dataset.repeat()
-    train_dataset = train_dataset.batch(args.batch_size)
+    train_dataset = tf.data.Dataset.from_tensor_slices(
+        (train_tfrecords_filenames, train_counts)
+    )
+    if not flag_snapshot:
+        # order of files is shuffled again every epoch
+        train_dataset = train_dataset.shuffle(
+            max(len(train_tfrecords_filenames), 1), reshuffle_each_iteration=True
+        )
+        train_dataset = train_dataset.repeat()
+    train_dataset = train_dataset.interleave(
+        read_tfrecord,
+        cycle_length=tf.data.experimental.AUTOTUNE,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=deterministic,
+    )
+    if flag_snapshot:
+        # parse and stft once, shuffle the parsed elements read from the snapshot
+        snapshot_path = os.path.join(
+            path_to_dataset, f"snapshot_train_{_get_cache_key(args, train_tfrecords_filenames)}"
+        )
+        print("Snapshot: ", snapshot_path)
+        train_dataset = parse(train_dataset)
+
+        # saved explicitly, the fingerprint of Dataset.snapshot changes between processes
+        element_spec = train_dataset.element_spec
+        if not os.path.isdir(snapshot_path):
+            print("Writing snapshot...")
+            tmp_path = f"{snapshot_path}.tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if hasattr(tf.data.Dataset, "save"):
+                train_dataset.save(tmp_path)
+            else:
+                # tf < 2.10
+                tf.data.experimental.save(train_dataset, tmp_path)
+            os.replace(tmp_path, snapshot_path)
+        if hasattr(tf.data.Dataset, "load"):
+            train_dataset = tf.data.Dataset.load(snapshot_path, element_spec=element_spec)
+        else:
+            train_dataset = tf.data.experimental.load(snapshot_path, element_spec=element_spec)
+        if flag_utterance:
+            element_bytes = record_bytes
+        else:
+            element_bytes = sum(
+                spec.shape.num_elements() * spec.dtype.size for spec in tf.nest.flatten(element_spec)
+            )
+        train_dataset = train_dataset.shuffle(get_shuffle_buffer(element_bytes))
+        train_dataset = train_dataset.repeat()
+        if flag_utterance:
+            train_dataset = bucket(train_dataset)
+        else:
+            train_dataset = train_dataset.batch(args.batch_size)
+    else:
+        # serialized records are in the buffer
+        train_dataset = train_dataset.shuffle(get_shuffle_buffer(record_bytes))
+        train_dataset = parse_and_batch(train_dataset)
     train_dataset = train_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
-    # DataLossError (see above for traceback): corrupted record at 1261886956
-    # node IteratorGetNext
-    # Shape/_6
-    # https://github.com/tensorflow/tensorflow/issues/13463
-    train_dataset = train_dataset.apply(tf.data.experimental.ignore_errors())
-
     # val_dataset
-    test_dataset = tf.data.TFRecordDataset([val_tfrecords_filenames])
-    test_dataset = test_dataset.map(tf_record_parser)
+    test_dataset = tf.data.Dataset.from_tensor_slices(
+        (val_tfrecords_filenames, val_counts)
+    )
+    test_dataset = test_dataset.interleave(
+        read_tfrecord,
+        cycle_length=tf.data.experimental.AUTOTUNE,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=deterministic,
+    )
     test_dataset = test_dataset.repeat(1)
-    test_dataset = test_dataset.batch(args.batch_size)
-    test_dataset = test_dataset.apply(tf.data.experimental.ignore_errors())
+    test_dataset = parse_and_batch(test_dataset)
+    if val_cache == "memory":
+        test_dataset = test_dataset.cache()
+    elif val_cache == "disk":
+        cache_path = os.path.join(
+            path_to_dataset,
+            f"cache_val_{_get_cache_key(args, val_tfrecords_filenames, batch_size=args.batch_size)}",
+        )
+        print("Validation cache: ", cache_path)
+        test_dataset = test_dataset.cache(cache_path)
+    test_dataset = test_dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
 
     return train_dataset, test_dataset
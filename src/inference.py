@@ -13,7 +13,7 @@ import tensorflow as tf
 import numpy as np
 from src.preprocess.VoiceBankDEMAND import VoiceBandDEMAND
 from src.preprocess.feature_extractor import FeatureExtractor
-from src.utils import read_audio, load_yaml, limit_gpu_tf
+from src.utils import read_audio, AudioCache, load_yaml, limit_gpu_tf, get_frontend, normalize_audio, decode_normalize
 from src.distrib import load_model
 
 # Load the TensorBoard notebook extension.
@@ -82,19 +82,22 @@ def inference(clean_file, noisy_file, args, return_metric=False):
     win_length = args.dset.win_length
     segment = args.dset.segment
     num_segments = int(segment*sample_rate//hop_length + 1)
+    # model: wav in and wav out, stft in the model or waveform model
+    frontend = get_frontend(args)
 
     # 3. Build and Load Model
     model = load_model(args)
 
     # 4. Load audio files
-    clean_audio, sr = read_audio(clean_file, sample_rate)
-    noisy_audio, sr = read_audio(noisy_file, sample_rate)
+    cache = AudioCache.from_args(args.dset)
+    resample_method = getattr(args.dset, "resample", None) or "resampy"
+    clean_audio, sr = read_audio(clean_file, sample_rate, cache, resample_method)
+    noisy_audio, sr = read_audio(noisy_file, sample_rate, cache, resample_method)
 
-    mean_noisy = np.mean(noisy_audio)
-    std_noisy = np.std(noisy_audio)
-    noisy_audio_norm = (noisy_audio - mean_noisy) / std_noisy
+    # dset.normalize as preprocess, reverted after the model
+    noisy_audio_norm, noisy_metadata = normalize_audio(noisy_audio, normalization)
 
-    if model_name in ("unet", "conv-tasnet"):
+    if frontend == "model":
         num_feature = int(sample_rate*segment)
         stride = 256
         noisy_input = _prepare_input_wav_zero_filled(noisy_audio_norm, num_feature=num_feature, stride=stride)
@@ -111,7 +114,7 @@ def inference(clean_file, noisy_file, args, return_metric=False):
         
     output = model.predict(noisy_input)
     
-    if model_name in ("unet", "conv-tasnet"):
+    if frontend == "model":
         shape = list(noisy_audio_norm.shape)
         shape = shape[:-1] + [num_feature + stride*(output.shape[0]-1)]
         estimation = np.zeros(shape=shape, dtype=noisy_audio_norm.dtype)
@@ -121,22 +124,19 @@ def inference(clean_file, noisy_file, args, return_metric=False):
             estimation[..., curr_loc: curr_loc+stride] = output[ibatch+1, ..., -stride:]
 
         estimation = estimation[..., :noisy_audio_norm.shape[-1]]
-        estimation = estimation*mean_noisy + std_noisy
+        estimation = decode_normalize(estimation, normalization, noisy_metadata)
     else:
         output = output[..., -1, :]
         output = np.squeeze(output)
 
-        def revert_features_to_audio(stft, mean=None, std=None):
+        def revert_features_to_audio(stft, metadata):
             stft = np.transpose(stft, (1, 0))
             stft *= nfft
             estimated_audio = noisy_audio_feature_extractor.get_audio_from_stft_spectrogram(stft, center)
             
             # scale the outpus back to the original range
-            if mean and std:
-                estimated_audio = std * estimated_audio + mean
-            
-            return estimated_audio
-        estimation = revert_features_to_audio(output, mean_noisy, std_noisy)
+            return decode_normalize(estimated_audio, normalization, metadata)
+        estimation = revert_features_to_audio(output, noisy_metadata)
     
     print("Min:", np.min(estimation),"Max:",np.max(estimation))
 
@@ -145,20 +145,18 @@ def inference(clean_file, noisy_file, args, return_metric=False):
         filename = clean_file.split('/')[-1].split('.')[0]
         metric_sisdr = {filename:{}}
         
-        if model_name in ("unet", "conv-tasnet"):
-            noisy_bypass = mean_noisy*noisy_audio_norm + std_noisy
+        if frontend == "model":
+            noisy_bypass = decode_normalize(noisy_audio_norm, normalization, noisy_metadata)
             clean_bypass = clean_audio
         else:
-            mean_clean = np.mean(clean_audio)
-            std_clean = np.std(clean_audio)
-            clean_audio_norm = (clean_audio - mean_clean) / std_clean
+            clean_audio_norm, clean_metadata = normalize_audio(clean_audio, normalization)
             clean_audio_feature_extractor = FeatureExtractor(clean_audio_norm, windowLength=win_length, hop_length=hop_length, sample_rate=sr)
             clean_stft_features = clean_audio_feature_extractor.get_stft_spectrogram(center)
             clean_stft_features /= nfft
             
             noisy_bypass = noisy_input[..., -1, :]
             noisy_bypass = np.squeeze(noisy_bypass)
-            noisy_bypass = revert_features_to_audio(noisy_bypass, mean_noisy, std_noisy)
+            noisy_bypass = revert_features_to_audio(noisy_bypass, noisy_metadata)
 
             clean_input = _prepare_input_stft_zero_filled(clean_stft_features, num_segments, num_features)
             clean_input = np.transpose(clean_input, (2, 1, 0))
@@ -166,7 +164,7 @@ def inference(clean_file, noisy_file, args, return_metric=False):
 
             clean_bypass = clean_input[..., -1, :]
             clean_bypass = np.squeeze(clean_bypass)
-            clean_bypass = revert_features_to_audio(clean_bypass, mean_clean, std_clean)
+            clean_bypass = revert_features_to_audio(clean_bypass, clean_metadata)
 
         estimation_metric = estimation
 
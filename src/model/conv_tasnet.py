@@ -12,8 +12,7 @@ import keras
 import keras.layers
 from keras.backend import epsilon
 
-import os
-from src.utils import load_json
+from src.utils import load_optimizer_state
 
 from .metrics import (
     CustomMetric,
@@ -500,47 +499,8 @@ def compile_model(model: keras.Model, args):
         raise NotImplementedError(f"Loss '{self.metric}' is not implemented")
 
     if args.model.path is not None and args.optim.load:
-        if "optimizer" in os.listdir(args.model.path):  # optimizer folder check
-            tf.print("Optimizer Loading...")
-            dummpy_model = build_conv_tasnet_model_tf(args)
-            optimizer_state = load_json(
-                os.path.join(args.model.path, "optimizer/optim.json")
-            )["optimizer"]
-            dummy_batch_size = 1
-            dummy_tensor = tf.ones(
-                shape=(
-                    dummy_batch_size,
-                    1,
-                    int(args.dset.sample_rate*args.dset.segment),
-                ),
-                dtype=tf.float32,
-            )
-            dummy_clean_tensor = tf.ones(
-                shape=(
-                    dummy_batch_size,
-                    1,
-                    int(args.dset.sample_rate*args.dset.segment),
-                ), 
-                dtype=tf.float32,
-            )
-
-            dummpy_model.compile(
-                optimizer=optimizer,
-                loss=loss_function,
-            )
-            dummpy_model.fit(
-                x=dummy_tensor, y=dummy_clean_tensor, batch_size=dummy_batch_size
-            )
-            
-            del (
-                dummpy_model,
-                dummy_tensor,
-                dummy_clean_tensor,
-            )  
-            
-            len_optimizer = len(optimizer.get_weights()) 
-            optimizer.set_weights(optimizer_state[:len_optimizer])
-
+        tf.print("Optimizer Loading...")
+        if load_optimizer_state(args.model.path, model, optimizer):
             tf.print("Optimizer was loaded!")
         else:
             tf.print("Optimizer was not existed!")
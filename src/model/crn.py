@@ -10,8 +10,7 @@ import tensorflow as tf
 import keras
 import keras.layers
 
-import os
-from src.utils import load_json
+from src.utils import load_optimizer_state, get_frontend, get_num_frames
 
 from .metrics import (
     CustomMetric,
@@ -23,6 +22,7 @@ from .loss import (
     ideal_amplitude_mask,
     phase_sensitive_spectral_approximation_loss,
     phase_sensitive_spectral_approximation_loss_bose,
+    waveform_loss,
 )
 
 import tensorflow as tf
@@ -31,6 +31,7 @@ import keras.layers
 from .time_frequency import(
     Magnitude,
     SqueezeChannel,
+    build_waveform_model,
 )
 
 class ZeroPadding(keras.layers.Layer):
@@ -154,11 +155,12 @@ class CausalTransConvBlockTF(keras.layers.Layer):
 
 def build_crn_model_tf(args):
     """
-    Input: [batch size, channels=1, T, n_fft]
+    Input: [batch size, channels=1, T, n_fft], T is None for full utterances
     Output: [batch size, T, n_fft]
+    frontend: model, [batch size, channels=1, samples] in and out
     """
     inputs = keras.layers.Input(
-        shape=[1, int(args.dset.segment*args.dset.sample_rate//args.dset.hop_length + 1), args.model.n_feature],
+        shape=[1, get_num_frames(args), args.model.n_feature],
         name="input",
         dtype=tf.complex64,
     )
@@ -180,17 +182,17 @@ def build_crn_model_tf(args):
     conv_block_4 = CausalConvBlockTF(in_channels=64, out_channels=128)(conv_block_3)
     conv_block_5 = CausalConvBlockTF(in_channels=128, out_channels=256)(conv_block_4)
 
-    _, n_frame_size, n_channels, n_f_bins = conv_block_5.shape
+    _, _, n_channels, n_f_bins = conv_block_5.shape
 
     # LSTM
-    reshape_1 = keras.layers.Reshape(target_shape=(n_frame_size, n_channels * n_f_bins))(conv_block_5)
+    reshape_1 = keras.layers.Reshape(target_shape=(-1, n_channels * n_f_bins))(conv_block_5)
     lstm_layer_1 = keras.layers.LSTM(units=n_channels * n_f_bins, 
                                         activation='tanh', 
                                         return_sequences=True)(reshape_1)
     lstm_layer_2 = keras.layers.LSTM(units=n_channels * n_f_bins, 
                                         activation='tanh', 
                                         return_sequences=True)(lstm_layer_1)
-    lstm_out = keras.layers.Reshape(target_shape=(n_frame_size, n_channels, n_f_bins))(lstm_layer_2)
+    lstm_out = keras.layers.Reshape(target_shape=(-1, n_channels, n_f_bins))(lstm_layer_2)
 
     # Decoder
     tran_conv_block_1 = CausalTransConvBlockTF(out_channels=128)(tf.concat((lstm_out, conv_block_5), -1))
@@ -208,6 +210,9 @@ def build_crn_model_tf(args):
 
     model = keras.Model(inputs=inputs, outputs=outputs)
 
+    if get_frontend(args) == "model":
+        model = build_waveform_model(model, args)
+
     return model
 
 
@@ -232,50 +237,20 @@ def compile_model(model: keras.Model, args):
     else:
         raise NotImplementedError(f"Loss '{self.metric}' is not implemented")
 
-    if args.model.path is not None and args.optim.load:
-        if "optimizer" in os.listdir(args.model.path):  # optimizer folder check
-            tf.print("Optimizer Loading...")
-            dummpy_model = build_crn_model_tf(args)
-            optimizer_state = load_json(
-                os.path.join(args.model.path, "optimizer/optim.json")
-            )["optimizer"]
-            dummy_batch_size = 1
-            dummy_tensor = tf.ones(
-                shape=(
-                    dummy_batch_size,
-                    1,
-                    int(args.dset.segment*args.dset.sample_rate//args.dset.hop_length + 1),
-                    args.model.n_feature,
-                ),
-                dtype=tf.complex64,
-            )
-            dummy_clean_tensor = tf.ones(
-                shape=(
-                    dummy_batch_size,
-                    1,
-                    int(args.dset.segment*args.dset.sample_rate//args.dset.hop_length + 1),
-                    args.model.n_feature,
-                ), 
-                dtype=tf.complex64,
-            )
-
-            dummpy_model.compile(
-                optimizer=optimizer,
-                loss=loss_function,
-            )
-            dummpy_model.fit(
-                x=dummy_tensor, y=dummy_clean_tensor, batch_size=dummy_batch_size
-            )
-            
-            del (
-                dummpy_model,
-                dummy_tensor,
-                dummy_clean_tensor,
-            )  
-            
-            len_optimizer = len(optimizer.get_weights()) 
-            optimizer.set_weights(optimizer_state[:len_optimizer])
+    # frontend: model, the loss is on the stft of output waveform
+    stft = None
+    if get_frontend(args) == "model":
+        stft = dict(
+            n_fft=args.dset.n_fft,
+            hop_length=args.dset.hop_length,
+            center=args.dset.center,
+            normalize=args.model.fft_normalization,
+        )
+        loss_function = waveform_loss(loss_function, **stft)
 
+    if args.model.path is not None and args.optim.load:
+        tf.print("Optimizer Loading...")
+        if load_optimizer_state(args.model.path, model, optimizer):
             tf.print("Optimizer was loaded!")
         else:
             tf.print("Optimizer was not existed!")
@@ -287,9 +262,10 @@ def compile_model(model: keras.Model, args):
             hop_length=args.dset.hop_length,
             normalize=args.model.fft_normalization,
             name=metric_name,
+            waveform=stft is not None,
         )
         for metric_name in args.model.metric
     ]
-    metrics.append(CustomMetric(metric=args.optim.loss, name=args.optim.loss))
+    metrics.append(CustomMetric(metric=args.optim.loss, name=args.optim.loss, stft=stft))
 
     model.compile(optimizer=optimizer, loss=loss_function, metrics=metrics)
@@ -0,0 +1,132 @@
+"""
+Speech metrics out of the training graph
+
+    PESQ, STOI and SDR are numpy functions, in tf.py_function they are serial and
+    crash in threads(OMP: Error #131). AsyncSpeechEvaluation enhances a part of the
+    validation dataset after each epoch and sends the audio to a process pool,
+    then the scores are written to TensorBoard and evaluation.json when they are ready.
+    PESQ goes to the pool of the shared PESQEngine(get_pesq_engine), the others to the
+    pool of the callback.
+"""
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+import keras.callbacks
+
+from .metrics import spectrum_to_waveform
+from .pesq_engine import get_pesq_engine, mean_pesq
+from src.utils import get_frontend, SingleThreadSpawnContext
+
+
+def _evaluate_batch(metric_names, reference, estimation, sample_rate):
+    """Scores of a batch, reference and estimation are [batch, channel, samples]"""
+    from .metrics import STOI, ESTOI, SDR, SDR_v3
+
+    functions = {"stoi": STOI, "estoi": ESTOI, "sdr": SDR, "sdr-v3": SDR_v3}
+    return {
+        name: float(functions[name](reference, estimation, sample_rate))
+        for name in metric_names
+    }
+
+
+class AsyncSpeechEvaluation(keras.callbacks.Callback):
+    """Evaluate metrics of evaluation.metric in background processes after each epoch
+
+    The training loop only waits for the enhancement of evaluation.batches
+    validation batches, the metrics are collected when they are done.
+    """
+
+    METRICS = ("wb-pesq", "nb-pesq", "stoi", "estoi", "sdr", "sdr-v3")
+    PESQ_MODES = {"wb-pesq": "wb", "nb-pesq": "nb"}
+
+    def __init__(self, dataset, path, args):
+        super().__init__()
+        self.metric_names = list(args.evaluation.metric)
+        for name in self.metric_names:
+            if name not in self.METRICS:
+                raise ValueError(f"Metric {name} should be one of {self.METRICS}...")
+
+        self.dataset = dataset.take(getattr(args.evaluation, "batches", None) or 8)
+        self.num_workers = getattr(args.evaluation, "num_workers", None) or 2
+        self.sample_rate = args.dset.sample_rate
+        self.n_fft = args.dset.n_fft
+        self.hop_length = args.dset.hop_length
+        self.normalize = args.model.fft_normalization
+        self.waveform = args.model.name in ("unet", "conv-tasnet") or get_frontend(args) == "model"
+        self.json_path = os.path.join(path, "evaluation.json")
+        self.logdir = os.path.join(path, "logs", "evaluation")
+        self.pool = None
+        self.engine = None
+        self.pending = {}
+        self.results = {}
+
+    def on_train_begin(self, logs=None):
+        # spawn, the main process already initialized tensorflow
+        # one openmp thread per process, openmp in several threads crashes
+        self.pool = ProcessPoolExecutor(self.num_workers, mp_context=SingleThreadSpawnContext())
+        if any(name in self.PESQ_MODES for name in self.metric_names):
+            # kept open after training, the other users of the engine share its pool
+            self.engine = get_pesq_engine(self.sample_rate, self.num_workers)
+        self.writer = tf.summary.create_file_writer(self.logdir)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.collect()
+        names = [name for name in self.metric_names if name not in self.PESQ_MODES]
+        futures = []
+        for noisy, clean in self.dataset:
+            estimation = self.model(noisy, training=False)
+            if not self.waveform:
+                clean = spectrum_to_waveform(clean, self.n_fft, self.hop_length, self.normalize)
+                estimation = spectrum_to_waveform(estimation, self.n_fft, self.hop_length, self.normalize)
+            clean, estimation = np.asarray(clean), np.asarray(estimation)
+
+            # (metric names, future), a dict of the names or PESQ of each pair
+            if names:
+                futures.append((names, self.pool.submit(_evaluate_batch, names, clean, estimation, self.sample_rate)))
+            for name in self.metric_names:
+                if name in self.PESQ_MODES:
+                    futures.append(([name], self.engine.submit(clean, estimation, mode=self.PESQ_MODES[name])))
+        self.pending[epoch] = futures
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.collect()
+
+    def on_train_end(self, logs=None):
+        self.collect(wait=True)
+        self.pool.shutdown()
+        self.writer.close()
+
+    def collect(self, wait=False):
+        """Write the scores of the epochs whose batches are all evaluated"""
+        for epoch in sorted(self.pending):
+            futures = self.pending[epoch]
+            if not wait and not all(future.done() for _, future in futures):
+                continue
+            scores = {name: [] for name in self.metric_names}
+            for names, future in futures:
+                try:
+                    result = future.result()
+                    if not isinstance(result, dict):
+                        result = {names[0]: float(mean_pesq(result, self.PESQ_MODES[names[0]]))}
+                    for name, score in result.items():
+                        scores[name].append(score)
+                except Exception as e:
+                    # evaluation never stops training
+                    print(f"[WARNING] Evaluation epoch {epoch + 1} failed a batch of {names}, {e!r}")
+            del self.pending[epoch]
+            if not any(scores.values()):
+                continue
+
+            result = {name: float(np.mean(values)) for name, values in scores.items() if values}
+            self.results[epoch + 1] = result
+            with self.writer.as_default():
+                for name, value in result.items():
+                    tf.summary.scalar(f"evaluation/{name}", value, step=epoch)
+            self.writer.flush()
+
+            with open(self.json_path, "w") as tmp:
+                json.dump(self.results, tmp, indent=4)
+            print(f"\nEvaluation epoch {epoch + 1}: {result}")
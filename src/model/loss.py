@@ -1,5 +1,7 @@
 import tensorflow as tf
 from keras.backend import epsilon
+from src.utils import stft_tensorflow
+
 def convert_stft_from_amplitude_phase(y):
     y_amplitude = y[..., 0, :, :, :]  # amp/phase, ch, frame, freq
     y_phase = y[..., 1, :, :, :]
@@ -117,4 +119,15 @@ def phase_sensitive_spectral_approximation_loss_bose(y_true, y_pred, train=True)
     else:
         # For metric
         loss = tf.math.reduce_mean(loss)
-        return loss
\ No newline at end of file
+        return loss
+
+
+def waveform_loss(loss_function, n_fft, hop_length, center=True, normalize=True):
+    """Loss on the stft of waveforms, for the models with stft in the model(frontend: model)"""
+    def loss(y_true, y_pred, train=True):
+        y_true = stft_tensorflow(y_true, n_fft, hop_length, center=center, normalize=normalize)
+        y_pred = stft_tensorflow(y_pred, n_fft, hop_length, center=center, normalize=normalize)
+        return loss_function(y_true, y_pred, train)
+
+    loss.__name__ = loss_function.__name__
+    return loss
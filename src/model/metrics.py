@@ -1,9 +1,9 @@
 import tensorflow as tf
 import numpy as np
-from pesq import pesq, cypesq
-from pypesq import pesq as nb_pesq
-from pystoi import stoi
-from museval.metrics import bss_eval
+
+from .pesq_engine import get_pesq_engine, mean_pesq
+from .stoi import stoi_batch
+from .sdr import sdr_batch, sdr_tensorflow
 
 from .loss import (
     mean_square_error_amplitdue_phase,
@@ -11,10 +11,14 @@ from .loss import (
     ideal_amplitude_mask,
     phase_sensitive_spectral_approximation_loss,
     phase_sensitive_spectral_approximation_loss_bose,
+    waveform_loss,
 )
 
-def SDR(reference, estimation, sr=16000):
-    """Signal to Distortion Ratio (SDR) from museval
+def SDR(reference, estimation, sr=16000, bsseval_sources_version=False):
+    """Signal to Distortion Ratio (SDR), bss_eval of museval for each pair
+
+    The default of museval(images), with one source it is the same as SNR.
+    bsseval_sources_version allows the distortion filter of 512 taps(BSS Eval v3), metric 'sdr-v3'.
 
     Reference
     ---------
@@ -23,21 +27,29 @@ def SDR(reference, estimation, sr=16000):
     IEEE Transactions on Audio, Speech and Language Processing, 14(4), 1462-1469.
 
     """
-    if not isinstance(reference, np.ndarray):
-        reference_numpy = reference.numpy()
-        estimation_numpy = estimation.numpy()
-    else:
-        reference_numpy = reference
-        estimation_numpy = estimation 
-    sdr_batch = np.empty(shape=(reference_numpy.shape[0], reference_numpy.shape[1]))
-
-    for batch in range(reference_numpy.shape[0]):
-        for ch in range(reference_numpy.shape[1]):
-            sdr_batch[batch, ch], _, _, _, _ = bss_eval(
-                reference_numpy[batch, ch], estimation_numpy[batch, ch]
-            )
-    sdr_batch = np.mean(sdr_batch)
-    return sdr_batch
+    return np.nanmean(sdr_batch(reference, estimation, bsseval_sources_version=bsseval_sources_version))
+
+
+def SDR_v3(reference, estimation, sr=16000):
+    """SDR with the distortion filter, bsseval_sources_version of museval"""
+    return SDR(reference, estimation, sr, bsseval_sources_version=True)
+
+
+def SDR_tensorflow(reference, estimation, bsseval_sources_version=False):
+    """SDR in tensorflow, mean of the pairs except silent ones, the same as SDR
+
+    Args:
+        reference: tf.Tensor, [..., T]
+        estimation: tf.Tensor, [..., T]
+    """
+    sdr = sdr_tensorflow(reference, estimation, bsseval_sources_version=bsseval_sources_version)
+    valid = tf.math.is_finite(sdr)
+    return tf.reduce_sum(tf.where(valid, sdr, 0.0)) / tf.maximum(tf.reduce_sum(tf.cast(valid, tf.float32)), 1.0)
+
+
+def SDR_v3_tensorflow(reference, estimation):
+    """SDR_v3 in tensorflow"""
+    return SDR_tensorflow(reference, estimation, bsseval_sources_version=True)
 
 
 def SI_SDR(reference, estimation, sr=16000):
@@ -67,84 +79,87 @@ def SI_SDR(reference, estimation, sr=16000):
     return 10 * np.log10(ratio+np.finfo(dtype=reference_energy.dtype).eps)
 
 
+def SI_SDR_tensorflow(reference, estimation):
+    """SI_SDR in tensorflow, the same value without leaving the graph
+
+    Args:
+        reference: tf.Tensor, [..., T]
+        estimation: tf.Tensor, [..., T]
+    """
+    eps = np.finfo(np.float32).eps
+    reference_energy = tf.reduce_sum(reference**2, axis=-1, keepdims=True)
+
+    optimal_scaling = (
+        tf.reduce_sum(estimation*reference, axis=-1, keepdims=True) / (reference_energy + eps)
+    )
+
+    projection = optimal_scaling * reference
+    noise = estimation - projection
+
+    ratio = tf.reduce_sum(projection**2, axis=-1) / (tf.reduce_sum(noise**2, axis=-1) + eps)
+    ratio = tf.reduce_mean(ratio)
+    return 10 * tf.math.log(ratio + eps) / tf.math.log(10.0)
+
+
+def SNR_tensorflow(reference, estimation):
+    """Signal to Noise Ratio, the residual estimation - reference as noise
+
+    Args:
+        reference: tf.Tensor, [..., T]
+        estimation: tf.Tensor, [..., T]
+    """
+    eps = np.finfo(np.float32).eps
+    noise = estimation - reference
+
+    ratio = tf.reduce_sum(reference**2, axis=-1) / (tf.reduce_sum(noise**2, axis=-1) + eps)
+    ratio = tf.reduce_mean(ratio)
+    return 10 * tf.math.log(ratio + eps) / tf.math.log(10.0)
+
+
 def STOI(reference, estimation, sr=16000):
-    if not isinstance(reference, np.ndarray):
-        reference_numpy = reference.numpy()
-        estimation_numpy = estimation.numpy()
-    else:
-        reference_numpy = reference
-        estimation_numpy = estimation 
-    stoi_batch = np.empty(shape=(reference_numpy.shape[0], reference_numpy.shape[1]))
-    for batch in range(reference_numpy.shape[0]):
-        for ch in range(reference_numpy.shape[1]):
-            stoi_batch[batch, ch] = stoi(
-                reference_numpy[batch, ch],
-                estimation_numpy[batch, ch],
-                sr,
-                extended=False,
-            )
+    """Short-Time Objective Intelligibility, mean of the pairs in a batch"""
+    return np.mean(stoi_batch(reference, estimation, sr, extended=False))
+
 
-    stoi_batch = np.mean(stoi_batch)
-    return stoi_batch
+def ESTOI(reference, estimation, sr=16000):
+    """Extended STOI, mean of the pairs in a batch"""
+    return np.mean(stoi_batch(reference, estimation, sr, extended=True))
 
 
 def WB_PESQ(reference, estimation, sr=16000):
-    if not isinstance(reference, np.ndarray):
-        reference_numpy = reference.numpy()
-        estimation_numpy = estimation.numpy()
-    else:
-        reference_numpy = reference
-        estimation_numpy = estimation        
-    num_batch, num_channel = reference_numpy.shape[0], reference_numpy.shape[1]
-    pesq_batch = np.empty(shape=(num_batch, num_channel))
-
-    count_error = 0
-    for batch in range(num_batch):
-        for ch in range(num_channel):
-            try:
-                pesq_batch[batch, ch] = pesq(
-                    sr,
-                    reference_numpy[batch, ch],
-                    estimation_numpy[batch, ch],
-                    mode="wb",
-                )
-            except cypesq.NoUtterancesError:
-                logging.info("cypesq.NoUtterancesError: b'No utterances detected'")
-                count_error += 1
-    if batch * num_channel - count_error > 0:
-        pesq_batch = np.sum(pesq_batch) / (num_batch * num_channel - count_error)
-    else:
-        pesq_batch = 0
-    return pesq_batch
+    """Wideband PESQ, mean of the pairs with utterances, 0 if none, in the pool of the shared engine"""
+    return mean_pesq(get_pesq_engine(sr).score(reference, estimation, mode="wb"), mode="wb")
 
 
 def NB_PESQ(reference, estimation, sr=16000):
-    if not isinstance(reference, np.ndarray):
-        reference_numpy = reference.numpy()
-        estimation_numpy = estimation.numpy()
-    else:
-        reference_numpy = reference
-        estimation_numpy = estimation 
-    score = 0
-
-    for ref_batch, est_batch in zip(reference_numpy, estimation_numpy):
-        for ref_ch, est_ch in zip(ref_batch, est_batch):
-            # print(ref_ch.shape, est_ch.shape, type(ref_ch), type(est_ch))
-            # print(ref_ch, est_ch)
-            score += nb_pesq(sr, ref_ch, est_ch)
-    score /= (
-        reference.shape[0] * reference.shape[1]
-        if reference.shape[0] is not None
-        else reference.shape[1]
+    """Narrowband PESQ, mean of the pairs, in the pool of the shared engine"""
+    return mean_pesq(get_pesq_engine(sr).score(reference, estimation, mode="nb"), mode="nb")
+
+def spectrum_to_waveform(y, n_fft, hop_length, normalize):
+    """Inverse stft of model output for the speech metrics, [..., frame, freq] -> [..., samples]"""
+    # related with preprocess normalized fft
+    if normalize:
+        y *= 2 * (y.shape[-1] - 1)
+
+    window_fn = tf.signal.hamming_window
+
+    return tf.signal.inverse_stft(
+        y,
+        frame_length=n_fft,
+        frame_step=hop_length,
+        window_fn=tf.signal.inverse_stft_window_fn(
+            frame_step=hop_length, forward_window_fn=window_fn
+        ),
     )
-    score = np.squeeze(score)
-    return score
+
 
 class CustomMetric(tf.keras.metrics.Metric):
-    def __init__(self, metric, name="mse", **kwargs):
+    def __init__(self, metric, name="mse", stft=None, **kwargs):
+        """stft: dict of n_fft, hop_length, center and normalize if y is waveform"""
         super(CustomMetric, self).__init__(name=name, **kwargs)
         self.metric = metric
         self.metric_name = name
+        self.stft = stft
         self.score = self.add_weight(name=f"{name}_value", initializer="zeros")
         self.total = self.add_weight(name="total", initializer="zeros")
 
@@ -164,6 +179,9 @@ class CustomMetric(tf.keras.metrics.Metric):
         else:
             raise NotImplementedError(f"Loss '{self.metric}' is not implemented")
 
+        if self.stft is not None:
+            loss_function = waveform_loss(loss_function, **self.stft)
+
         self.score.assign_add(
             tf.py_function(
                 func=loss_function,
@@ -183,6 +201,7 @@ class CustomMetric(tf.keras.metrics.Metric):
             {
                 "metric": self.metric,
                 "metric_name": self.metric_name,
+                "stft": self.stft,
             }
         )
         return config
@@ -194,18 +213,23 @@ class CustomMetric(tf.keras.metrics.Metric):
 
 class SpeechMetric(tf.keras.metrics.Metric):
     """
-    [V] SI_SDR,     pass
+    [V] SI_SDR,     pass, in graph
+    [V] SNR,        pass, in graph
     [V] WB_PESQ,    pass
     [ ] STOI,       fail, np.matmul, (15, 257) @ (257, 74) -> OMP: Error #131: Thread identifier invalid, zsh: abort
     [ ] NB_PESQ     fail, ValueError: The truth value of an array with more than one element is ambiguous. Use a.any() or a.all()
-    [ ] SDR,        fail, MP: Error #131: Thread identifier invalid. zsh: abort      python train.py -> maybe batch related?
+    [V] SDR,        pass, in graph, 'sdr-v3' with the distortion filter
 
     [TODO] Verification, compared with pytorch
+
+    The numpy metrics are evaluated in processes by evaluation.AsyncSpeechEvaluation
     """
 
-    def __init__(self, model_name, n_fft, hop_length, normalize, name="sisdr", **kwargs):
+    def __init__(self, model_name, n_fft, hop_length, normalize, name="sisdr", waveform=False, **kwargs):
+        """waveform: y is waveform, model with stft in the model(frontend: model)"""
         super(SpeechMetric, self).__init__(name=name, **kwargs)
         self.model_name = model_name
+        self.waveform = waveform
         self.metric_name = name
         self.n_fft = n_fft
         self.hop_length = hop_length
@@ -214,58 +238,47 @@ class SpeechMetric(tf.keras.metrics.Metric):
         self.total = self.add_weight(name="total", initializer="zeros")
 
     def update_state(self, y_true, y_pred, sample_weight=None):
+        # in graph, the others are numpy through tf.py_function
+        func_metric_tensorflow = None
         if self.metric_name == "sisdr":
-            func_metric=SI_SDR
+            func_metric_tensorflow=SI_SDR_tensorflow
+        elif self.metric_name == "snr":
+            func_metric_tensorflow=SNR_tensorflow
         elif self.metric_name == 'wb-pesq':
             func_metric=WB_PESQ
         elif self.metric_name == 'stoi':
             func_metric=STOI
+        elif self.metric_name == 'estoi':
+            func_metric=ESTOI
         elif self.metric_name == 'nb-pesq':
             func_metric=NB_PESQ
         elif self.metric_name == 'sdr':
-            func_metric=SDR
+            func_metric_tensorflow=SDR_tensorflow
+        elif self.metric_name == 'sdr-v3':
+            func_metric_tensorflow=SDR_v3_tensorflow
         else:
             raise NotImplementedError(
                 f"Metric function '{self.metric}' is not implemented"
             )
 
-        if self.model_name not in ("unet", "conv-tasnet"):
-            # related with preprocess normalized fft
-            if self.normalize:
-                y_true *= 2 * (y_true.shape[-1] - 1)  
-                y_pred *= 2 * (y_pred.shape[-1] - 1)
-
-            window_fn = tf.signal.hamming_window
-
-            reference = tf.signal.inverse_stft(
-                y_true,
-                frame_length=self.n_fft,
-                frame_step=self.hop_length,
-                window_fn=tf.signal.inverse_stft_window_fn(
-                    frame_step=self.hop_length, forward_window_fn=window_fn
-                ),
-            )
-
-            estimation = tf.signal.inverse_stft(
-                y_pred,
-                frame_length=self.n_fft,
-                frame_step=self.hop_length,
-                window_fn=tf.signal.inverse_stft_window_fn(
-                    frame_step=self.hop_length, forward_window_fn=window_fn
-                ),
-            )
+        if self.model_name not in ("unet", "conv-tasnet") and not self.waveform:
+            reference = spectrum_to_waveform(y_true, self.n_fft, self.hop_length, self.normalize)
+            estimation = spectrum_to_waveform(y_pred, self.n_fft, self.hop_length, self.normalize)
         else:
             reference = y_true
             estimation = y_pred
 
-        self.score.assign_add(
-            tf.py_function(
-                func=func_metric,
-                inp=[reference, estimation],
-                Tout=tf.float32,
-                name=f"{self.metric_name}_metric",
-            )
-        )  # tf 2.x
+        if func_metric_tensorflow is not None:
+            self.score.assign_add(func_metric_tensorflow(reference, estimation))
+        else:
+            self.score.assign_add(
+                tf.py_function(
+                    func=func_metric,
+                    inp=[reference, estimation],
+                    Tout=tf.float32,
+                    name=f"{self.metric_name}_metric",
+                )
+            )  # tf 2.x
         self.total.assign_add(1)
 
     def result(self):
@@ -279,6 +292,7 @@ class SpeechMetric(tf.keras.metrics.Metric):
                 "n_fft": self.n_fft,
                 "hop_length": self.hop_length,
                 "normalize": self.normalize,
+                "waveform": self.waveform,
             }
         )
         return config
@@ -0,0 +1,194 @@
+"""
+Batched PESQ
+
+    pesq and pypesq score one pair at a time, and a whole test set in a python loop
+    takes far longer than the inference. PESQEngine scores every pair of [..., samples]
+    in a process pool, kept until close() so that the workers are reused across calls.
+
+    - wb: pesq(ITU-T P.862.2), nb: pypesq(P.862), the same as WB_PESQ and NB_PESQ
+    - a pair without utterances(cypesq.NoUtterancesError) is NaN
+    - scores are cached by hash of the audio, optionally saved in a json file
+    - get_pesq_engine: the engine shared in the process, used by WB_PESQ, NB_PESQ and
+      AsyncSpeechEvaluation, so its pool is started once
+"""
+import os
+import json
+import atexit
+import hashlib
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from pesq import pesq, cypesq
+from pypesq import pesq as nb_pesq
+
+from src.utils import SingleThreadSpawnContext
+
+
+def pesq_pair(reference, estimation, sr=16000, mode="wb"):
+    """PESQ of a pair of 1d audio, NaN if no utterances are detected"""
+    if mode == "wb":
+        try:
+            return float(pesq(sr, reference, estimation, mode="wb"))
+        except cypesq.NoUtterancesError:
+            return np.nan
+    elif mode == "nb":
+        return float(nb_pesq(sr, reference, estimation))
+    raise ValueError(f"PESQ mode '{mode}' should be 'wb' or 'nb'...")
+
+
+def pesq_batch(reference, estimation, sr=16000, mode="wb"):
+    """PESQ of each pair in the process, [..., samples] -> [...]"""
+    reference, estimation = np.asarray(reference), np.asarray(estimation)
+    scores = [
+        pesq_pair(ref, est, sr, mode)
+        for ref, est in zip(
+            reference.reshape(-1, reference.shape[-1]),
+            estimation.reshape(-1, estimation.shape[-1]),
+        )
+    ]
+    return np.array(scores).reshape(reference.shape[:-1])
+
+
+def mean_pesq(scores, mode="wb"):
+    """Mean of the scores, wb of the pairs with utterances(0 if none), nb of all the pairs"""
+    if mode == "wb":
+        if np.all(np.isnan(scores)):
+            return 0
+        return np.nanmean(scores)
+    return np.mean(scores)
+
+
+def _hash_audio(audio):
+    return hashlib.blake2b(
+        np.ascontiguousarray(audio).tobytes() + str(audio.dtype).encode(), digest_size=16
+    ).hexdigest()
+
+
+class PESQEngine:
+    """PESQ of batches in a process pool
+
+    Args:
+        sample_rate: 16000 or 8000(nb only)
+        num_workers: processes, default cpu count
+        chunksize: pairs sent to a worker at once, default pairs / (4 * num_workers)
+        cache: keep the scores by hash of the reference, estimation, sample rate and mode
+        cache_path: json file of the cache, loaded at start and saved by close()
+
+    Example:
+        with PESQEngine(16000, num_workers=8) as engine:
+            scores = engine.score(reference, estimation, mode="wb")  # [batch, channel]
+            print(np.nanmean(scores))
+    """
+
+    def __init__(self, sample_rate=16000, num_workers=None, chunksize=None, cache=True, cache_path=None):
+        self.sample_rate = sample_rate
+        self.num_workers = num_workers or os.cpu_count()
+        self.chunksize = chunksize
+        self.cache = {} if cache else None
+        self.cache_path = cache_path
+        self.pool = None
+
+        if self.cache is not None and cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, "r") as tmp:
+                self.cache = json.load(tmp)
+
+    def _get_pool(self):
+        if self.pool is None:
+            # spawn, fork after tensorflow is initialized can hang
+            self.pool = ProcessPoolExecutor(self.num_workers, mp_context=SingleThreadSpawnContext())
+        return self.pool
+
+    def score(self, reference, estimation, mode="wb"):
+        """PESQ of each pair
+
+        Args:
+            reference: numpy.ndarray or tf.Tensor, [..., samples]
+            estimation: numpy.ndarray or tf.Tensor, [..., samples]
+            mode: 'wb' or 'nb'
+
+        Returns:
+            numpy.ndarray, [...], NaN for pairs without utterances
+        """
+        reference, estimation = np.asarray(reference), np.asarray(estimation)
+        if reference.shape != estimation.shape:
+            raise ValueError(
+                f"Reference {reference.shape} and estimation {estimation.shape} should have the same shape..."
+            )
+        references = reference.reshape(-1, reference.shape[-1])
+        estimations = estimation.reshape(-1, estimation.shape[-1])
+
+        scores = np.full(len(references), np.nan)
+        keys = [None] * len(references)
+        missing = []
+        for i, (ref, est) in enumerate(zip(references, estimations)):
+            if self.cache is not None:
+                keys[i] = f"{_hash_audio(ref)}-{_hash_audio(est)}-{self.sample_rate}-{mode}"
+                if keys[i] in self.cache:
+                    # json saves NaN as null
+                    scores[i] = np.nan if self.cache[keys[i]] is None else self.cache[keys[i]]
+                    continue
+            missing.append(i)
+
+        if missing:
+            chunksize = self.chunksize or max(1, len(missing) // (4 * self.num_workers))
+            results = self._get_pool().map(
+                pesq_pair,
+                (references[i] for i in missing),
+                (estimations[i] for i in missing),
+                repeat(self.sample_rate),
+                repeat(mode),
+                chunksize=chunksize,
+            )
+            for i, result in zip(missing, results):
+                scores[i] = result
+                if self.cache is not None:
+                    self.cache[keys[i]] = None if np.isnan(result) else result
+
+        return scores.reshape(reference.shape[:-1])
+
+    def submit(self, reference, estimation, mode="wb"):
+        """PESQ of each pair in a worker without waiting, not cached
+
+        Returns:
+            concurrent.futures.Future of numpy.ndarray, [...]
+        """
+        return self._get_pool().submit(
+            pesq_batch, np.asarray(reference), np.asarray(estimation), self.sample_rate, mode
+        )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.cache is not None and self.cache_path is not None:
+            with open(f"{self.cache_path}.tmp", "w") as tmp:
+                json.dump(self.cache, tmp)
+            os.replace(f"{self.cache_path}.tmp", self.cache_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_engines = {}
+
+
+def _close_engines():
+    for engine in _engines.values():
+        engine.close()
+
+
+def get_pesq_engine(sample_rate=16000, num_workers=None):
+    """The engine of sample_rate shared in the process, closed at exit
+
+    The scores are not cached, the metrics of training see new audio every call.
+    num_workers is used when the engine is created first.
+    """
+    if sample_rate not in _engines:
+        if not _engines:
+            atexit.register(_close_engines)
+        _engines[sample_rate] = PESQEngine(sample_rate, num_workers=num_workers, cache=False)
+    return _engines[sample_rate]
@@ -20,9 +20,8 @@ from keras import Model
 import keras.regularizers
 import keras.optimizers
 
-import os
 import numpy as np
-from src.utils import load_json
+from src.utils import load_optimizer_state, get_frontend, get_num_frames
 
 from .metrics import (
     CustomMetric,
@@ -34,6 +33,7 @@ from .loss import (
     ideal_amplitude_mask,
     phase_sensitive_spectral_approximation_loss,
     phase_sensitive_spectral_approximation_loss_bose,
+    waveform_loss,
 )
 
 from .time_frequency import(
@@ -41,12 +41,19 @@ from .time_frequency import(
     MelSpec,
     InverseMelSpec,
     ExponentialMovingAverage,
+    build_waveform_model,
 )
 
 
-def build_model_rnn(args):
+def build_model_rnn(args, streaming=False):
+    """
+        streaming: stateful recurrent layers and ExponentialMovingAverage for a batch of 1,
+                   any number of frames in a call continues the previous call until reset_states(),
+                   spectrum in and out whatever the frontend, see src/streaming.py
+    """
     inputs = Input(
-        shape=[1, int(args.dset.segment*args.dset.sample_rate//args.dset.hop_length + 1), args.model.n_feature],
+        shape=[1, None if streaming else get_num_frames(args), args.model.n_feature],
+        batch_size=1 if streaming else None,
         name="input", 
         dtype=tf.complex64,
     )
@@ -71,19 +78,19 @@ def build_model_rnn(args):
     # Power law compress 0.3
     
     if args.model.name == 'rnn':
-        mask = SimpleRNN(args.model.lstm_layer, activation="tanh", return_sequences=True)(mask)
-        mask = SimpleRNN(args.model.lstm_layer, activation="tanh", return_sequences=True)(mask)
+        mask = SimpleRNN(args.model.lstm_layer, activation="tanh", return_sequences=True, stateful=streaming)(mask)
+        mask = SimpleRNN(args.model.lstm_layer, activation="tanh", return_sequences=True, stateful=streaming)(mask)
     if args.model.name == 'lstm':
-        mask = LSTM(args.model.lstm_layer, activation="tanh", return_sequences=True)(mask)
-        mask = LSTM(args.model.lstm_layer, activation="tanh", return_sequences=True)(mask)
+        mask = LSTM(args.model.lstm_layer, activation="tanh", return_sequences=True, stateful=streaming)(mask)
+        mask = LSTM(args.model.lstm_layer, activation="tanh", return_sequences=True, stateful=streaming)(mask)
     if args.model.name == 'gru':
-        mask = GRU(args.model.lstm_layer, activation="tanh", return_sequences=True)(mask)
-        mask = GRU(args.model.lstm_layer, activation="tanh", return_sequences=True)(mask)
+        mask = GRU(args.model.lstm_layer, activation="tanh", return_sequences=True, stateful=streaming)(mask)
+        mask = GRU(args.model.lstm_layer, activation="tanh", return_sequences=True, stateful=streaming)(mask)
     
     mask = BatchNormalization()(mask)
     
     if args.model.ema:
-        contextEMA = ExponentialMovingAverage(alpha=0.1)(contextEMA)
+        contextEMA = ExponentialMovingAverage(alpha=0.1, stateful=streaming)(contextEMA)
         mask = tf.concat([mask, contextEMA], axis=-1)
     
     mask = Dense(
@@ -108,7 +115,7 @@ def build_model_rnn(args):
     # print(mask.shape, mask.dtype)
     mask = InverseMelSpec(args)(mask)
     if args.model.ema:
-        mask = ExponentialMovingAverage(alpha=0.85)(mask)
+        mask = ExponentialMovingAverage(alpha=0.85, stateful=streaming)(mask)
     
     # print(mask.shape, mask.dtype)
 
@@ -123,6 +130,9 @@ def build_model_rnn(args):
     # print(outputs.shape, outputs.dtype)
 
     model = Model(inputs=inputs, outputs=outputs)
+
+    if get_frontend(args) == "model" and not streaming:
+        model = build_waveform_model(model, args)
     return model
 
 
@@ -153,55 +163,20 @@ def compile_model(model: Model, args):
     else:
         raise NotImplementedError(f"Loss '{self.metric}' is not implemented")
 
-    if args.model.path is not None and args.optim.load:
-        if "optimizer" in os.listdir(args.model.path):  # optimizer folder check
-            tf.print("Optimizer Loading...")
-            dummpy_model = build_model_rnn(args)
-            optimizer_state = load_json(
-                os.path.join(args.model.path, "optimizer/optim.json")
-            )["optimizer"]
-            dummy_batch_size = 1
-            dummy_tensor = tf.ones(
-                shape=(
-                    dummy_batch_size,
-                    1,
-                    int(args.dset.segment*args.dset.sample_rate//args.dset.hop_length + 1),
-                    args.model.n_feature,
-                ),
-                dtype=tf.complex64,
-            )
-            dummy_clean_tensor = tf.ones(
-                shape=(
-                    dummy_batch_size,
-                    1,
-                    int(args.dset.segment*args.dset.sample_rate//args.dset.hop_length + 1),
-                    args.model.n_feature,
-                ), 
-                dtype=tf.complex64,
-            )
-
-            dummpy_model.compile(
-                optimizer=optimizer,
-                loss=loss_function,
-            )
-            dummpy_model.fit(
-                x=dummy_tensor, y=dummy_clean_tensor, batch_size=dummy_batch_size
-            )
-            
-            del (
-                dummpy_model,
-                dummy_tensor,
-                dummy_clean_tensor,
-            )  # [TODO] How to remove object and check it removed?
-            
-            # Currently, when using saved optimizer, the next optimizer loading has almost double size
-            # The reason to load dummy model is when optimizer didn't compile, then it didn't have the optimizer weight
-            # Ex. the case fo LSTM model: 25 -> 49, so it temporaily saved half of len
-            # This tested in test_model and optimizer/model weight is same between saving and loading
-            # [TODO] How to load optimizer weights? 
-            len_optimizer = len(optimizer.get_weights()) 
-            optimizer.set_weights(optimizer_state[:len_optimizer])
+    # frontend: model, the loss is on the stft of output waveform
+    stft = None
+    if get_frontend(args) == "model":
+        stft = dict(
+            n_fft=args.dset.n_fft,
+            hop_length=args.dset.hop_length,
+            center=args.dset.center,
+            normalize=args.model.fft_normalization,
+        )
+        loss_function = waveform_loss(loss_function, **stft)
 
+    if args.model.path is not None and args.optim.load:
+        tf.print("Optimizer Loading...")
+        if load_optimizer_state(args.model.path, model, optimizer):
             tf.print("Optimizer was loaded!")
         else:
             tf.print("Optimizer was not existed!")
@@ -213,9 +188,10 @@ def compile_model(model: Model, args):
             hop_length=args.dset.hop_length,
             normalize=args.model.fft_normalization,
             name=metric_name,
+            waveform=stft is not None,
         )
         for metric_name in args.model.metric
     ]
-    metrics.append(CustomMetric(metric=args.optim.loss, name=args.optim.loss))
+    metrics.append(CustomMetric(metric=args.optim.loss, name=args.optim.loss, stft=stft))
 
     model.compile(optimizer=optimizer, loss=loss_function, metrics=metrics)
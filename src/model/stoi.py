@@ -0,0 +1,292 @@
+"""
+Batched STOI/ESTOI
+
+    The same algorithm as pystoi, on [..., samples] at once instead of a pair at a time,
+
+    1. resample to 10 kHz, the filter of pystoi on the spectrum of one rfft of the batch
+    2. silent frames of the reference(40 dB under the loudest frame) are dropped,
+       kept frames are moved to the front of each item and overlap-added
+    3. stft of all frames, one-third octave bands by the band matrix(cached)
+    4. correlation of every 30 frames segment, masked by the valid segments of each item
+
+    Frames are 256 samples with hop 128, so every frame is two halves of the
+    signal reshaped to [..., chunks, 128], without copying overlapped frames.
+    Reference and estimation are stacked and stay float32 until the bands, one resample
+    and one stft for both. On one cpu core a batch of 16 x 1.024 sec is 2-3.5x faster
+    than pystoi pair by pair, see MetricSanityCheck.test_stoi_benchmark. The ffts alone
+    (rfft and irfft of the resample, rfft of the frames) take a third of the time of
+    stoi_batch, the resample has to be exact to 1e-6 since a frame near the 40 dB
+    threshold flips with a small error.
+
+    Reference
+    ---------
+    - https://github.com/mpariente/pystoi
+    - C.H.Taal, R.C.Hendriks, R.Heusdens, J.Jensen, An Algorithm for Intelligibility Prediction
+    of Time-Frequency Weighted Noisy Speech, IEEE TASLP, 2011.
+    - J. Jensen and C. H. Taal, An Algorithm for Predicting the Intelligibility of Speech Masked
+    by Modulated Noise Maskers, IEEE TASLP, 2016.
+"""
+import math
+import functools
+import warnings
+import numpy as np
+import scipy.fft
+from scipy.signal import resample_poly
+
+FS = 10000  # sampling frequency
+N_FRAME = 256  # window support
+NFFT = 512  # fft size
+NUMBAND = 15  # number of one-third octave bands
+MINFREQ = 150  # center frequency of the first band(Hz)
+N = 30  # frames for intermediate intelligibility
+BETA = -15.0  # lower SDR bound
+DYN_RANGE = 40  # speech dynamic range
+EPS = np.finfo("float").eps
+
+
+@functools.lru_cache(maxsize=None)
+def _resample_window(p, q):
+    """Kaiser windowed sinc of octave resample, the same as pystoi"""
+    gcd = math.gcd(p, q)
+    p, q = p // gcd, q // gcd
+
+    log10_rejection = -3.0
+    stopband_cutoff_f = 1.0 / (2 * max(p, q))
+    roll_off_width = stopband_cutoff_f / 10
+
+    rejection_db = -20 * log10_rejection
+    length = np.ceil((rejection_db - 8) / (28.714 * roll_off_width))
+
+    t = np.arange(-length, length + 1)
+    ideal_filter = 2 * p * stopband_cutoff_f * np.sinc(2 * stopband_cutoff_f * t)
+
+    if 21 <= rejection_db <= 50:
+        beta = 0.5842 * (rejection_db - 21) ** 0.4 + 0.07886 * (rejection_db - 21)
+    elif rejection_db > 50:
+        beta = 0.1102 * (rejection_db - 8.7)
+    else:
+        beta = 0.0
+
+    h = np.kaiser(2 * length + 1, beta) * ideal_filter
+    return h / np.sum(h)
+
+
+@functools.lru_cache(maxsize=None)
+def _resample_spectrum(length, sr, target=FS):
+    """Filter of scipy.signal.resample_poly on the spectrum of x, for the spectrum of the output
+
+    Upsampling by up repeats the spectrum of x, the filter multiplies it, and downsampling
+    by down adds down copies of it shifted by the output length. Copy j starts at the bin
+    shift * j of the spectrum of x, so every copy is a slice of the periodic spectrum.
+
+    Returns:
+        fft length of x(a multiple of down, longer than the filter wraps), fft length of
+        the output, bins of the output, shift and [down, bins] weights of the copies
+    """
+    gcd = math.gcd(target, sr)
+    up, down = target // gcd, sr // gcd
+    # gain of upsampling as scipy.signal.resample_poly
+    h = _resample_window(target, sr) * up
+    half = (len(h) - 1) // 2
+
+    n_x = down * scipy.fft.next_fast_len(-(-(length + len(h) // up + 1) // down), real=True)
+    n_y = n_x * up // down
+    # centered, resample_poly compensates the delay of the filter
+    h_centered = np.zeros(n_x * up)
+    h_centered[: len(h) - half] = h[half:]
+    h_centered[len(h_centered) - half :] = h[:half]
+    spectrum = scipy.fft.fft(h_centered) / down
+
+    bins = n_y // 2 + 1
+    shift = n_x // down
+    weights = np.zeros((down, bins), dtype=np.complex64)
+    for j in range(down):
+        weights[j * n_y % n_x // shift] = spectrum[j * n_y : j * n_y + bins]
+    return n_x, n_y, bins, shift, weights
+
+
+def resample(x, sr, target=FS):
+    """The same as pystoi resample_oct(scipy.signal.resample_poly), [batch, samples]
+
+    One rfft of the whole batch, the filter on the spectrum and one irfft, float32 stays float32.
+    """
+    gcd = math.gcd(target, sr)
+    up, down = target // gcd, sr // gcd
+    if up == down:
+        return x
+    if up * down > 256:
+        # 44.1 kHz has 441 x 100 phases, the filter in time is faster
+        return resample_poly(x, target, sr, axis=-1, window=_resample_window(target, sr)).astype(x.dtype)
+    length = x.shape[-1]
+    n_x, n_y, bins, shift, weights = _resample_spectrum(length, sr, target)
+
+    # the periodic spectrum of x from the rfft, [batch, shift * (down - 1) + bins]
+    half = scipy.fft.rfft(x, n=n_x, axis=-1)
+    spectrum = np.empty((len(x), shift * (down - 1) + bins), dtype=half.dtype)
+    spectrum[:, : n_x // 2 + 1] = half
+    spectrum[:, n_x // 2 + 1 : n_x] = np.conj(half[:, (n_x - 1) // 2 : 0 : -1])
+    for start in range(n_x, spectrum.shape[-1], n_x):
+        spectrum[:, start : start + n_x] = spectrum[:, : min(n_x, spectrum.shape[-1] - start)]
+
+    output = spectrum[:, :bins] * weights[0]
+    product = np.empty_like(output)
+    for i in range(1, down):
+        np.multiply(spectrum[:, i * shift : i * shift + bins], weights[i], out=product)
+        output += product
+    return scipy.fft.irfft(output, n=n_y, axis=-1)[:, : -(-length * up // down)]
+
+
+@functools.lru_cache(maxsize=None)
+def third_octave_bands(fs=FS, nfft=NFFT, num_bands=NUMBAND, min_freq=MINFREQ):
+    """One-third octave band matrix, [num_bands, nfft // 2 + 1]"""
+    f = np.linspace(0, fs, nfft + 1)[: nfft // 2 + 1]
+    k = np.arange(num_bands, dtype=float)
+    freq_low = min_freq * np.power(2.0, (2 * k - 1) / 6)
+    freq_high = min_freq * np.power(2.0, (2 * k + 1) / 6)
+
+    obm = np.zeros((num_bands, len(f)))
+    for i in range(num_bands):
+        low = np.argmin(np.square(f - freq_low[i]))
+        high = np.argmin(np.square(f - freq_high[i]))
+        obm[i, low:high] = 1
+    return obm
+
+
+@functools.lru_cache(maxsize=None)
+def _interleaved_bands():
+    """Band matrix for the float32 view of the rfft, [2 * (NFFT // 2 + 1), band]"""
+    return np.repeat(third_octave_bands(), 2, axis=1).T.astype(np.float32)
+
+
+def _remove_silent_frames(xy, batch):
+    """Windowed stft frames after removing silent frames of x, zero padded to NFFT
+
+    Args:
+        xy: x and y stacked, [2 * batch, samples]
+
+    Returns:
+        frames: [2 * batch, frames, NFFT]
+        num_frames: [batch], valid frames of each item
+    """
+    hop = N_FRAME // 2
+    window = np.hanning(N_FRAME + 2)[1:-1].astype(xy.dtype)
+    head, tail = window[:hop], window[hop:]
+
+    # frames of pystoi, range(0, len(x) - N_FRAME, hop), every frame is two chunks of hop
+    num_frames = len(range(0, xy.shape[-1] - N_FRAME, hop))
+    chunks = xy[:, : (num_frames + 1) * hop].reshape(len(xy), num_frames + 1, hop)
+
+    power = np.square(chunks[:batch])
+    energies = 20 * np.log10(np.sqrt(power[:, :-1] @ np.square(head) + power[:, 1:] @ np.square(tail)) + EPS)
+    mask = (np.max(energies, axis=-1, keepdims=True) - DYN_RANGE - energies) < 0
+    num_kept = np.sum(mask, axis=-1)
+
+    # kept frames to the front in order, the rest point to a zero chunk at the end
+    order = np.argsort(~mask, axis=-1, kind="stable")
+    order = np.where(np.arange(num_frames) < num_kept[:, np.newaxis], order, num_frames + 1)
+    # rows of the chunks of both halves flattened, a gather of whole rows is a copy
+    chunks = np.pad(chunks, ((0, 0), (0, 1), (0, 0))).reshape(-1, hop)
+    rows = (num_frames + 2) * np.arange(len(xy))[:, np.newaxis]
+    order = np.tile(order, (2, 1))
+
+    # chunk j of the signal after removal, head of kept frame j + tail of kept frame j - 1
+    heads = np.take(chunks, order + rows, axis=0) * head
+    tails = np.take(chunks, np.minimum(order + 1, num_frames + 1) + rows, axis=0) * tail
+    heads[:, 1:] += tails[:, :-1]
+
+    # stft frame i is chunks i, i + 1 of the signal, k kept frames have k - 1 stft frames
+    frames = np.zeros((len(xy), num_frames - 1, NFFT), dtype=xy.dtype)
+    frames[..., :hop] = heads[:, :-1] * head
+    frames[..., hop:N_FRAME] = heads[:, 1:] * tail
+    return frames, np.maximum(num_kept - 1, 0)
+
+
+def _window_sum(frames):
+    """Sum of every N frames, [batch, frames, band] -> [batch, frames - N + 1, band]"""
+    total = np.pad(np.cumsum(frames, axis=1), ((0, 0), (1, 0), (0, 0)))
+    return total[:, N:] - total[:, :-N]
+
+
+def _centered_norm(total, total_square, n):
+    """Norm of a vector minus its mean, from the sum and the sum of squares"""
+    return np.sqrt(np.maximum(total_square - np.square(total) / n, 0))
+
+
+def stoi_batch(reference, estimation, sr=16000, extended=False):
+    """STOI of each pair
+
+    Args:
+        reference: numpy.ndarray, [..., samples]
+        estimation: numpy.ndarray, [..., samples]
+        sr: sample rate
+        extended: ESTOI
+
+    Returns:
+        numpy.ndarray, [...], 1e-5 for pairs with less than 30 frames after removing silence
+    """
+    reference, estimation = np.asarray(reference), np.asarray(estimation)
+    if reference.shape != estimation.shape:
+        raise ValueError(
+            f"Reference {reference.shape} and estimation {estimation.shape} should have the same shape..."
+        )
+    shape = reference.shape[:-1]
+    batch = int(np.prod(shape))
+    # float32 until the bands, x and y stacked for one resample and one stft
+    xy = np.concatenate([reference, estimation]).reshape(2 * batch, -1).astype(np.float32)
+    if sr != FS:
+        xy = resample(xy, sr)
+
+    frames, num_frames = _remove_silent_frames(xy, batch)
+    # real and imaginary parts interleaved, the power of a band is the sum of their squares
+    spectrum = scipy.fft.rfft(frames, axis=-1, overwrite_x=True).view(np.float32)
+    np.square(spectrum, out=spectrum)
+    # [batch, frames, band], the correlations of the bands in float64
+    tob = np.sqrt(spectrum @ _interleaved_bands())
+    x_tob, y_tob = np.split(tob.astype(np.float64), 2)
+
+    if x_tob.shape[1] < N:
+        x_tob = np.pad(x_tob, ((0, 0), (0, N - x_tob.shape[1]), (0, 0)))
+        y_tob = np.pad(y_tob, ((0, 0), (0, N - y_tob.shape[1]), (0, 0)))
+    num_segments = np.maximum(num_frames - N + 1, 0)
+    valid = np.arange(x_tob.shape[1] - N + 1) < num_segments[:, np.newaxis]
+
+    # [batch, segments, band, N] views, sums over N by cumulative sums of frames
+    x_segments = np.lib.stride_tricks.sliding_window_view(x_tob, N, axis=1)
+    y_segments = np.lib.stride_tricks.sliding_window_view(y_tob, N, axis=1)
+    x_sum, x_square = _window_sum(x_tob), _window_sum(np.square(x_tob))
+    y_sum, y_square = _window_sum(y_tob), _window_sum(np.square(y_tob))
+
+    if extended:
+        # rows(frames of a band) normalized, then columns(bands of a frame)
+        x_n = (x_segments - (x_sum / N)[..., np.newaxis]) / (_centered_norm(x_sum, x_square, N) + EPS)[..., np.newaxis]
+        y_n = (y_segments - (y_sum / N)[..., np.newaxis]) / (_centered_norm(y_sum, y_square, N) + EPS)[..., np.newaxis]
+        x_band, y_band = np.sum(x_n, axis=-2), np.sum(y_n, axis=-2)
+        covariance = np.einsum("bjkn,bjkn->bjn", x_n, y_n) - x_band * y_band / NUMBAND
+        x_norm = _centered_norm(x_band, np.einsum("bjkn,bjkn->bjn", x_n, x_n), NUMBAND)
+        y_norm = _centered_norm(y_band, np.einsum("bjkn,bjkn->bjn", y_n, y_n), NUMBAND)
+        correlations = np.sum(covariance / ((x_norm + EPS) * (y_norm + EPS)), axis=-1) / N
+    else:
+        # y scaled to the energy of x, clipped to lower SDR bound
+        normalization = np.sqrt(x_square) / (np.sqrt(y_square) + EPS)
+        clip_value = 10 ** (-BETA / 20)
+        x_clip = np.lib.stride_tricks.sliding_window_view(x_tob * (1 + clip_value), N, axis=1)
+        y_primes = y_segments * normalization[..., np.newaxis]
+        np.minimum(y_primes, x_clip, out=y_primes)
+        y_primes -= np.mean(y_primes, axis=-1, keepdims=True)
+        # sum of centered y' is 0, x doesn't need to be centered for the covariance
+        covariance = np.einsum("bjkn,bjkn->bjk", y_primes, x_segments)
+        y_norm = np.sqrt(np.einsum("bjkn,bjkn->bjk", y_primes, y_primes))
+        x_norm = _centered_norm(x_sum, x_square, N)
+        correlations = np.sum(covariance / ((y_norm + EPS) * (x_norm + EPS)), axis=-1) / NUMBAND
+
+    scores = np.sum(correlations * valid, axis=-1) / np.maximum(num_segments, 1)
+
+    short = num_segments == 0
+    if np.any(short):
+        warnings.warn(
+            f"{np.sum(short)} pairs have less than {N} frames after removing silent frames, "
+            "STOI of them is 1e-5",
+            RuntimeWarning,
+        )
+        scores[short] = 1e-5
+    return scores.reshape(shape)
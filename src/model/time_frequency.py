@@ -2,44 +2,95 @@ import numpy as np
 import tensorflow as tf
 from keras.backend import epsilon
 import keras.layers
+from src.utils import stft_tensorflow
 
 class ExponentialMovingAverage(keras.layers.Layer):
     """
-        [B, T, ..., C]
-        outputs_{t} = (1-alpha) * outputs_{t-1} + alpha * inputs_{t}
+        [B, T, C]
+        outputs_{t} = (1-alpha) * outputs_{t-1} + alpha * inputs_{t}, outputs_{-1} = state
+
+        In closed form, outputs_{t} = (1-alpha)^(t+1) * state + sum_{k<=t} alpha * (1-alpha)^(t-k) * inputs_{k}.
+        Frames are split into chunks of chunk_size, each chunk is one matmul of the lower triangular
+        decay kernel [chunk, chunk] from a zero state, and the last output of a chunk is carried to
+        the next one(tf.scan over chunks), so the memory is linear in frames and frames can be None.
+
+        stateful: the last output is kept for the next call(streaming), the batch size should be fixed
+        as stateful LSTM, and reset_states() clears it. Otherwise the state is zero for every call.
     """
     def __init__(
         self,
         alpha,
+        stateful=False,
+        chunk_size=128,
         **kwargs,
     ):
         super().__init__(**kwargs)
         self.alpha = alpha
-        self.ema_parameter = [tf.constant(alpha, dtype=tf.float32), 
-                            tf.constant(1-alpha, dtype=tf.float32)]
+        self.stateful = stateful
+        self.chunk_size = chunk_size
+        self.state = None
+
+    def build(self, input_shape):
+        if self.stateful:
+            if input_shape[0] is None:
+                raise ValueError("Stateful ExponentialMovingAverage needs a fixed batch size...")
+            self.state = self.add_weight(
+                name="state",
+                shape=(input_shape[0], input_shape[-1]),
+                initializer="zeros",
+                trainable=False,
+            )
+        super().build(input_shape)
+
     def call(self, inputs, training=True):
         assert len(inputs.shape)==3
-        _, time, _ = inputs.shape
-        outputs = []
-        
-        delay_buffer = None
-        for curr_time in range(time):
-            if curr_time == 0:
-                outputs.append(self.ema_parameter[0] * inputs[:, curr_time, ...])
-                delay_buffer = self.ema_parameter[0] * inputs[:, curr_time, ...]
-            elif curr_time == time-1:
-                outputs.append(self.ema_parameter[1]*delay_buffer + self.ema_parameter[0]*inputs[:, curr_time, ...])
-            else:
-                outputs.append(self.ema_parameter[1]*delay_buffer + self.ema_parameter[0]*inputs[:, curr_time, ...])
-                delay_buffer = self.ema_parameter[1]*delay_buffer + self.ema_parameter[0]*inputs[:, curr_time, ...]
-        outputs = tf.stack(outputs, axis=1)
+        batch_size, frames, channels = tf.shape(inputs)[0], tf.shape(inputs)[1], tf.shape(inputs)[2]
+        chunk = tf.maximum(tf.minimum(frames, self.chunk_size), 1)  # streaming calls of a few frames
+        num_chunks = (frames + chunk - 1) // chunk
+
+        index = tf.range(chunk)
+        exponent = index[:, tf.newaxis] - index[tf.newaxis, :]  # t - k
+        decay = tf.constant(1 - self.alpha, dtype=inputs.dtype)
+        kernel = tf.where(
+            exponent >= 0,
+            self.alpha * tf.pow(decay, tf.cast(tf.maximum(exponent, 0), inputs.dtype)),
+            tf.zeros([], dtype=inputs.dtype),
+        )
+        state_decay = tf.pow(decay, tf.cast(index + 1, inputs.dtype))[:, tf.newaxis]
+
+        # [chunks, B, chunk, C], zeros after the last frame
+        chunks = tf.pad(inputs, [[0, 0], [0, num_chunks * chunk - frames], [0, 0]])
+        chunks = tf.transpose(tf.reshape(chunks, [batch_size, num_chunks, chunk, channels]), [1, 0, 2, 3])
+        chunks = tf.matmul(kernel, chunks)  # [chunk, chunk] @ [chunks, B, chunk, C], from zero state
+
+        if self.stateful:
+            state = tf.cast(self.state, inputs.dtype)
+        else:
+            state = tf.zeros([batch_size, channels], dtype=inputs.dtype)
+        outputs = tf.scan(
+            lambda previous, chunk_outputs: chunk_outputs + state_decay * previous[:, -1:, :],
+            chunks,
+            initializer=tf.tile(state[:, tf.newaxis, :], [1, chunk, 1]),
+        )
+        outputs = tf.reshape(tf.transpose(outputs, [1, 0, 2, 3]), [batch_size, num_chunks * chunk, channels])
+        outputs = outputs[:, :frames]
+        outputs.set_shape(inputs.shape)
+
+        if self.stateful:
+            self.state.assign(outputs[:, -1, :])
         return outputs
 
+    def reset_states(self):
+        if self.state is not None:
+            self.state.assign(tf.zeros_like(self.state))
+
     def get_config(self):
         config = super(ExponentialMovingAverage, self).get_config()
         config.update(
             { 
                 "alpha": self.alpha,
+                "stateful": self.stateful,
+                "chunk_size": self.chunk_size,
             }
         )
         return config
@@ -198,4 +249,116 @@ class CombineAmplitudePhase(keras.layers.Layer):
         amplitude = tf.cast(inputs[0], dtype=tf.complex64) + epsilon()
         angle = tf.complex(tf.zeros_like(inputs[1]), inputs[1])
         outputs = tf.multiply(amplitude, tf.exp(angle))
-        return outputs
\ No newline at end of file
+        return outputs
+
+
+class STFT(keras.layers.Layer):
+    """
+        [..., samples] -> complex [..., frame, frequency]
+        same as stft_tensorflow in the input pipeline
+    """
+    def __init__(
+        self,
+        n_fft,
+        hop_length,
+        center=True,
+        normalize=True,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.center = center
+        self.normalize = normalize
+
+    def call(self, inputs, training=True):
+        return stft_tensorflow(
+            inputs, self.n_fft, self.hop_length, center=self.center, normalize=self.normalize
+        )
+
+    def get_config(self):
+        config = super(STFT, self).get_config()
+        config.update(
+            {
+                "n_fft": self.n_fft,
+                "hop_length": self.hop_length,
+                "center": self.center,
+                "normalize": self.normalize,
+            }
+        )
+        return config
+
+
+class InverseSTFT(keras.layers.Layer):
+    """
+        complex [..., frame, frequency] -> [..., samples]
+        inverse of STFT, length is the number of samples of the input of STFT
+    """
+    def __init__(
+        self,
+        n_fft,
+        hop_length,
+        length,
+        center=True,
+        normalize=True,
+        **kwargs,
+    ):
+        kwargs.setdefault("autocast", False)  # keep complex inputs
+        super().__init__(**kwargs)
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.length = length
+        self.center = center
+        self.normalize = normalize
+
+    def call(self, inputs, training=True):
+        if self.normalize:
+            inputs = inputs * self.n_fft
+        outputs = tf.signal.inverse_stft(
+            inputs,
+            frame_length=self.n_fft,
+            frame_step=self.hop_length,
+            window_fn=tf.signal.inverse_stft_window_fn(
+                frame_step=self.hop_length, forward_window_fn=tf.signal.hann_window
+            ),
+        )
+        start = self.n_fft // 2 if self.center else 0
+        return outputs[..., start : start + self.length]
+
+    def get_config(self):
+        config = super(InverseSTFT, self).get_config()
+        config.update(
+            {
+                "n_fft": self.n_fft,
+                "hop_length": self.hop_length,
+                "length": self.length,
+                "center": self.center,
+                "normalize": self.normalize,
+            }
+        )
+        return config
+
+
+def build_waveform_model(model, args):
+    """
+        STFT -> model -> InverseSTFT, for frontend: model
+        Input: [batch size, channels=1, samples]
+        Output: [batch size, channels=1, samples]
+    """
+    length = int(args.dset.segment*args.dset.sample_rate)
+    inputs = keras.layers.Input(shape=[1, length], name="input_wav", dtype=tf.float32)
+    spectrogram = STFT(
+        n_fft=args.dset.n_fft,
+        hop_length=args.dset.hop_length,
+        center=args.dset.center,
+        normalize=args.model.fft_normalization,
+    )(inputs)
+    spectrogram = model(spectrogram)
+    outputs = InverseSTFT(
+        n_fft=args.dset.n_fft,
+        hop_length=args.dset.hop_length,
+        length=length,
+        center=args.dset.center,
+        normalize=args.model.fft_normalization,
+    )(spectrogram)
+    return keras.Model(inputs=inputs, outputs=outputs, name=f"{model.name}_waveform")
@@ -7,24 +7,29 @@
 """
 import os
 import tqdm
+import queue
+import threading
+import itertools
+import multiprocessing
 import librosa
 import numpy as np
-import tensorflow as tf
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from .feature_extractor import FeatureExtractor
+from .record_writer import ShardedRecordWriter
+from .manifest import PreprocessManifest, get_params, record_name
 from src.utils import (
-    get_tf_feature_real_imag_pair,
-    get_tf_feature_mag_phase_pair,
-    get_tf_feature_sample_pair,
+    get_tf_feature_dict,
+    get_feature_plan,
     read_audio,
+    AudioCache,
     segment_audio,
     encode_normalize,
 )
 
 # import logging
 # import math
-# import multiprocessing
 # from sklearn.preprocessing import StandardScaler
 
 
@@ -35,6 +40,8 @@ class DatasetVoiceBank:
         self.model_name = name
         self.args = args
         self.debug = debug
+        self.cache = AudioCache.from_args(args)
+        self.features = get_feature_plan(args)
 
     def _sample_noisy_filename(self):
         return np.random.choice(self.noisy_filenames)
@@ -68,14 +75,15 @@ class DatasetVoiceBank:
             clean_filename.split("/")[-1] == noisy_filename.split("/")[-1]
         ), "filename must match."
 
-        name = (
-            clean_filename.split("/")[-1].split(".")[0]
-            + "_"
-            + clean_filename.split("/")[-1].split(".")[1]
-        )
+        name = record_name(clean_filename)
 
-        clean_audio, sr = read_audio(clean_filename, self.args.sample_rate)
-        noisy_audio, sr = read_audio(noisy_filename, self.args.sample_rate)
+        resample_method = getattr(self.args, "resample", None) or "resampy"
+        clean_audio, sr = read_audio(
+            clean_filename, self.args.sample_rate, self.cache, resample_method
+        )
+        noisy_audio, sr = read_audio(
+            noisy_filename, self.args.sample_rate, self.cache, resample_method
+        )
 
         if not self.args.segment_normalization:
             clean_audio = encode_normalize(clean_audio, self.args.normalize)
@@ -85,81 +93,149 @@ class DatasetVoiceBank:
         #     noisy_index, noisy_audio = self._remove_silent_frames(noisy_audio, None, noisy_filename)
         #     noisy_index, clean_audio = self._remove_silent_frames(clean_audio, noisy_index, clean_filename)
 
-        # sample random fixed-sized snippets of audio
-        clean_audio = segment_audio(
-            clean_audio, self.args.sample_rate, self.args.segment
-        )
-        noisy_audio = segment_audio(
-            noisy_audio, self.args.sample_rate, self.args.segment
-        )
+        if getattr(self.args, "full_utterance", False):
+            # the whole utterance as one segment, nothing is cut or padded
+            clean_audio = clean_audio[np.newaxis, ...]
+            noisy_audio = noisy_audio[np.newaxis, ...]
+        else:
+            # sample random fixed-sized snippets of audio
+            segment_hop = getattr(self.args, "segment_hop", None)
+            segment_pad = getattr(self.args, "segment_pad", None) or "drop"
+            clean_audio = segment_audio(
+                clean_audio, self.args.sample_rate, self.args.segment, segment_hop, segment_pad
+            )
+            noisy_audio = segment_audio(
+                noisy_audio, self.args.sample_rate, self.args.segment, segment_hop, segment_pad
+            )
 
         if self.args.segment_normalization:
             clean_audio = encode_normalize(clean_audio, self.args.normalize)
             noisy_audio = encode_normalize(noisy_audio, self.args.normalize)
 
-        if self.args.fft:
-            # extract stft features from noisy audio
+        # compute only the features in the plan, key -> [segment, ...]
+        data = {}
+        if "pcm" in self.features:
+            data["noisy"], data["clean"] = noisy_audio, clean_audio
+
+        if "real_imag" in self.features or "mag_phase" in self.features:
+            # extract stft features, segment, frame, frequency
             noisy_input_fe = FeatureExtractor(
                 noisy_audio,
                 windowLength=self.args.win_length,
                 hop_length=self.args.hop_length,
                 sample_rate=self.args.sample_rate,
             )
-            noisy_spectrogram = noisy_input_fe.get_stft_spectrogram(self.args.center)
-
-            # Or get the phase angle (in radians)
-            # noisy_stft_magnitude, noisy_stft_phase = librosa.magphase(noisy_stft_features)
-            noisy_phase = np.angle(noisy_spectrogram)
-
-            # get the magnitude of the spectral
-            noisy_magnitude = np.abs(noisy_spectrogram)
-
-            # extract stft features from clean audio
             clean_audio_fe = FeatureExtractor(
                 clean_audio,
                 windowLength=self.args.win_length,
                 hop_length=self.args.hop_length,
                 sample_rate=self.args.sample_rate,
             )
-            clean_spectrogram = clean_audio_fe.get_stft_spectrogram(self.args.center)
-            # clean_spectrogram = cleanAudioFE.get_mel_spectrogram()
-
-            # get the clean phase
-            clean_phase = np.angle(clean_spectrogram)
-
-            # get the clean spectral magnitude
-            clean_magnitude = np.abs(clean_spectrogram)
-            # clean_magnitude = 2 * clean_magnitude / np.sum(scipy.signal.hamming(self.args.win_length, sym=False))
 
-            noisy_real, noisy_imag = np.real(noisy_spectrogram), np.imag(
-                noisy_spectrogram
+            # real and imag are written to one preallocated buffer for each audio
+            noisy_real, noisy_imag = noisy_input_fe.get_stft_real_imag(
+                self.args.center,
+                out=np.empty(noisy_input_fe.get_stft_shape(self.args.center), dtype=np.float32),
             )
-            clean_real, clean_imag = np.real(clean_spectrogram), np.imag(
-                clean_spectrogram
+            clean_real, clean_imag = clean_audio_fe.get_stft_real_imag(
+                self.args.center,
+                out=np.empty(clean_audio_fe.get_stft_shape(self.args.center), dtype=np.float32),
             )
 
+            if "real_imag" in self.features:
+                data["noisy_stft_real"], data["clean_stft_real"] = noisy_real, clean_real
+                data["noisy_stft_imag"], data["clean_stft_imag"] = noisy_imag, clean_imag
+
+            if "mag_phase" in self.features:
+                # get the magnitude and the phase angle (in radians)
+                data["noisy_stft_magnitude"] = np.hypot(noisy_real, noisy_imag)
+                data["clean_stft_magnitude"] = np.hypot(clean_real, clean_imag)
+                data["noisy_stft_phase"] = np.arctan2(noisy_imag, noisy_real)
+                data["clean_stft_phase"] = np.arctan2(clean_imag, clean_real)
+                # clean_magnitude = 2 * clean_magnitude / np.sum(scipy.signal.hamming(self.args.win_length, sym=False))
+
             # called phase aware scaling
             # clean_magnitude = self._phase_aware_scaling(clean_magnitude, clean_phase, noisy_phase)
             # scaler = StandardScaler(copy=False, with_mean=True, with_std=True)
             # noisy_magnitude = scaler.fit_transform(noisy_magnitude)
             # clean_magnitude = scaler.transform(clean_magnitude)
 
-            return name, (
-                noisy_magnitude,
-                clean_magnitude,
-                noisy_phase,
-                clean_phase,
-                noisy_real,
-                clean_real,
-                noisy_imag,
-                clean_imag,
+        if "mel" in self.features:
+            # segment, frame, mel
+            for key, audio in (("noisy_mel", noisy_audio), ("clean_mel", clean_audio)):
+                mel = FeatureExtractor(
+                    audio,
+                    windowLength=self.args.win_length,
+                    hop_length=self.args.hop_length,
+                    sample_rate=self.args.sample_rate,
+                ).get_mel_spectrogram()
+                data[key] = np.swapaxes(mel, -1, -2)
+
+        return name, data
+
+    def get_examples(self, name, data):
+        """Serialize the output of audio_process to tfrecord examples
+
+        Returns:
+            list of (key, serialized example), key is "{name}_{index of segment}"
+        """
+        if self.debug:
+            print("  Write Down to tfrecord")
+            for key, value in data.items():
+                print("[DEBUG]: ", key, value.shape, value.dtype)
+            print("---")
+
+        precision = getattr(self.args, "precision", None) or "float32"
+        num_segments = len(next(iter(data.values())))
+        examples = []
+        for idata in range(num_segments):
+            example = get_tf_feature_dict(
+                {key: value[idata] for key, value in data.items()}, precision
             )
-        else:
-            return name, (noisy_audio, clean_audio)
-
-    def create_tf_record(self, *, prefix, parallel=False):
+            examples.append((f"{name}_{idata}", example.SerializeToString()))
+
+        return examples
+
+    def process_examples(self, filename):
+        """audio_process and get_examples in one call, the task of a worker"""
+        name, data = self.audio_process(filename)
+        return name, self.get_examples(name, data)
+
+    def _iter_examples(self, file_name_list, num_workers, queue_size):
+        """Yield (file name, name, examples) for each file
+
+        In parallel, one process pool lives for the whole list and at most
+        queue_size files are in flight, so memory stays flat with the corpus size.
+        """
+        if num_workers <= 0:
+            for file_name in file_name_list:
+                yield (file_name, *self.process_examples(file_name))
+            return
+
+        # spawn, the main process already initialized tensorflow
+        with ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.args, self.debug),
+        ) as pool:
+            file_names = iter(file_name_list)
+            pendings = {}
+            for file_name in itertools.islice(file_names, queue_size):
+                pendings[pool.submit(_process_examples_worker, file_name)] = file_name
+
+            while pendings:
+                done, _ = wait(pendings, return_when=FIRST_COMPLETED)
+                for file_name in itertools.islice(file_names, len(done)):
+                    pendings[pool.submit(_process_examples_worker, file_name)] = file_name
+                for pending in done:
+                    yield (pendings.pop(pending), *pending.result())
+
+    def create_tf_record(self, *, prefix, parallel=None):
         root = self.args.save_path
         folder = f"{root}/records_seg_{str(self.args.segment).replace('.', '-')}_train_{int(self.args.split*100)}_norm_{self.args.normalize}_segNorm_{self.args.segment_normalization}_fft_{self.args.fft}_topdB_{self.args.top_db}"
+        if getattr(self.args, "full_utterance", False):
+            folder = f"{folder}_utterance"
         if self.debug:
             folder = f"{folder}_debug"
 
@@ -181,183 +257,105 @@ class DatasetVoiceBank:
                 )
             ]
 
-        # If file list for preprocess didn't divide, then it will stack in memory(RAM)
-        start = 0
-        step = 100
-        end = step
+        num_workers = getattr(self.args, "num_workers", None)
+        if num_workers is None:
+            num_workers = os.cpu_count() - 3 if os.cpu_count() > 4 else 1
+        if parallel is False:
+            num_workers = 0
+        num_writers = max(getattr(self.args, "num_writers", None) or 1, 1)
+        queue_size = getattr(self.args, "queue_size", None) or 2 * max(num_workers, 1)
+
+        num_shards = getattr(self.args, "num_shards", None)
+        shard_size = getattr(self.args, "shard_size", None)
+        if num_shards:
+            num_writers = min(num_writers, num_shards)
 
         print(f"Total {prefix} file number: {len(file_name_list)}")
 
-        for istep in tqdm.tqdm(range(len(file_name_list) // step), ncols=120):
-            if istep == len(file_name_list) // step - 1:
-                submitted_file_name_list = file_name_list[start:]
-            else:
-                submitted_file_name_list = file_name_list[start:end]
-
-            if parallel:
-                print(f"CPU ", os.cpu_count() - 3 if os.cpu_count() > 4 else 1, "...")
-                out = []
-                pendings = []
-                with ProcessPoolExecutor(
-                    os.cpu_count() - 3 if os.cpu_count() > 4 else 1
-                ) as pool:
-                    for file_name in submitted_file_name_list:
-                        pendings.append(pool.submit(self.audio_process, file_name))
-
-                    for pending in tqdm.tqdm(pendings):
-                        out.append(pending.result())
-                # out = p.map(self.parallel_audio_processing, clean_filenames_sublist)
-            else:
-                out = [
-                    self.audio_process(file_names)
-                    for file_names in submitted_file_name_list
-                ]
-
-            for name, data in out:
-                if self.args.fft:
-                    # noisy_stft_magnitude = data[0]
-                    # clean_stft_magnitude = data[1]
-                    # noisy_stft_phase = data[2]
-                    # clean_stft_phase = data[3]
-                    noisy_stft_real = data[4]
-                    clean_stft_real = data[5]
-                    noisy_stft_imag = data[6]
-                    clean_stft_imag = data[7]
-                    if self.debug:
-                        print("  Getting from preprocess")
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.shape,
-                            noisy_stft_imag.shape,
-                            clean_stft_real.shape,
-                            clean_stft_imag.shape,
-                        )
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.dtype,
-                            noisy_stft_imag.dtype,
-                            clean_stft_real.dtype,
-                            clean_stft_imag.dtype,
-                        )
-                        print("---")
-
-                    # segment, ch, frame, freqeuncy
-                    new_axes = np.arange(len(clean_stft_imag.shape))
-                    new_axes[-2:] = new_axes[-1], new_axes[-2]
-
-                    noisy_stft_real = np.transpose(
-                        noisy_stft_real, axes=new_axes
-                    )
-                    clean_stft_real = np.transpose(
-                        clean_stft_real, axes=new_axes
-                    )
-                    noisy_stft_imag = np.transpose(
-                        noisy_stft_imag, axes=new_axes
-                    )
-                    clean_stft_imag = np.transpose(
-                        clean_stft_imag, axes=new_axes
-                    )  
-                    
-                    if self.debug:
-                        print(" Segmentation")
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.shape,
-                            noisy_stft_imag.shape,
-                            clean_stft_real.shape,
-                            clean_stft_imag.shape,
-                        )
-                        print(
-                            "[DEBUG]: ",
-                            noisy_stft_real.dtype,
-                            noisy_stft_imag.dtype,
-                            clean_stft_real.dtype,
-                            clean_stft_imag.dtype,
-                        )
-                        print("---")
-
-                    for idata, (
-                        noisy_real,
-                        clean_real,
-                        noisy_imag,
-                        clean_imag,
-                    ) in enumerate(
-                        zip(
-                            noisy_stft_real,
-                            clean_stft_real,
-                            noisy_stft_imag,
-                            clean_stft_imag,
-                        )
-                    ):
-                        # 1, ch, frame, freqeuncy
-                        noisy_real = np.expand_dims(noisy_real, axis=0)  
-                        clean_real = np.expand_dims(clean_real, axis=0)
-                        noisy_imag = np.expand_dims(noisy_imag, axis=0)
-                        clean_imag = np.expand_dims(clean_imag, axis=0)
-
-                        if self.debug:
-                            print("  Write Down to tfrecord")
-                            print(
-                                "[DEBUG]: ",
-                                noisy_real.shape,
-                                noisy_imag.shape,
-                                clean_real.shape,
-                                clean_imag.shape,
-                            )
-                            print(
-                                "[DEBUG]: ",
-                                noisy_real.dtype,
-                                noisy_imag.dtype,
-                                clean_real.dtype,
-                                clean_imag.dtype,
-                            )
-                            print("---")
-
-                        example = get_tf_feature_real_imag_pair(
-                            noisy_real, clean_real, noisy_imag, clean_imag
-                        )
-    
-                        tfrecord_filename = (
-                            f"{folder}/{prefix}_{name}_{idata}.tfrecords"
-                        )
-                        if os.path.isfile(
-                            tfrecord_filename
-                        ):  # [TODO] Why at first time, it goes here?
-                            print(f"Skipping {tfrecord_filename}")
-                            continue
-                        else:
-                            writer = tf.io.TFRecordWriter(tfrecord_filename)
-                            writer.write(example.SerializeToString())
-                            writer.close()
-                else:
-                    noisy_audio = data[0]
-                    clean_audio = data[1]
-
-                    if self.debug:
-                        print("[DEBUG]: ", noisy_audio.shape, clean_audio.shape)
-
-                    for idata, (noise_segment, clean_segment) in enumerate(
-                        zip(noisy_audio, clean_audio)
-                    ):
-                        if self.debug:
-                            print("  Write Down to tfrecord")
-                            print("[DEBUG]: ", noise_segment.shape, clean_segment.shape)
-                            print("---")
-
-                        example = get_tf_feature_sample_pair(
-                            noise_segment, clean_segment
-                        )
-                        tfrecord_filename = (
-                            f"{folder}/{prefix}_{name}_{idata}.tfrecords"
-                        )
-                        if os.path.isfile(tfrecord_filename):
-                            print(f"Skipping {tfrecord_filename}")
-                            continue
-                        else:
-                            writer = tf.io.TFRecordWriter(tfrecord_filename)
-                            writer.write(example.SerializeToString())
-                            writer.close()
-
-            del out  # resolve memory leak
-            start += step
-            end += step
+        # only new, changed or not finished files
+        manifest = PreprocessManifest(folder, prefix, get_params(self.args))
+        file_name_list = manifest.prepare(file_name_list)
+        if len(file_name_list) == 0:
+            return
+
+        run = None
+        if num_shards or shard_size:
+            # microseconds, runs in the same second must not share shard names
+            run = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            manifest.start_run(run)
+
+        print(f"Workers: {num_workers}, Writers: {num_writers}, Queue: {queue_size}")
+
+        # one file per segment if neither num_shards nor shard_size is set
+        writers = [
+            ShardedRecordWriter(
+                folder,
+                prefix,
+                num_shards=num_shards,
+                shard_size=shard_size,
+                index=index,
+                num_writers=num_writers,
+                run=run,
+                on_close=manifest.commit,
+                compression=getattr(self.args, "compression", None),
+            )
+            for index in range(num_writers)
+        ]
+
+        # bounded, the workers wait when the writers can't follow
+        examples_queue = queue.Queue(maxsize=queue_size)
+        errors = []
+
+        def write_examples(writer):
+            try:
+                while True:
+                    item = examples_queue.get()
+                    if item is None:
+                        break
+                    (clean_filename, noisy_filename), _, examples = item
+                    records = writer.write_examples(examples)
+                    manifest.stage(clean_filename, noisy_filename, records)
+            except Exception as e:
+                errors.append(e)
+                # keep consuming so that the producer does not block
+                while examples_queue.get() is not None:
+                    pass
+            finally:
+                writer.close()
+
+        threads = [
+            threading.Thread(target=write_examples, args=(writer,), daemon=True)
+            for writer in writers
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in tqdm.tqdm(
+                self._iter_examples(file_name_list, num_workers, queue_size),
+                total=len(file_name_list),
+                ncols=120,
+            ):
+                examples_queue.put(item)
+                if errors:
+                    break
+        finally:
+            for _ in threads:
+                examples_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+
+_worker_dataset = None
+
+
+def _init_worker(args, debug):
+    global _worker_dataset
+    _worker_dataset = DatasetVoiceBank([], [], None, args, debug)
+
+
+def _process_examples_worker(filename):
+    return _worker_dataset.process_examples(filename)
@@ -1,4 +1,6 @@
 import librosa
+import numpy as np
+import scipy.fft
 import scipy.signal as signal
 
 
@@ -9,7 +11,7 @@ class FeatureExtractor:
         self.window_length = windowLength
         self.hop_length = hop_length
         self.sample_rate = sample_rate
-        self.window = signal.hanning(
+        self.window = signal.windows.hann(
             self.window_length, sym=False
         )  # sym true: filter, false: spectral analysis
 
@@ -23,6 +25,47 @@ class FeatureExtractor:
             center=center,
         )
 
+    def get_stft_shape(self, center):
+        """Shape of get_stft_real_imag, [2, ..., frames, freq]"""
+        num_samples = np.shape(self.audio)[-1] + (self.fft_length if center else 0)
+        num_frames = (num_samples - self.window_length) // self.hop_length + 1
+        return (2,) + np.shape(self.audio)[:-1] + (num_frames, self.fft_length // 2 + 1)
+
+    def get_stft_real_imag(self, center, out=None):
+        """Batched stft of all segments in one rfft call
+
+        Frames of every segment are a strided view of the audio and the frequency
+        axis is last, so the result doesn't need to be transposed.
+        Same as librosa.stft with pad_mode="constant".
+
+        The complex output of rfft is copied to out once, a dft as matmul writing out
+        directly was 10x slower than rfft and the copy(512 fft, 60 segments of 16384).
+
+        Args:
+            out: preallocated float32 array of get_stft_shape, [2, ..., frames, freq]
+
+        Returns:
+            real, imag: float32, [..., frames, freq]
+        """
+        audio = np.asarray(self.audio, dtype=np.float32)
+        if center:
+            padding = np.zeros(shape=(audio.ndim, 2), dtype=int)
+            padding[-1] = self.fft_length // 2
+            audio = np.pad(audio, padding, mode="constant")
+
+        frames = np.lib.stride_tricks.sliding_window_view(
+            audio, self.window_length, axis=-1
+        )[..., :: self.hop_length, :]
+        spectrogram = scipy.fft.rfft(
+            frames * self.window.astype(np.float32), n=self.fft_length, axis=-1, overwrite_x=True
+        )  # complex64, ..., frames, freq
+
+        if out is None:
+            out = np.empty(self.get_stft_shape(center), dtype=np.float32)
+        np.copyto(out[0], spectrogram.real)
+        np.copyto(out[1], spectrogram.imag)
+        return out[0], out[1]
+
     def get_audio_from_stft_spectrogram(self, stft_features, center):
         return librosa.istft(
             stft_features,
@@ -34,7 +77,7 @@ class FeatureExtractor:
 
     def get_mel_spectrogram(self):
         return librosa.feature.melspectrogram(
-            self.audio,
+            y=self.audio,
             sr=self.sample_rate,
             power=2.0,
             pad_mode="reflect",
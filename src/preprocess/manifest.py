@@ -0,0 +1,260 @@
+"""
+Preprocess manifest
+
+    One json line per source wav pair in {folder}/manifest_{prefix}.jsonl,
+
+        {"name", "clean", "noisy", "stat", "hash", "params", "records": [[file, offset], ...]}
+
+    - hash: sha1 of the contents of the clean and noisy wav
+    - params: hash of the preprocess parameters, the whole parameters are in the run line
+    - records: record file(shard) and byte offset of each segment
+
+    An entry is appended only after every record file it points to is closed, so
+    that a crashed run leaves no entry for partially written shards. On the next
+    run, the shards of that run which no entry points to are removed and the
+    files are processed again. In legacy mode(one file per segment), the files of
+    every pair to process are removed first, so that a partially written file is
+    never taken as done.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+
+# parameters of dset which change the contents of the records
+PARAMS = (
+    "sample_rate",
+    "resample",
+    "segment",
+    "segment_hop",
+    "segment_pad",
+    "full_utterance",
+    "n_fft",
+    "win_length",
+    "hop_length",
+    "center",
+    "normalize",
+    "segment_normalization",
+    "fft",
+    "features",
+    "precision",
+    "compression",
+    "top_db",
+)
+
+
+def record_name(clean_filename):
+    """Name of the records of a wav pair, the keys of its examples are "{name}_{index of segment}" """
+    filename = os.path.basename(clean_filename)
+    return filename.split(".")[0] + "_" + filename.split(".")[1]
+
+
+def get_params(args):
+    return {key: getattr(args, key, None) for key in PARAMS}
+
+
+def _hash_params(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def _hash_files(*paths):
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as tmp:
+            for chunk in iter(lambda: tmp.read(1 << 20), b""):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _stat(*paths):
+    stat = []
+    for path in paths:
+        st = os.stat(path)
+        stat += [st.st_size, st.st_mtime_ns]
+    return stat
+
+
+class PreprocessManifest:
+    def __init__(self, folder, prefix, params):
+        self.folder = folder
+        self.prefix = prefix
+        self.path = os.path.join(folder, f"manifest_{prefix}.jsonl")
+        self.params = params
+        self.params_hash = _hash_params(params)
+
+        self.runs = {}  # run -> params
+        self.entries = {}  # clean filename -> entry
+        self._pending = {}  # clean filename -> (entry, record files not closed)
+        self._digests = {}  # clean filename -> (stat, hash) of files to process
+        self._closed = set()  # record files closed in this run
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as tmp:
+                for line in tmp:
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:  # last line of a crashed run
+                        continue
+                    if "run" in item:
+                        self.runs[item["run"]] = item["params"]
+                    else:
+                        self.entries[item["clean"]] = item
+
+    def _record_files(self, entry):
+        return set(os.path.join(self.folder, file) for file, _ in entry["records"])
+
+    def _run_files(self):
+        """Record files written by the runs in the manifest"""
+        return set(
+            os.path.join(self.folder, file)
+            for file in os.listdir(self.folder)
+            if any(file.startswith(f"{self.prefix}_{run}_") for run in self.runs)
+        )
+
+    def prepare(self, file_name_list):
+        """Check the entries against the wav files and the parameters
+
+        Removes the records of changed files and of crashed runs, rewrites the
+        manifest with the valid entries.
+
+        Returns:
+            the list of (clean, noisy) files which should be processed
+        """
+        todo = []
+        valid = {}
+        for clean_filename, noisy_filename in file_name_list:
+            stat = _stat(clean_filename, noisy_filename)
+            entry = self.entries.get(clean_filename)
+            if entry is not None and entry["stat"] == stat:
+                digest = entry["hash"]  # not modified, skip hashing
+            else:
+                digest = _hash_files(clean_filename, noisy_filename)
+
+            if (
+                entry is not None
+                and entry["noisy"] == noisy_filename
+                and entry["hash"] == digest
+                and entry["params"] == self.params_hash
+                and all(os.path.isfile(file) for file in self._record_files(entry))
+            ):
+                entry["stat"] = stat
+                valid[clean_filename] = entry
+            else:
+                self._digests[clean_filename] = (stat, digest)
+                todo.append((clean_filename, noisy_filename))
+
+        # a shard with any stale record is removed, so the other files in it are processed again
+        stale_files = set()
+        for clean_filename, entry in self.entries.items():
+            if clean_filename not in valid:
+                stale_files |= self._record_files(entry)
+        changed = True
+        while changed:
+            changed = False
+            for clean_filename, entry in list(valid.items()):
+                if self._record_files(entry) & stale_files:
+                    stale_files |= self._record_files(entry)
+                    todo.append((clean_filename, entry["noisy"]))
+                    del valid[clean_filename]
+                    changed = True
+
+        referenced = set()
+        for entry in valid.values():
+            referenced |= self._record_files(entry)
+
+        # legacy mode, "{prefix}_{name}_{segment}.tfrecords" of the pairs to process
+        todo_names = set(record_name(clean_filename) for clean_filename, _ in todo)
+        pattern = re.compile(rf"{re.escape(self.prefix)}_(.+)_\d+\.tfrecords")
+        for file in os.listdir(self.folder):
+            match = pattern.fullmatch(file)
+            if match and match.group(1) in todo_names:
+                stale_files.add(os.path.join(self.folder, file))
+
+        removed = (stale_files | self._run_files()) - referenced
+        for file in removed:
+            if os.path.isfile(file):
+                os.remove(file)
+
+        unknown = [
+            file
+            for file in os.listdir(self.folder)
+            if file.startswith(f"{self.prefix}_")
+            and os.path.join(self.folder, file) not in referenced
+        ]
+        if unknown and (self.entries or self.runs):
+            print(
+                f"[WARNING] {len(unknown)} {self.prefix} record files are not in the manifest, "
+                "they are read in training as well"
+            )
+
+        self.entries = valid
+        self.runs = {
+            run: params
+            for run, params in self.runs.items()
+            if any(
+                os.path.basename(file).startswith(f"{self.prefix}_{run}_")
+                for file in referenced
+            )
+        }
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as tmp:
+            for run, params in self.runs.items():
+                tmp.write(json.dumps({"run": run, "params": params}) + "\n")
+            for entry in valid.values():
+                tmp.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+
+        print(
+            f"Manifest {self.prefix}: {len(valid)} done, {len(todo)} to process, "
+            f"{len(removed)} record files removed"
+        )
+        return todo
+
+    def _append(self, item):
+        with open(self.path, "a") as tmp:
+            tmp.write(json.dumps(item) + "\n")
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+    def start_run(self, run):
+        with self._lock:
+            self.runs[run] = self.params
+            self._append({"run": run, "params": self.params})
+
+    def stage(self, clean_filename, noisy_filename, records):
+        """Keep the entry until all of its record files are closed
+
+        Args:
+            records: list of (record file, offset)
+        """
+        if clean_filename in self._digests:
+            stat, digest = self._digests.pop(clean_filename)
+        else:
+            stat = _stat(clean_filename, noisy_filename)
+            digest = _hash_files(clean_filename, noisy_filename)
+
+        entry = {
+            "name": os.path.basename(clean_filename),
+            "clean": clean_filename,
+            "noisy": noisy_filename,
+            "stat": stat,
+            "hash": digest,
+            "params": self.params_hash,
+            "records": [[os.path.basename(file), offset] for file, offset in records],
+        }
+        with self._lock:
+            self._pending[clean_filename] = (entry, set(file for file, _ in records))
+        self.commit([])
+
+    def commit(self, closed):
+        """Append the entries whose record files are all closed, on_close of the writer"""
+        with self._lock:
+            self._closed.update(closed)
+            for clean_filename, (entry, files) in list(self._pending.items()):
+                if files <= self._closed:
+                    self.entries[clean_filename] = entry
+                    self._append(entry)
+                    del self._pending[clean_filename]
@@ -0,0 +1,129 @@
+"""
+Record index
+
+    Scans the record files once, checking the crc of every record by reading it
+    with TFRecordDataset, and keeps the valid records in {folder}/index.json,
+
+        {"compression", "files": {file: {"size", "mtime", "count", "offsets", "error"}}}
+
+    - count: the number of records before the first corrupted one
+    - offsets: byte offset of each valid record, of the uncompressed stream
+    - error: why the file stopped early, null if every record is valid
+
+    The reader takes only count records of each file, so that it doesn't need
+    ignore_errors. A file is scanned again only when its size or mtime changes.
+"""
+import os
+import re
+import json
+import tensorflow as tf
+from .record_writer import RECORD_OVERHEAD
+
+INDEX_NAME = "index.json"
+
+
+def scan_record_file(path, compression=None):
+    """Offsets of the valid records in a record file
+
+    Returns:
+        (offsets, error), error is None if every record is valid
+    """
+    dataset = tf.data.TFRecordDataset(path, compression_type=compression or "")
+    dataset = dataset.map(tf.strings.length)
+
+    offsets = []
+    offset = 0
+    error = None
+    try:
+        for length in dataset:
+            offsets.append(offset)
+            offset += int(length) + RECORD_OVERHEAD
+    except (tf.errors.DataLossError, tf.errors.InvalidArgumentError) as e:
+        # drop the name of the iterator op, "{{function_node ...}} corrupted record at 42 [Op:...]"
+        error = re.sub(r"\{\{.*?\}\}\s*", "", e.message).split(" [Op:")[0]
+
+    if error is None and not compression and offset != os.path.getsize(path):
+        error = f"{os.path.getsize(path) - offset} trailing bytes after the last record"
+    return offsets, error
+
+
+def load_index(folder):
+    path = os.path.join(folder, INDEX_NAME)
+    if not os.path.isfile(path):
+        return {"compression": None, "files": {}}
+    with open(path, "r") as tmp:
+        try:
+            return json.load(tmp)
+        except json.JSONDecodeError:
+            return {"compression": None, "files": {}}
+
+
+def update_index(folder, filenames, compression=None, force=False):
+    """Scan new or changed record files and save the index
+
+    Args:
+        filenames: record files in the folder
+        force: scan every file again
+
+    Returns:
+        index, {"compression", "files": {file: entry}}
+    """
+    compression = compression or None
+    index = load_index(folder)
+    if index.get("compression") != compression:
+        index = {"compression": compression, "files": {}}
+
+    files = {}
+    scanned = 0
+    for filename in sorted(filenames):
+        name = os.path.basename(filename)
+        stat = os.stat(filename)
+        entry = index["files"].get(name)
+        if (
+            force
+            or entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns
+        ):
+            offsets, error = scan_record_file(filename, compression)
+            entry = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "count": len(offsets),
+                "offsets": offsets,
+                "error": error,
+            }
+            scanned += 1
+        files[name] = entry
+
+    if scanned or len(files) != len(index["files"]):
+        index = {"compression": compression, "files": files}
+        path = os.path.join(folder, INDEX_NAME)
+        with open(f"{path}.tmp", "w") as tmp:
+            json.dump(index, tmp)
+        os.replace(f"{path}.tmp", path)
+
+        corrupted = [name for name, entry in files.items() if entry["error"] is not None]
+        print(
+            f"Index: {scanned} record files scanned, "
+            f"{sum(entry['count'] for entry in files.values())} records in {len(files)} files"
+        )
+        for name in corrupted:
+            print(f"[WARNING] {name}: {files[name]['count']} valid records, {files[name]['error']}")
+    else:
+        index["files"] = files
+    return index
+
+
+def verify_records(folder, compression=None, force=True):
+    """Check the record files of train/val in the folder, index.json is rewritten
+
+    Args:
+        force: scan every file, or only new and changed ones(size, mtime)
+    """
+    filenames = [
+        os.path.join(folder, file)
+        for file in os.listdir(folder)
+        if file.endswith(".tfrecords") and file.startswith(("train_", "val_"))
+    ]
+    return update_index(folder, filenames, compression, force=force)
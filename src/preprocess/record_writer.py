@@ -0,0 +1,155 @@
+"""
+Sharded TFRecord writer
+
+    Packs many serialized examples per file so that the dataset folder does not
+    end up with one tiny file per segment. Shards keep the "{prefix}_" naming,
+    so that glob "train_*" / "val_*" in distrib.load_dataset still finds them.
+
+    - num_shards: fixed number of files, wav files are distributed round-robin
+    - shard_size: target size of a file in MB, a new file is opened when exceeded
+    - neither: legacy mode, one file per example named by its key
+
+    Several writers can work on the same prefix in parallel, each of them owns
+    the shards index, index + num_writers, index + 2*num_writers, ...
+
+    With compression('GZIP' or 'ZLIB'), shard_size and the offsets are of the
+    uncompressed records.
+
+    The examples of one wav file are always written to one shard and the shard
+    names have the tag of the run, "{prefix}_{run}_...", so that a shard can be
+    dropped as a whole by the manifest when one of its files changes.
+"""
+import os
+import tensorflow as tf
+
+# length(8) + crc of length(4) + crc of data(4)
+RECORD_OVERHEAD = 16
+
+
+class ShardedRecordWriter:
+    def __init__(
+        self,
+        folder,
+        prefix,
+        *,
+        num_shards=None,
+        shard_size=None,
+        index=0,
+        num_writers=1,
+        run=None,
+        on_close=None,
+        compression=None,
+    ):
+        self.folder = folder
+        self.prefix = prefix if run is None else f"{prefix}_{run}"
+        self.on_close = on_close
+        self.options = tf.io.TFRecordOptions(compression_type=compression or "")
+        self.num_shards = num_shards if num_shards else None
+        self.shard_size = int(shard_size * 1024 * 1024) if shard_size else None
+        self.index = index
+        self.num_writers = num_writers
+
+        if self.num_shards is not None:
+            self._shard_ids = list(range(index, self.num_shards, num_writers))
+            assert len(self._shard_ids) > 0, "num_writers should be less than num_shards"
+
+        self._writers = {}  # shard id -> [writer, path, bytes]
+        self._count = 0
+        self._shard = 0
+
+    @property
+    def sharded(self):
+        return self.num_shards is not None or self.shard_size is not None
+
+    def _shard_path(self, shard_id):
+        if self.num_shards is not None:
+            name = f"{self.prefix}_{shard_id:05d}-of-{self.num_shards:05d}.tfrecords"
+        else:
+            name = f"{self.prefix}_shard_{self.index:02d}-{shard_id:05d}.tfrecords"
+        return os.path.join(self.folder, name)
+
+    def _open(self, shard_id):
+        path = self._shard_path(shard_id)
+        self._writers[shard_id] = [tf.io.TFRecordWriter(path, self.options), path, 0]
+        return self._writers[shard_id]
+
+    def _close(self, shard_id):
+        writer, path, _ = self._writers.pop(shard_id)
+        writer.close()
+        if self.on_close is not None:
+            self.on_close([path])
+        return path
+
+    def write(self, example, key=None):
+        """Write one tf.train.Example
+
+        Args:
+            example: tf.train.Example or serialized bytes
+            key: name of the file in legacy mode, "{prefix}_{key}.tfrecords"
+
+        Returns:
+            (path of record file, byte offset of the record in the file)
+        """
+        return self.write_examples([(key, example)])[0]
+
+    def write_examples(self, examples):
+        """Write the examples of one wav file to one shard
+
+        Args:
+            examples: list of (key, tf.train.Example or serialized bytes)
+
+        Returns:
+            list of (path of record file, byte offset of the record in the file)
+        """
+        examples = [
+            (key, example if isinstance(example, bytes) else example.SerializeToString())
+            for key, example in examples
+        ]
+
+        records = []
+        if not self.sharded:
+            for key, example in examples:
+                # overwritten, the manifest only skips the pairs which are done
+                path = os.path.join(self.folder, f"{self.prefix}_{key}.tfrecords")
+                writer = tf.io.TFRecordWriter(path, self.options)
+                writer.write(example)
+                writer.close()
+                records.append((path, 0))
+            if self.on_close is not None:
+                self.on_close([path for path, _ in records])
+            return records
+
+        size = sum(len(example) + RECORD_OVERHEAD for _, example in examples)
+        if self.num_shards is not None:
+            shard_id = self._shard_ids[self._count % len(self._shard_ids)]
+        else:
+            shard_id = self._shard
+            if (
+                shard_id in self._writers
+                and self._writers[shard_id][2] + size > self.shard_size
+                and self._writers[shard_id][2] > 0
+            ):
+                self._close(shard_id)
+                self._shard += 1
+                shard_id = self._shard
+
+        if shard_id not in self._writers:
+            self._open(shard_id)
+
+        state = self._writers[shard_id]
+        for _, example in examples:
+            records.append((state[1], state[2]))
+            state[0].write(example)
+            state[2] += len(example) + RECORD_OVERHEAD
+        self._count += 1
+        return records
+
+    def close(self):
+        for shard_id in list(self._writers.keys()):
+            self._close(shard_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
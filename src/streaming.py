@@ -0,0 +1,251 @@
+"""
+Frame by frame inference of rnn, lstm and gru models
+
+    inference.py runs the model on a window of segment frames for every output frame and keeps
+    only the last one. StreamingEnhancer runs the streaming model of build_model_rnn instead,
+    stateful recurrent layers and ExponentialMovingAverage, on the new frames only, and the states
+    are carried to the next call.
+
+    samples -> frame(n_fft, hop_length) -> hann window, rfft -> model -> irfft, overlap-add -> samples
+
+    - the same as the model on the stft of the whole utterance(stft_tensorflow, InverseSTFT)
+    - frames: STFT frames in a model call, the output is pushed every hop_length * frames samples
+    - algorithmic latency: n_fft samples, the frame is buffered(n_fft - hop_length) and
+      the output of a hop is complete after overlap-add of the following frames(hop_length)
+    - a model trained on segments starts its states from zero every segment, streaming starts
+      once at the beginning of the utterance(reset)
+    - the samples are normalized by dset.normalize('z-score', 'min-max' or 'none') with running
+      statistics of the samples received so far, updated every chunk, so an output never depends
+      on future audio. Each output sample is reverted with the statistics its input was normalized
+      with. Inference normalizes by the whole utterance, the first chunks differ from it.
+    - chunk_times: wall-clock time of each process call, the latency of a chunk on top of the
+      algorithmic latency
+
+    python main.py --mode streaming, real time factor and latency of the test files
+"""
+import time
+import numpy as np
+import tensorflow as tf
+import keras
+
+from src.utils import read_audio, AudioCache, load_yaml, limit_gpu_tf, get_frontend, encode_normalize, decode_normalize
+
+
+class StreamingEnhancer:
+    """Enhance a stream of samples in chunks of any length
+
+    Args:
+        model: trained rnn, lstm or gru model of build_model_rnn, the waveform model of frontend: model as well
+        args: configuration of the model
+        frames: STFT frames in a model call
+
+    Example:
+        enhancer = StreamingEnhancer(model, args)
+        for chunk in chunks:
+            play(enhancer.process(chunk))
+        play(enhancer.flush())
+    """
+
+    NORMALIZE = ("z-score", "min-max", "none")
+
+    def __init__(self, model, args, frames=1):
+        from src.model.rnn import build_model_rnn
+
+        if args.model.name not in ("rnn", "lstm", "gru"):
+            raise ValueError(f"Streaming is not supported by {args.model.name}, only rnn, lstm and gru...")
+        if args.dset.normalize not in self.NORMALIZE:
+            raise ValueError(f"Streaming normalize {args.dset.normalize} should be one of {self.NORMALIZE}...")
+
+        self.n_fft = args.dset.n_fft
+        self.hop_length = args.dset.hop_length
+        self.center = args.dset.center
+        self.fft_normalization = args.model.fft_normalization
+        self.normalize = args.dset.normalize
+        self.sample_rate = args.dset.sample_rate
+        self.frames = frames
+
+        if get_frontend(args) == "model":
+            # STFT -> model -> InverseSTFT
+            model = next(layer for layer in model.layers if isinstance(layer, keras.Model))
+
+        # the same layers in the same order, stateful ones have their states after the weights
+        self.model = build_model_rnn(args, streaming=True)
+        for layer, streaming_layer in zip(model.layers, self.model.layers):
+            weights = layer.get_weights()
+            if weights:
+                streaming_layer.set_weights(weights + streaming_layer.get_weights()[len(weights):])
+
+        self._step = tf.function(
+            lambda spectrum: self.model(spectrum, training=False),
+            input_signature=[tf.TensorSpec([1, 1, None, self.n_fft // 2 + 1], tf.complex64)],
+        )
+
+        # the same windows as tf.signal.stft and tf.signal.inverse_stft
+        self.window = tf.signal.hann_window(self.n_fft).numpy()
+        self.synthesis_window = tf.signal.inverse_stft_window_fn(
+            frame_step=self.hop_length, forward_window_fn=tf.signal.hann_window
+        )(self.n_fft, dtype=tf.float32).numpy()
+
+        self.reset()
+
+    @property
+    def latency(self):
+        """Algorithmic latency, sec"""
+        return self.n_fft / self.sample_rate
+
+    def reset(self):
+        """States of a new utterance"""
+        for layer in self.model.layers:
+            if getattr(layer, "stateful", False):
+                layer.reset_states()
+        # zeros of center padding as stft_tensorflow, and trimmed from the output as InverseSTFT
+        self.buffer = np.zeros(self.n_fft // 2 if self.center else 0, dtype=np.float32)
+        self.overlap = np.zeros(self.n_fft, dtype=np.float32)
+        self.trim = self.n_fft // 2 if self.center else 0
+        self.frame_times = []
+        self.chunk_times = []
+        # running statistics, and [samples, metadata] of the inputs not yet in the output
+        self.count, self.total, self.total_square = 0, 0.0, 0.0
+        self.min, self.max = np.inf, -np.inf
+        self.pending = []
+
+    def _encode(self, samples):
+        """Normalize a chunk by the statistics of the samples so far, including the chunk"""
+        if self.normalize == "none" or len(samples) == 0:
+            return samples
+        eps = 1e-12
+        if self.normalize == "z-score":
+            self.count += len(samples)
+            self.total += np.sum(samples, dtype=np.float64)
+            self.total_square += np.sum(np.square(samples, dtype=np.float64))
+            mean = self.total / self.count
+            metadata = {"mean": mean, "std": np.sqrt(max(self.total_square / self.count - mean**2, 0)) + eps}
+        else:
+            self.min, self.max = min(self.min, np.min(samples)), max(self.max, np.max(samples))
+            metadata = {"min": self.min, "max": self.max + eps}
+        self.pending.append([len(samples), metadata])
+        return encode_normalize(samples, self.normalize, metadata).astype(np.float32)
+
+    def _decode(self, outputs):
+        """Revert the outputs with the statistics of their inputs, the tail of flush by the last ones"""
+        if self.normalize == "none" or not self.pending:
+            return outputs
+        start = 0
+        while start < len(outputs):
+            count, metadata = self.pending[0]
+            end = len(outputs) if len(self.pending) == 1 else min(start + count, len(outputs))
+            outputs[start:end] = decode_normalize(outputs[start:end], self.normalize, metadata)
+            self.pending[0][0] -= end - start
+            if self.pending[0][0] <= 0 and len(self.pending) > 1:
+                self.pending.pop(0)
+            start = end
+        return outputs
+
+    def _enhance_frames(self, num_frames):
+        """num_frames frames of the buffer, returns hop_length * num_frames samples"""
+        index = np.arange(num_frames)[:, np.newaxis] * self.hop_length + np.arange(self.n_fft)
+        spectrum = np.fft.rfft(self.buffer[index] * self.window, axis=-1)
+        if self.fft_normalization:
+            spectrum /= self.n_fft
+        self.buffer = self.buffer[num_frames * self.hop_length :]
+
+        start = time.perf_counter()
+        spectrum = self._step(spectrum[np.newaxis, np.newaxis].astype(np.complex64)).numpy()[0, 0]
+        self.frame_times.append((time.perf_counter() - start) / num_frames)
+
+        if self.fft_normalization:
+            spectrum *= self.n_fft
+        frames = np.fft.irfft(spectrum, n=self.n_fft, axis=-1) * self.synthesis_window
+
+        # overlap-add, the first hop_length samples are complete after each frame
+        outputs = np.empty(num_frames * self.hop_length, dtype=np.float32)
+        for i, frame in enumerate(frames):
+            self.overlap += frame
+            outputs[i * self.hop_length : (i + 1) * self.hop_length] = self.overlap[: self.hop_length]
+            self.overlap = np.concatenate([self.overlap[self.hop_length :], np.zeros(self.hop_length, np.float32)])
+        return outputs
+
+    def _trim(self, outputs):
+        trim = min(self.trim, len(outputs))
+        self.trim -= trim
+        return outputs[trim:]
+
+    def process(self, samples):
+        """Enhanced samples of the frames completed by the chunk, [samples] -> [hop_length * frames]"""
+        start = time.perf_counter()
+        samples = self._encode(np.asarray(samples, dtype=np.float32))
+        self.buffer = np.concatenate([self.buffer, samples])
+        outputs = []
+        while len(self.buffer) >= self.n_fft + (self.frames - 1) * self.hop_length:
+            outputs.append(self._enhance_frames(self.frames))
+        outputs = self._decode(self._trim(np.concatenate(outputs))) if outputs else np.zeros(0, dtype=np.float32)
+        self.chunk_times.append(time.perf_counter() - start)
+        return outputs
+
+    def flush(self):
+        """The rest of the utterance, then reset"""
+        # zeros of center padding at the end, frames as pad_end=False of stft_tensorflow
+        self.buffer = np.concatenate([self.buffer, np.zeros(self.n_fft // 2 if self.center else 0, np.float32)])
+        outputs = []
+        num_frames = (len(self.buffer) - self.n_fft) // self.hop_length + 1
+        if num_frames > 0:
+            outputs.append(self._enhance_frames(num_frames))
+        outputs.append(self.overlap[: self.n_fft - self.hop_length])
+        outputs = self._decode(self._trim(np.concatenate(outputs)))
+
+        frame_times, chunk_times = self.frame_times, self.chunk_times
+        self.reset()
+        self.frame_times, self.chunk_times = frame_times, chunk_times
+        return outputs
+
+    def enhance(self, audio, chunk=None):
+        """Whole utterance in chunks of samples(default hop_length), the same length as audio"""
+        chunk = chunk or self.hop_length
+        outputs = [self.process(audio[start : start + chunk]) for start in range(0, len(audio), chunk)]
+        outputs.append(self.flush())
+        return np.concatenate(outputs)[: len(audio)]
+
+
+def streaming(args):
+    from src.distrib import load_model
+    from src.preprocess.VoiceBankDEMAND import VoiceBandDEMAND
+
+    config = getattr(args, "streaming", None)
+    frames = getattr(config, "frames", None) or 1
+    num_files = getattr(config, "files", None) or 10
+
+    enhancer = StreamingEnhancer(load_model(args), args, frames=frames)
+    cache = AudioCache.from_args(args.dset)
+    resample_method = getattr(args.dset, "resample", None) or "resampy"
+
+    _, noisy_filenames = VoiceBandDEMAND(args.test.wav, val_dataset_percent=0).get_test_filenames()
+
+    # tf.function tracing
+    enhancer.enhance(np.random.randn(enhancer.n_fft * 4).astype(np.float32))
+    enhancer.frame_times, enhancer.chunk_times = [], []
+
+    duration, elapsed = 0.0, 0.0
+    for noisy_file in noisy_filenames[:num_files]:
+        noisy_audio, sr = read_audio(noisy_file, args.dset.sample_rate, cache, resample_method)
+
+        start = time.perf_counter()
+        enhancer.enhance(noisy_audio)
+        elapsed += time.perf_counter() - start
+        duration += len(noisy_audio) / sr
+
+    frame_times = np.array(enhancer.frame_times) * 1000
+    chunk_times = np.array(enhancer.chunk_times) * 1000
+    hop = enhancer.hop_length / enhancer.sample_rate * 1000
+    algorithmic = enhancer.latency * 1000 + (frames - 1) * hop
+    print(f"Files: {num_files}, {duration:.1f} sec of audio, {frames} frames per call")
+    print(f"Real time factor: {elapsed / duration:.3f}")
+    print(f"Model: {np.mean(frame_times):.3f} ms/frame(mean), {np.percentile(frame_times, 99):.3f} ms/frame(p99), hop {hop:.1f} ms")
+    print(f"Chunk of {hop:.1f} ms: {np.mean(chunk_times):.3f} ms(mean), {np.percentile(chunk_times, 99):.3f} ms(p99), {np.max(chunk_times):.3f} ms(max)")
+    print(f"Latency: {algorithmic:.1f} ms algorithmic + {np.percentile(chunk_times, 99):.3f} ms of a chunk(p99)")
+    return elapsed / duration, frame_times, chunk_times
+
+
+def main(gpu_size, path_conf):
+    limit_gpu_tf(gpu_size)
+    config = load_yaml(path_conf)
+    streaming(config)
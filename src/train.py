@@ -12,7 +12,15 @@ import tensorflow as tf
 from tensorflow.python.client import device_lib
 
 # custom api
-from src.distrib import load_dataset, load_model, load_callback
+from src.distrib import (
+    load_dataset,
+    load_model,
+    load_callback,
+    get_steps_per_epoch,
+    fit_with_checkpoint,
+    InputStallMonitor,
+)
+from src.model.evaluation import AsyncSpeechEvaluation
 from src.utils import load_yaml, obj2dict, limit_gpu_tf
 
 
@@ -43,6 +51,11 @@ def train(args):
         args.folder, model_name, datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     )
     callbacks_list = load_callback(save_path, args)
+    if getattr(args, "input_stall", None):
+        callbacks_list.append(InputStallMonitor(threshold=args.input_stall))
+    if getattr(getattr(args, "evaluation", None), "metric", None):
+        # pesq, stoi and sdr in background processes, training doesn't wait for them
+        callbacks_list.append(AsyncSpeechEvaluation(test_dataset, save_path, args))
     print("Save path: ", save_path)
 
     # 5. Evaluate model
@@ -50,13 +63,17 @@ def train(args):
     print(f"Baseline accuracy {baseline_val_loss}")
 
     # 6. Train
-    model.fit(
-        train_dataset,  # model.fit([pair_1, pair_2], labels, epochs=50)
-        steps_per_epoch=args.steps,  # you might need to change this
-        validation_data=test_dataset,
-        epochs=args.epochs,
-        callbacks=callbacks_list,
-    )
+    if getattr(getattr(args, "checkpoint", None), "steps", None):
+        # resumable, the training state is saved every checkpoint.steps
+        fit_with_checkpoint(model, train_dataset, test_dataset, callbacks_list, args)
+    else:
+        model.fit(
+            train_dataset,  # model.fit([pair_1, pair_2], labels, epochs=50)
+            steps_per_epoch=get_steps_per_epoch(args),  # args.steps, or all training batches in the record index
+            validation_data=test_dataset,
+            epochs=args.epochs,
+            callbacks=callbacks_list,
+        )
 
     # 7. Save trained model after evaluation
     val_loss = model.evaluate(test_dataset)[0]
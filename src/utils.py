@@ -1,5 +1,9 @@
+import os
 import json
+import multiprocessing
+import math
 import yaml
+import hashlib
 import time
 import numpy as np
 import typing as tp
@@ -8,9 +12,35 @@ import librosa
 # import sounddevice as sd
 # import julius # for pytorch
 from resampy import resample
+import scipy.signal as signal
 import soundfile as sf
 import tensorflow as tf
 
+class _SingleThreadProcess(multiprocessing.context.SpawnProcess):
+    def start(self):
+        # the environment of the new interpreter, openmp reads it once when it is loaded
+        environ = {key: os.environ.get(key) for key in ("OMP_NUM_THREADS",)}
+        os.environ["OMP_NUM_THREADS"] = "1"
+        try:
+            super().start()
+        finally:
+            for key, value in environ.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+
+class SingleThreadSpawnContext(multiprocessing.context.SpawnContext):
+    """spawn context of processes with OMP_NUM_THREADS=1, mp_context of ProcessPoolExecutor
+
+    OMP_NUM_THREADS set in a worker is too late, numpy, scipy and tensorflow are imported
+    before the initializer. It is set in the parent while the process starts.
+    """
+
+    Process = _SingleThreadProcess
+
+
 def limit_gpu_tf(memory_size):
     """Reference. https://www.tensorflow.org/guide/gpu
     """
@@ -81,14 +111,143 @@ def add_noise_to_clean_audio(clean_audio, noise_signal):
     return noisyAudio
 
 
-def read_audio(filepath, sample_rate):
+class AudioCache:
+    """On-disk cache of decoded and resampled audio
+
+    Audio is saved as float32 .npy keyed by (path, mtime, target sample rate, resample method)
+    and loaded back memory-mapped(read-only). When the total size is over
+    max_size(MB), the least recently used files are removed.
+    """
+
+    def __init__(self, path, max_size=4096):
+        self.path = path
+        self.max_size = int(max_size * 1024 * 1024)
+        self._sample_rates = {}  # filepath -> sample rate of the source file
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        self._size = sum(
+            os.path.getsize(os.path.join(self.path, file))
+            for file in os.listdir(self.path)
+            if file.endswith(".npy")
+        )
+
+    @classmethod
+    def from_args(cls, args):
+        """args.cache_path, args.cache_size in dset, None if not set"""
+        path = getattr(args, "cache_path", None)
+        if not path:
+            return None
+        return cls(path, getattr(args, "cache_size", None) or 4096)
+
+    def _key(self, filepath, sample_rate, method):
+        filepath = os.path.abspath(filepath)
+        mtime = os.stat(filepath).st_mtime_ns
+        key = f"{filepath}:{mtime}:{sample_rate}:{method}"
+        key = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, f"{key}.npy")
+
+    def get(self, filepath, sample_rate, method="resampy"):
+        cache_file = self._key(filepath, sample_rate, method)
+        try:
+            audio = np.load(cache_file, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None, None
+        os.utime(cache_file)  # recently used
+
+        if filepath not in self._sample_rates:
+            self._sample_rates[filepath] = sf.info(filepath).samplerate
+        return audio, self._sample_rates[filepath]
+
+    def put(self, filepath, sample_rate, method, audio, sr):
+        cache_file = self._key(filepath, sample_rate, method)
+        tmp_file = f"{cache_file[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+        audio = np.asarray(audio, dtype=np.float32)
+        np.save(tmp_file, audio)
+        os.replace(tmp_file, cache_file)  # atomic for the other workers
+
+        self._sample_rates[filepath] = sr
+        self._size += os.path.getsize(cache_file)
+        if self._size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        files = []
+        for file in os.listdir(self.path):
+            if file.endswith(".npy") and ".tmp" not in file:
+                file = os.path.join(self.path, file)
+                try:
+                    st = os.stat(file)
+                except FileNotFoundError:  # removed by the other worker
+                    continue
+                files.append((st.st_mtime, st.st_size, file))
+        files.sort()
+
+        self._size = sum(size for _, size, _ in files)
+        target = int(self.max_size * 0.9)
+        for _, size, file in files:
+            if self._size <= target:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+
+def resample_audio(audio, sr, sample_rate, method="resampy"):
+    """Resample audio along the last axis
+
+    Args:
+        method:
+            'resampy': band-limited sinc interpolation, high quality and slow
+            'polyphase': scipy.signal.resample_poly with the reduced ratio, ex. 48k->16k is 1/3, 44.1k->16k is 160/441
+
+    The audio is returned as it is if the sample rates are the same.
+    """
+    if sr == sample_rate:
+        return audio
+
+    if method == "resampy":
+        audio = resample(audio, sr, sample_rate, axis=-1)
+    elif method == "polyphase":
+        gcd = math.gcd(int(sr), int(sample_rate))
+        audio = signal.resample_poly(
+            audio, int(sample_rate) // gcd, int(sr) // gcd, axis=-1
+        )
+    else:
+        raise ValueError(f"Invalid resample method: {method}")
+    return audio
+
+
+def read_audio(filepath, sample_rate, cache=None, method="resampy"):
+    """Read and resample audio
+
+    Args:
+        cache: AudioCache, if given a warm cache returns memory-mapped(read-only) float32 audio
+        method: resample method, 'resampy' or 'polyphase'
+
+    Returns:
+        audio, sample rate of the file
+    """
+    if cache is not None:
+        audio, sr = cache.get(filepath, sample_rate, method)
+        if audio is not None:
+            return audio, sr
+
     # audio, sr = librosa.load(filepath, sr=sample_rate)
     # if normalize is True:
     #     div_fac = 1 / np.max(np.abs(audio)) / 3.0
     #     audio = audio * div_fac
     #     # audio = librosa.util.normalize(audio)
     audio, sr = sf.read(filepath)
-    audio = resample(audio, sr, sample_rate)
+    audio = resample_audio(audio, sr, sample_rate, method)
+
+    if cache is not None:
+        cache.put(filepath, sample_rate, method, audio, sr)
+        cached, _ = cache.get(filepath, sample_rate, method)
+        if cached is not None:  # same dtype as the warm cache
+            audio = cached
 
     return audio, sr
 
@@ -210,6 +369,121 @@ def get_tf_feature_sample_pair(noisy, clean):
     return example
 
 
+# representations which can be stored in tfrecord, feature -> keys of tf.train.Example
+FEATURES = {
+    "pcm": ("noisy", "clean"),
+    "real_imag": ("noisy_stft_real", "clean_stft_real", "noisy_stft_imag", "clean_stft_imag"),
+    "mag_phase": (
+        "noisy_stft_magnitude",
+        "clean_stft_magnitude",
+        "noisy_stft_phase",
+        "clean_stft_phase",
+    ),
+    "mel": ("noisy_mel", "clean_mel"),
+}
+
+
+def get_feature_plan(args):
+    """Features to store in preprocess, dset.features or real_imag/pcm by dset.fft"""
+    features = getattr(args, "features", None)
+    if not features:
+        features = ["real_imag"] if args.fft else ["pcm"]
+    features = list(features)
+    for feature in features:
+        if feature not in FEATURES:
+            raise ValueError(f"Feature {feature} is not in {list(FEATURES.keys())}...")
+    return features
+
+
+def get_dataset_path(args):
+    """Folder of the records for the preprocess parameters in args.dset"""
+    segment = str(args.dset.segment).replace(".", "-")
+    train_split = int(args.dset.split * 100)
+    seg_normalization = args.dset.segment_normalization if args.dset.segment_normalization else False
+    path_to_dataset = (
+        f"{args.dset.save_path}/records_seg_{segment}_train_{train_split}_norm_{args.dset.normalize}"
+        f"_segNorm_{seg_normalization}_fft_{args.dset.fft}_topdB_{args.dset.top_db}"
+    )
+    if getattr(args.dset, "full_utterance", False):
+        path_to_dataset = path_to_dataset + "_utterance"
+    if args.debug:
+        path_to_dataset = path_to_dataset + "_debug"
+    return path_to_dataset
+
+
+def get_num_frames(args):
+    """The number of frames of the model input, None for full utterances(dset.full_utterance)"""
+    if not getattr(args.dset, "full_utterance", False):
+        return int(args.dset.segment * args.dset.sample_rate // args.dset.hop_length + 1)
+
+    if args.model.name not in ("rnn", "lstm", "gru", "crn"):
+        raise ValueError(f"Full utterance is not supported by {args.model.name}, only rnn, lstm, gru and crn...")
+    if get_frontend(args) == "model":
+        raise ValueError("Full utterance needs the frontend precomputed or pipeline...")
+    return None
+
+
+def get_frontend(args):
+    """Where stft is computed, model.frontend
+
+    - precomputed: stft in preprocess, real_imag in records
+    - pipeline: stft of pcm records in tf.data
+    - model: stft/inverse stft layers in the model, wav in and wav out
+
+    If not set, precomputed if real_imag is stored, else pipeline.
+    unet and conv-tasnet take wav, so they are always model.
+    """
+    feature_plan = get_feature_plan(args.dset)
+    frontend = getattr(args.model, "frontend", None)
+    if args.model.name in ("unet", "conv-tasnet"):
+        frontend = "model"
+    elif frontend is None:
+        frontend = "precomputed" if "real_imag" in feature_plan else "pipeline"
+
+    if frontend not in ("precomputed", "pipeline", "model"):
+        raise ValueError(f"Frontend {frontend} should be precomputed, pipeline or model...")
+    if frontend == "precomputed" and "real_imag" not in feature_plan:
+        raise ValueError(f"Frontend {frontend} needs real_imag in features, but {feature_plan}...")
+    if frontend != "precomputed" and "pcm" not in feature_plan:
+        raise ValueError(f"Frontend {frontend} needs pcm in features, but {feature_plan}...")
+    return frontend
+
+
+def encode_pcm16(audio):
+    """Samples to int16 with a scale, audio ~= pcm * scale"""
+    scale = float(np.max(np.abs(audio))) / 32767 if audio.size else 0.0
+    if scale == 0.0:
+        scale = 1.0
+    pcm = np.round(audio / scale).astype(np.int16)
+    return pcm, scale
+
+
+def get_tf_feature_dict(features, precision="float32"):
+    """Serialize arrays as bytes
+
+    Args:
+        features: dict, key -> numpy array
+        precision: 'float32' or 'compact', compact stores samples(pcm) as int16
+            with a scale "{key}_scale" and the other features as float16
+    """
+    if precision not in ("float32", "compact"):
+        raise ValueError(f"Precision {precision} should be float32 or compact...")
+
+    feature = {}
+    for key, value in features.items():
+        if precision == "compact" and key in FEATURES["pcm"]:
+            value, scale = encode_pcm16(value)
+            feature[f"{key}_scale"] = _float_feature(scale)
+        elif precision == "compact":
+            value = value.astype(np.float16)
+        else:
+            value = value.astype(np.float32)
+        feature[key] = _bytes_feature(np.ascontiguousarray(value).tobytes())
+
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example
+
+
 def stft_tensorflow(wav, nfft, hop_length, center=True, normalize=True):
     if center:
         padding = [(0, 0) for _ in range(len(wav.get_shape()))]
@@ -340,6 +614,41 @@ def save_json(data: tp.Dict[str, tp.List[np.ndarray]], path: str, *args, **kwarg
         json.dump(data, tmp, cls=NumpyEncoder, *args, **kwargs)
 
 
+def save_optimizer_state(path, model):
+    """Optimizer state of the model in a tf checkpoint, {path}/optimizer/state.*
+
+    The checkpoint is binary and read lazily by variable, the model is in it
+    only to match the slots with the variables of the model.
+    """
+    tf.train.Checkpoint(model=model, optimizer=model.optimizer).write(
+        os.path.join(path, "optimizer", "state")
+    )
+
+
+def load_optimizer_state(path, model, optimizer):
+    """Restore the optimizer state saved by save_optimizer_state
+
+    The slots of optimizer are created for the model first, so the state is in
+    the optimizer right after loading. The weights of model are not changed.
+
+    Returns:
+        False if there is no saved state
+    """
+    prefix = os.path.join(path, "optimizer", "state")
+    if not tf.io.gfile.exists(f"{prefix}.index"):
+        return False
+
+    if hasattr(optimizer, "build"):
+        optimizer.build(model.trainable_variables)
+    else:  # OptimizerV2
+        optimizer._create_all_weights(model.trainable_variables)
+
+    weights = model.get_weights()
+    tf.train.Checkpoint(model=model, optimizer=optimizer).restore(prefix).expect_partial()
+    model.set_weights(weights)
+    return True
+
+
 def obj2dict(obj):
     if not hasattr(obj, "__dict__"):
         return obj
@@ -434,7 +743,7 @@ def encode_normalize(wav, normalize, metadata=None):
 def encode_normalize_with_metadata(wav, normalize, metadata):
     if normalize == "z-score":
         wav = (wav - metadata["mean"]) / (metadata["std"])
-    elif normalize == "linear-scale":
+    elif normalize in ("linear-scale", "min-max"):
         wav = (wav - metadata["min"]) / (metadata["max"] - metadata["min"])
     elif normalize == "clip":
         NotImplementedError
@@ -445,13 +754,27 @@ def encode_normalize_with_metadata(wav, normalize, metadata):
     return wav
 
 
+def normalize_audio(wav, normalize):
+    """encode_normalize of an utterance as preprocess(dset.normalize), and the metadata to revert it
+
+    Returns:
+        wav, metadata of decode_normalize
+    """
+    metadata = {}
+    if normalize == "z-score":
+        metadata = {"mean": np.mean(wav, axis=-1, keepdims=True), "std": np.std(wav, axis=-1, keepdims=True)}
+    elif normalize == "min-max":
+        metadata = {"min": np.min(wav, axis=-1, keepdims=True), "max": np.max(wav, axis=-1, keepdims=True)}
+    return encode_normalize(wav, normalize), metadata
+
+
 def decode_normalize(wav, normalize, metadata):
     """
     Refernence. https://developers.google.com/machine-learning/data-prep/transform/normalization
     """
     if normalize == "z-score":
         wav = wav * metadata["std"] + metadata["mean"]
-    elif normalize == "linear-scale":
+    elif normalize in ("linear-scale", "min-max"):
         wav = wav * (metadata["max"] - metadata["min"]) + metadata["min"]
     elif normalize == "clip":
         NotImplementedError
@@ -464,45 +787,39 @@ def decode_normalize(wav, normalize, metadata):
     return wav
 
 
-def segment_audio(audio, sample_rate, segment):
-    # sec
-    length_audio = audio.shape[-1]
-    num_sample_segment = int(segment * sample_rate)
-    nsegment = length_audio // num_sample_segment
+def segment_audio(audio, sample_rate, segment, hop=None, pad="drop"):
+    """Split audio into segments, [..., samples] -> [..., nsegment, segment samples]
 
-    if length_audio / sample_rate < segment:
-        padding = np.zeros(shape=(len(audio.shape)*2, ), dtype=int)
-        padding[-1] = num_sample_segment - length_audio
-        padding = np.reshape(a=padding, newshape=(len(audio.shape), 2))
-        audio = np.pad(
-            array=audio, pad_width=padding, mode="constant", constant_values=0
-        )
-        length_audio = audio.shape[-1]
-        nsegment = length_audio // num_sample_segment
+    The segments are a read-only strided view of the audio, it only copies when
+    the audio should be padded.
 
-    elif length_audio % num_sample_segment != 0:
-        audio = audio[: nsegment * num_sample_segment]
+    Args:
+        segment: the length of segment(sec)
+        hop: the interval between the starts of segments(sec), default segment(no overlap)
+        pad: policy for the last partial segment
+            'drop': drop it, but audio shorter than a segment is zero-padded to one segment
+            'zero': zero-pad it to a full segment
+    """
+    num_sample_segment = int(segment * sample_rate)
+    num_sample_hop = int(hop * sample_rate) if hop else num_sample_segment
+    length_audio = audio.shape[-1]
 
-    newshape = list(audio.shape)
-    if len(newshape) == 1:
-        newshape = [nsegment, num_sample_segment]
+    if pad == "drop":
+        nsegment = max((length_audio - num_sample_segment) // num_sample_hop + 1, 1)
+    elif pad == "zero":
+        nsegment = max(-(-(length_audio - num_sample_segment) // num_sample_hop), 0) + 1
     else:
-        newshape = [audio.shape[:-1]] + [nsegment, num_sample_segment]
+        raise ValueError(f"Invalid pad policy: {pad}")
 
-    audio = np.reshape(audio, newshape=newshape)  # ..., segment, samples
+    length_segments = (nsegment - 1) * num_sample_hop + num_sample_segment
+    if length_segments > length_audio:
+        padding = np.zeros(shape=(len(audio.shape), 2), dtype=int)
+        padding[-1, -1] = length_segments - length_audio
+        audio = np.pad(
+            array=audio, pad_width=padding, mode="constant", constant_values=0
+        )
 
-    audio_segments = None
-    for isegment in range(audio.shape[-2]):
-        if audio_segments is None:
-            audio_segments = audio[..., isegment, :]
-        else:
-            if audio_segments.shape != audio[..., isegment, :].shape:
-                buf_audio_segment = np.expand_dims(audio[..., isegment, :], axis=0)
-                audio_segments = np.concatenate(
-                    [audio_segments, buf_audio_segment], axis=0
-                )
-            else:
-                audio_segments = np.stack(
-                    [audio_segments, audio[..., isegment, :]], axis=0
-                )
-    return audio
+    audio = np.lib.stride_tricks.sliding_window_view(
+        audio[..., :length_segments], num_sample_segment, axis=-1
+    )  # ..., samples - segment samples + 1, segment samples
+    return audio[..., ::num_sample_hop, :]
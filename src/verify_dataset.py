@@ -0,0 +1,23 @@
+import os
+from src.preprocess.record_index import verify_records
+from src.utils import load_yaml, limit_gpu_tf, get_dataset_path
+
+
+def verify_dataset(args):
+    """Scan every record file of the dataset and rewrite its index"""
+    path_to_dataset = get_dataset_path(args)
+    if not os.path.isdir(path_to_dataset):
+        raise FileNotFoundError(f"Dataset {path_to_dataset} is not existed, run preprocess first...")
+
+    print("Data path: ", path_to_dataset)
+    index = verify_records(path_to_dataset, getattr(args.dset, "compression", None))
+
+    corrupted = [name for name, entry in index["files"].items() if entry["error"] is not None]
+    print(f"Corrupted files: {len(corrupted)}/{len(index['files'])}")
+    return index
+
+
+def main(gpu_size, path_conf):
+    limit_gpu_tf(gpu_size)
+    config = load_yaml(path_conf)
+    verify_dataset(config)
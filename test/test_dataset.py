@@ -1,3 +1,4 @@
+import os
 import unittest
 import numpy as np
 from src.utils import load_yaml, inverse_stft_transform
@@ -6,6 +7,95 @@ from src.preprocess.feature_extractor import FeatureExtractor
 save_path = "./test/result/test_model"
 
 
+def _make_wav_pairs(folder, num_files, sample_rate=16000, seconds=2.5):
+    """clean/noisy wav pairs of random noise, same file names as VoiceBankDEMAND
+
+    seconds: length of every file, or a list of the length of each file
+    """
+    import soundfile as sf
+
+    clean_filenames, noisy_filenames = [], []
+    for subset in ("clean", "noisy"):
+        os.makedirs(os.path.join(folder, subset), exist_ok=True)
+    lengths = np.broadcast_to(seconds, num_files)
+    for i in range(num_files):
+        clean = 0.1 * np.random.randn(int(lengths[i] * sample_rate))
+        noisy = clean + 0.05 * np.random.randn(*clean.shape)
+        for subset, audio, filenames in (
+            ("clean", clean, clean_filenames),
+            ("noisy", noisy, noisy_filenames),
+        ):
+            filename = os.path.join(folder, subset, f"p{i:03d}_001.wav")
+            sf.write(filename, audio, sample_rate)
+            filenames.append(filename)
+    return clean_filenames, noisy_filenames
+
+
+def _preprocess_args(folder, **kwargs):
+    """dset of conf/config.yaml writing records in folder, without the audio cache"""
+    args = load_yaml("./conf/config.yaml").dset
+    args.save_path = folder
+    args.cache_path = None
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def _preprocess(folder, clean_filenames, noisy_filenames, prefix="train", **kwargs):
+    """create_tf_record in the main process, returns the record folder"""
+    import glob
+    from src.preprocess.dataset import DatasetVoiceBank
+
+    args = _preprocess_args(folder, num_workers=0, **kwargs)
+    os.makedirs(folder, exist_ok=True)
+    DatasetVoiceBank(clean_filenames, noisy_filenames, "lstm", args).create_tf_record(prefix=prefix)
+    (record_folder,) = glob.glob(os.path.join(folder, "records_*"))
+    return record_folder
+
+
+def _dataset_args(folder, num_files=(8, 4), num_shards=1, seconds=2.5, **kwargs):
+    """conf/config.yaml with train/val records of synthetic wav pairs in folder
+
+    Args:
+        num_files: the number of train and val wav pairs
+        num_shards: record files of each of train/val
+        seconds: length of wav files, see _make_wav_pairs
+        kwargs: parameters of dset, also used in preprocess
+    """
+    import shutil
+
+    args = load_yaml("./conf/config.yaml")
+    args.debug = False
+    args.batch_size = 4
+    args.dset.save_path = folder
+    args.dset.cache_path = None
+    for key, value in kwargs.items():
+        setattr(args.dset, key, value)
+
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    for prefix, num in zip(("train", "val"), num_files):
+        clean_filenames, noisy_filenames = _make_wav_pairs(os.path.join(folder, f"wav_{prefix}"), num, seconds=seconds)
+        _preprocess(folder, clean_filenames, noisy_filenames, prefix, num_shards=num_shards, **kwargs)
+    return args
+
+
+def _read_records(folder, prefix):
+    """Records of prefix in folder, (key, serialized feature) of each record
+
+    The order of the features of a serialized example may differ between processes.
+    """
+    import glob
+    import tensorflow as tf
+
+    files = sorted(glob.glob(os.path.join(folder, f"{prefix}_*.tfrecords")))
+    records = []
+    for record in tf.data.TFRecordDataset(files):
+        features = tf.train.Example.FromString(record.numpy()).features.feature
+        records.append(tuple(sorted((key, value.SerializeToString()) for key, value in features.items())))
+    return records
+
+
 class DatasetSanityCheck(unittest.TestCase):
     def test_load(self):
         """python -m unittest -v test.test_dataset.DatasetSanityCheck.test_load"""
@@ -24,7 +114,7 @@ class DatasetSanityCheck(unittest.TestCase):
         """
         python -m unittest -v test.test_dataset.DatasetSanityCheck.test_fit_model
         """
-        from src.distrib import load_dataset, load_model
+        from src.distrib import load_dataset, load_model, get_steps_per_epoch
 
         path_conf = "./conf/config.yaml"
         args = load_yaml(path_conf)
@@ -38,11 +128,840 @@ class DatasetSanityCheck(unittest.TestCase):
 
         model.fit(
             train_dataset,
-            steps_per_epoch=args.steps,
+            steps_per_epoch=get_steps_per_epoch(args),
             validation_data=test_dataset,
             epochs=args.epochs,
         )
 
 
+class RecordWriterSanityCheck(unittest.TestCase):
+    def test_sharded_writer(self):
+        """python -m unittest -v test.test_dataset.RecordWriterSanityCheck.test_sharded_writer"""
+        import os
+        import glob
+        import shutil
+        import tensorflow as tf
+        from src.utils import get_tf_feature_sample_pair
+        from src.preprocess.record_writer import ShardedRecordWriter
+
+        folder = os.path.join(save_path, "records")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+
+        examples = [
+            get_tf_feature_sample_pair(
+                np.random.randn(16384).astype(np.float32),
+                np.random.randn(16384).astype(np.float32),
+            )
+            for _ in range(10)
+        ]
+
+        with ShardedRecordWriter(folder, "train", num_shards=3) as writer:
+            for example in examples:
+                writer.write(example)
+        with ShardedRecordWriter(folder, "val", shard_size=0.2) as writer:
+            for example in examples:
+                writer.write(example)
+
+        train_files = sorted(glob.glob(os.path.join(folder, "train_*")))
+        val_files = sorted(glob.glob(os.path.join(folder, "val_*")))
+        self.assertEqual(len(train_files), 3)
+        self.assertGreater(len(val_files), 1)
+
+        for files in (train_files, val_files):
+            dataset = tf.data.Dataset.from_tensor_slices(files).interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=len(files),
+            )
+            self.assertEqual(len(list(dataset)), len(examples))
+
+    def test_compact_precision(self):
+        """python -m unittest -v test.test_dataset.RecordWriterSanityCheck.test_compact_precision"""
+        import os
+        import glob
+        import shutil
+        import tensorflow as tf
+        from src.utils import get_tf_feature_dict
+        from src.preprocess.record_writer import ShardedRecordWriter
+
+        folder = os.path.join(save_path, "records_compact")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+
+        audio = np.random.randn(16384).astype(np.float32)
+        spectrum = np.random.randn(129, 129).astype(np.float32)
+        example = get_tf_feature_dict(
+            {"noisy": audio, "noisy_stft_real": spectrum}, precision="compact"
+        )
+        with ShardedRecordWriter(folder, "train", num_shards=1, compression="GZIP") as writer:
+            writer.write(example)
+
+        files = glob.glob(os.path.join(folder, "train_*"))
+        record = next(iter(tf.data.TFRecordDataset(files, compression_type="GZIP")))
+        features = tf.io.parse_single_example(
+            record,
+            {
+                "noisy": tf.io.FixedLenFeature((), tf.string),
+                "noisy_scale": tf.io.FixedLenFeature((), tf.float32),
+                "noisy_stft_real": tf.io.FixedLenFeature((), tf.string),
+            },
+        )
+        noisy = tf.cast(tf.io.decode_raw(features["noisy"], tf.int16), tf.float32)
+        noisy = noisy * features["noisy_scale"]
+        noisy_stft_real = tf.io.decode_raw(features["noisy_stft_real"], tf.float16)
+
+        self.assertLess(np.max(np.abs(noisy.numpy() - audio)), np.max(np.abs(audio)) / 16384)
+        np.testing.assert_allclose(
+            noisy_stft_real.numpy().astype(np.float32).reshape(spectrum.shape),
+            spectrum,
+            rtol=1e-3,
+            atol=1e-3,
+        )
+
+    def test_record_index(self):
+        """python -m unittest -v test.test_dataset.RecordWriterSanityCheck.test_record_index"""
+        import os
+        import glob
+        import shutil
+        from src.utils import get_tf_feature_dict
+        from src.preprocess.record_writer import ShardedRecordWriter
+        from src.preprocess.record_index import update_index, verify_records
+
+        folder = os.path.join(save_path, "records_index")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+
+        with ShardedRecordWriter(folder, "train", num_shards=2) as writer:
+            for _ in range(10):
+                audio = np.random.randn(1024).astype(np.float32)
+                writer.write(get_tf_feature_dict({"noisy": audio, "clean": audio}))
+
+        index = verify_records(folder)
+        self.assertEqual(sum(entry["count"] for entry in index["files"].values()), 10)
+        self.assertTrue(all(entry["error"] is None for entry in index["files"].values()))
+
+        # unchanged files are not scanned, and the index is not rewritten
+        mtime = os.stat(os.path.join(folder, "index.json")).st_mtime_ns
+        self.assertEqual(verify_records(folder, force=False), index)
+        self.assertEqual(os.stat(os.path.join(folder, "index.json")).st_mtime_ns, mtime)
+
+        # flip a byte in the last record of a file
+        filename = sorted(glob.glob(os.path.join(folder, "train_*.tfrecords")))[0]
+        with open(filename, "rb") as tmp:
+            data = bytearray(tmp.read())
+        data[-100] ^= 0xFF
+        with open(filename, "wb") as tmp:
+            tmp.write(data)
+
+        entry = update_index(folder, [filename])["files"][os.path.basename(filename)]
+        self.assertEqual(entry["count"], 4)
+        self.assertIn("corrupted record", entry["error"])
+
+
+class PreprocessSanityCheck(unittest.TestCase):
+    def test_process_pool(self):
+        """Records of the process pool are the same as in the main process
+
+        python -m unittest -v test.test_dataset.PreprocessSanityCheck.test_process_pool
+        """
+        import glob
+        import shutil
+        from src.preprocess.dataset import DatasetVoiceBank
+
+        folder = os.path.join(save_path, "preprocess_pool")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        clean_filenames, noisy_filenames = _make_wav_pairs(os.path.join(folder, "wav"), 6)
+
+        records = {}
+        for num_workers in (0, 2):
+            args = _preprocess_args(
+                os.path.join(folder, f"workers_{num_workers}"), num_workers=num_workers, queue_size=2, num_shards=1
+            )
+            os.makedirs(args.save_path)
+            DatasetVoiceBank(clean_filenames, noisy_filenames, "lstm", args).create_tf_record(prefix="train")
+            (record_folder,) = glob.glob(os.path.join(args.save_path, "records_*"))
+            # the order of files differs with the workers
+            records[num_workers] = sorted(_read_records(record_folder, "train"))
+
+        # 2 segments of 1.024 sec in 2.5 sec
+        self.assertEqual(len(records[0]), 12)
+        self.assertEqual(records[0], records[2])
+
+    def test_manifest_resume(self):
+        """A crashed run is resumed to the same records as a clean run
+
+        python -m unittest -v test.test_dataset.PreprocessSanityCheck.test_manifest_resume
+        """
+        import json
+        import shutil
+        from src.preprocess.manifest import record_name
+
+        folder = os.path.join(save_path, "preprocess_resume")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        clean_filenames, noisy_filenames = _make_wav_pairs(os.path.join(folder, "wav"), 3)
+
+        # legacy, one file per segment
+        expected = _read_records(
+            _preprocess(os.path.join(folder, "clean_run"), clean_filenames, noisy_filenames, shard_size=None),
+            "train",
+        )
+        record_folder = _preprocess(os.path.join(folder, "legacy"), clean_filenames, noisy_filenames, shard_size=None)
+
+        # crash while writing the last pair, its entry is not in the manifest
+        manifest_path = os.path.join(record_folder, "manifest_train.jsonl")
+        with open(manifest_path, "r") as tmp:
+            lines = [line for line in tmp if clean_filenames[-1] not in line]
+        with open(manifest_path, "w") as tmp:
+            tmp.writelines(lines)
+        partial = os.path.join(record_folder, f"train_{record_name(clean_filenames[-1])}_1.tfrecords")
+        with open(partial, "r+b") as tmp:
+            tmp.truncate(os.path.getsize(partial) // 2)
+
+        _preprocess(os.path.join(folder, "legacy"), clean_filenames, noisy_filenames, shard_size=None)
+        self.assertEqual(sorted(_read_records(record_folder, "train")), sorted(expected))
+
+        # sharded, a crashed run of the last pair left its tag and a shard without entries
+        record_folder = _preprocess(
+            os.path.join(folder, "sharded"), clean_filenames[:-1], noisy_filenames[:-1], num_shards=1
+        )
+        with open(os.path.join(record_folder, "manifest_train.jsonl"), "a") as tmp:
+            tmp.write(json.dumps({"run": "20000101-000000", "params": {}}) + "\n")
+        with open(os.path.join(record_folder, "train_20000101-000000_00000-of-00001.tfrecords"), "wb") as tmp:
+            tmp.write(b"partial")
+
+        _preprocess(os.path.join(folder, "sharded"), clean_filenames, noisy_filenames, num_shards=1)
+        self.assertFalse(os.path.exists(os.path.join(record_folder, "train_20000101-000000_00000-of-00001.tfrecords")))
+        self.assertEqual(sorted(_read_records(record_folder, "train")), sorted(expected))
+
+    def test_manifest_changed_file(self):
+        """Only the records of a changed wav file are written again
+
+        python -m unittest -v test.test_dataset.PreprocessSanityCheck.test_manifest_changed_file
+        """
+        import json
+        import shutil
+        import soundfile as sf
+
+        folder = os.path.join(save_path, "preprocess_changed")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        clean_filenames, noisy_filenames = _make_wav_pairs(os.path.join(folder, "wav"), 3)
+
+        record_folder = _preprocess(os.path.join(folder, "legacy"), clean_filenames, noisy_filenames, shard_size=None)
+        records = sorted(_read_records(record_folder, "train"))
+        mtimes = {file: os.stat(os.path.join(record_folder, file)).st_mtime_ns for file in os.listdir(record_folder)}
+
+        # nothing to do
+        _preprocess(os.path.join(folder, "legacy"), clean_filenames, noisy_filenames, shard_size=None)
+        self.assertEqual(sorted(_read_records(record_folder, "train")), records)
+
+        audio, sample_rate = sf.read(noisy_filenames[0])
+        sf.write(noisy_filenames[0], audio[::-1], sample_rate)
+        _preprocess(os.path.join(folder, "legacy"), clean_filenames, noisy_filenames, shard_size=None)
+
+        expected = _read_records(
+            _preprocess(os.path.join(folder, "clean_run"), clean_filenames, noisy_filenames, shard_size=None),
+            "train",
+        )
+        self.assertEqual(sorted(_read_records(record_folder, "train")), sorted(expected))
+        self.assertNotEqual(sorted(expected), records)
+
+        with open(os.path.join(record_folder, "manifest_train.jsonl"), "r") as tmp:
+            entries = [json.loads(line) for line in tmp]
+        self.assertEqual(len(entries), 3)
+        for entry in entries:
+            for file, _ in entry["records"]:
+                written = os.stat(os.path.join(record_folder, file)).st_mtime_ns != mtimes[file]
+                self.assertEqual(written, entry["clean"] == clean_filenames[0])
+
+    def test_feature_plan(self):
+        """Only the features in dset.features are computed
+
+        python -m unittest -v test.test_dataset.PreprocessSanityCheck.test_feature_plan
+        """
+        import shutil
+        from src.utils import FEATURES, get_feature_plan
+        from src.preprocess.dataset import DatasetVoiceBank
+
+        folder = os.path.join(save_path, "preprocess_features")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        clean_filenames, noisy_filenames = _make_wav_pairs(os.path.join(folder, "wav"), 1)
+        pair = (clean_filenames[0], noisy_filenames[0])
+
+        self.assertEqual(get_feature_plan(_preprocess_args(folder, features=None, fft=True)), ["real_imag"])
+        self.assertEqual(get_feature_plan(_preprocess_args(folder, features=None, fft=False)), ["pcm"])
+        with self.assertRaises(ValueError):
+            get_feature_plan(_preprocess_args(folder, features=["stft"]))
+
+        outputs = {}
+        for features in (["pcm"], ["real_imag"], ["mag_phase"], ["pcm", "real_imag", "mel"]):
+            args = _preprocess_args(folder, features=features)
+            _, data = DatasetVoiceBank([], [], "lstm", args).audio_process(pair)
+            self.assertEqual(set(data.keys()), set(key for feature in features for key in FEATURES[feature]))
+            outputs.update(data)
+
+        # 2 segments of 1.024 sec, [segment, frame, frequency]
+        num_frames = int(1.024 * 16000) // args.hop_length + 1
+        self.assertEqual(outputs["noisy"].shape, (2, 16384))
+        self.assertEqual(outputs["noisy_stft_real"].shape, (2, num_frames, args.n_fft // 2 + 1))
+        self.assertEqual(outputs["noisy_mel"].shape[:-1], (2, num_frames))
+        np.testing.assert_allclose(
+            outputs["noisy_stft_magnitude"],
+            np.hypot(outputs["noisy_stft_real"], outputs["noisy_stft_imag"]),
+            rtol=1e-5,
+        )
+
+
+class PipelineSanityCheck(unittest.TestCase):
+    def test_batched_parse(self):
+        """Batches of load_dataset are the same as the records parsed one by one
+
+        python -m unittest -v test.test_dataset.PipelineSanityCheck.test_batched_parse
+        """
+        import glob
+        import tensorflow as tf
+        from src.utils import stft_tensorflow, get_dataset_path
+        from src.distrib import load_dataset
+
+        args = _dataset_args(os.path.join(save_path, "pipeline_parse"))
+        _, test_dataset = load_dataset(args)
+
+        references = []
+        (filename,) = glob.glob(os.path.join(get_dataset_path(args), "val_*.tfrecords"))
+        for record in tf.data.TFRecordDataset(filename):
+            features = tf.io.parse_single_example(
+                record,
+                {"noisy": tf.io.FixedLenFeature((), tf.string), "clean": tf.io.FixedLenFeature((), tf.string)},
+            )
+            references.append(
+                [
+                    stft_tensorflow(
+                        tf.io.decode_raw(features[key], tf.float32),
+                        args.dset.n_fft,
+                        args.dset.hop_length,
+                        args.dset.center,
+                        args.model.fft_normalization,
+                    )
+                    for key in ("noisy", "clean")
+                ]
+            )
+
+        num_frames = int(args.dset.segment * args.dset.sample_rate // args.dset.hop_length + 1)
+        batches = list(test_dataset)
+        self.assertEqual(sum(noisy.shape[0] for noisy, _ in batches), len(references))
+        for noisy, clean in batches:
+            self.assertEqual(noisy.shape[1:], (1, num_frames, args.model.n_feature))
+        noisy = tf.concat([noisy for noisy, _ in batches], axis=0)
+        clean = tf.concat([clean for _, clean in batches], axis=0)
+        for i, (noisy_reference, clean_reference) in enumerate(references):
+            np.testing.assert_allclose(noisy[i, 0], noisy_reference, atol=1e-6)
+            np.testing.assert_allclose(clean[i, 0], clean_reference, atol=1e-6)
+
+    def test_cache_and_snapshot(self):
+        """Cached validation and snapshot of training have the same elements as parsing
+
+        python -m unittest -v test.test_dataset.PipelineSanityCheck.test_cache_and_snapshot
+        """
+        import glob
+        import tensorflow as tf
+        from src.utils import get_dataset_path
+        from src.distrib import load_dataset, get_input_stages
+
+        args = _dataset_args(os.path.join(save_path, "pipeline_cache"))
+        path_to_dataset = get_dataset_path(args)
+        _, test_dataset = load_dataset(args)
+        expected = np.concatenate([noisy for noisy, _ in test_dataset])
+
+        for val_cache in ("memory", "disk"):
+            args.dset.val_cache = val_cache
+            for _ in range(2):  # the second epoch from the cache
+                _, test_dataset = load_dataset(args)
+                np.testing.assert_array_equal(np.concatenate([noisy for noisy, _ in test_dataset]), expected)
+        self.assertTrue(glob.glob(os.path.join(path_to_dataset, "cache_val_*")))
+
+        # snapshot of the parsed training records, written once
+        args.dset.snapshot = True
+        train_dataset, _ = load_dataset(args)
+        (snapshot_path,) = glob.glob(os.path.join(path_to_dataset, "snapshot_train_*"))
+        mtime = os.stat(snapshot_path).st_mtime_ns
+        train_dataset, _ = load_dataset(args)
+        self.assertEqual(os.stat(snapshot_path).st_mtime_ns, mtime)
+
+        stages = get_input_stages(args)
+        (filename,), (count,) = stages["train"]
+        parsed = stages["read"](filename, count).batch(args.batch_size).map(stages["parse_batch"]).unbatch()
+        # tf.data.Dataset.load from tf 2.10
+        load = getattr(tf.data.Dataset, "load", None) or tf.data.experimental.load
+        snapshot = load(snapshot_path)
+        self.assertEqual(len(list(snapshot)), 16)
+        # the same elements, in another order
+        key = lambda element: float(tf.reduce_sum(tf.abs(element[0])))
+        np.testing.assert_allclose(
+            sorted(key(element) for element in snapshot), sorted(key(element) for element in parsed), rtol=1e-6
+        )
+        batch = next(iter(train_dataset))
+        self.assertEqual(batch[0].shape, (args.batch_size,) + tuple(expected.shape[1:]))
+
+    def test_shuffle(self):
+        """Shuffle buffer of shuffle_memory, and the order of record files every epoch
+
+        python -m unittest -v test.test_dataset.PipelineSanityCheck.test_shuffle
+        """
+        from src.distrib import load_dataset, get_input_stages
+
+        args = _dataset_args(os.path.join(save_path, "pipeline_shuffle"), num_files=(8, 2), num_shards=4)
+
+        args.dset.shuffle_memory = 1
+        get_shuffle_buffer = get_input_stages(args)["shuffle_buffer"]
+        self.assertEqual(get_shuffle_buffer(1024), 1024)
+        self.assertEqual(get_shuffle_buffer(2**20), args.batch_size)
+        args.dset.shuffle_memory = None
+        self.assertEqual(get_input_stages(args)["shuffle_buffer"](1024), 8192)
+
+        # a buffer of a batch, the order mostly comes from the order of files
+        args.dset.shuffle_memory = 1e-6
+        train_dataset, _ = load_dataset(args)
+        num_records = 16
+        elements = [
+            float(np.sum(np.abs(noisy)))
+            for noisy, _ in train_dataset.unbatch().take(4 * num_records).as_numpy_iterator()
+        ]
+        self.assertEqual(len(set(elements)), num_records)
+        epochs = [elements[i : i + num_records] for i in range(0, len(elements), num_records)]
+        self.assertGreater(len(set(tuple(epoch) for epoch in epochs)), 1)
+
+    def test_no_valid_records(self):
+        """python -m unittest -v test.test_dataset.PipelineSanityCheck.test_no_valid_records"""
+        import glob
+        from src.utils import get_dataset_path
+        from src.distrib import load_dataset
+
+        args = _dataset_args(os.path.join(save_path, "pipeline_empty"), num_files=(2, 1))
+        path_to_dataset = get_dataset_path(args)
+
+        # every record of the training file is corrupted
+        (filename,) = glob.glob(os.path.join(path_to_dataset, "train_*.tfrecords"))
+        with open(filename, "r+b") as tmp:
+            tmp.seek(8)
+            tmp.write(b"\xff" * 4)
+        with self.assertRaisesRegex(ValueError, "No valid train records"):
+            load_dataset(args)
+
+
+    def test_full_utterance(self):
+        """Records of whole utterances, batched by length and zero-padded to the longest in the batch
+
+        python -m unittest -v test.test_dataset.PipelineSanityCheck.test_full_utterance
+        """
+        from src.distrib import load_dataset, get_input_stages
+
+        seconds = [1.5, 2.2, 1.7, 3.3, 2.4, 1.6]
+        args = _dataset_args(
+            os.path.join(save_path, "pipeline_utterance"),
+            num_files=(6, 6),
+            seconds=seconds,
+            full_utterance=True,
+            buckets=[2, 3],
+        )
+        args.batch_size = 2
+        hop_length, sample_rate = args.dset.hop_length, args.dset.sample_rate
+
+        # one record of each utterance, nothing cut or padded
+        stages = get_input_stages(args)
+        self.assertTrue(stages["utterance"])
+        self.assertTrue(str(stages["path"]).endswith("_utterance"))
+        self.assertEqual(int(np.sum(stages["val"][1])), len(seconds))
+        utterances = []
+        for filename, count in zip(*stages["val"]):
+            for record in stages["read"](filename, count):
+                noisy, clean = stages["parse_utterance"](record)
+                utterances.append((noisy.numpy(), clean.numpy()))
+        expected_frames = sorted(int(sec * sample_rate) // hop_length + 1 for sec in seconds)
+        self.assertEqual(sorted(noisy.shape[-2] for noisy, _ in utterances), expected_frames)
+
+        boundaries = [int(sec * sample_rate // hop_length + 1) for sec in args.dset.buckets]
+        _, test_dataset = load_dataset(args)
+        seen = []
+        for noisy_batch, clean_batch in test_dataset.as_numpy_iterator():
+            self.assertLessEqual(len(noisy_batch), args.batch_size)
+            self.assertEqual(noisy_batch.shape, clean_batch.shape)
+            frames = []
+            for noisy, clean in zip(noisy_batch, clean_batch):
+                # the utterance of the element, then zeros to the end of the batch
+                (index,) = [
+                    i for i, (reference, _) in enumerate(utterances)
+                    if np.array_equal(reference[:, :4], noisy[:, :4])
+                ]
+                reference_noisy, reference_clean = utterances[index]
+                length = reference_noisy.shape[-2]
+                np.testing.assert_array_equal(noisy[:, :length], reference_noisy)
+                np.testing.assert_array_equal(clean[:, :length], reference_clean)
+                self.assertFalse(np.any(noisy[:, length:]))
+                self.assertFalse(np.any(clean[:, length:]))
+                frames.append(length)
+                seen.append(index)
+            self.assertEqual(noisy_batch.shape[-2], max(frames))
+            self.assertEqual(len(set(np.searchsorted(boundaries, frames, side="right"))), 1)
+        self.assertEqual(sorted(seen), list(range(len(seconds))))
+
+        train_dataset, _ = load_dataset(args)
+        noisy_batch, _ = next(iter(train_dataset))
+        self.assertEqual(noisy_batch.shape[-1], args.model.n_feature)
+
+class TrainingStateSanityCheck(unittest.TestCase):
+    def test_resume(self):
+        """Preempted in the middle of epoch and resumed from the state, conf/config.yaml with the input stall monitor
+
+        python -m unittest -v test.test_dataset.TrainingStateSanityCheck.test_resume
+        """
+        import glob
+        import signal
+        import keras
+        import tensorflow as tf
+        from src.distrib import load_dataset, load_model, fit_with_checkpoint, get_steps_per_epoch, InputStallMonitor
+
+        folder = os.path.join(save_path, "training_state")
+        args = _dataset_args(folder, num_files=(8, 2))
+        args.folder = folder
+        args.model.path = None
+        args.epochs = 1
+        args.checkpoint.path = os.path.join(folder, "state")
+        args.checkpoint.steps = 2
+        self.assertTrue(args.checkpoint.iterator)
+        self.assertTrue(args.input_stall)
+        steps_per_epoch = get_steps_per_epoch(args)
+        self.assertEqual(steps_per_epoch, 4)
+
+        class Recorder(keras.callbacks.Callback):
+            def __init__(self, preempt_at=None):
+                super().__init__()
+                self.preempt_at = preempt_at
+                self.batches, self.epoch_logs = [], []
+
+            def on_train_batch_begin(self, batch, logs=None):
+                self.batches.append(batch)
+
+            def on_train_batch_end(self, batch, logs=None):
+                if batch == self.preempt_at:
+                    os.kill(os.getpid(), signal.SIGTERM)
+
+            def on_epoch_end(self, epoch, logs=None):
+                self.epoch_logs.append(dict(logs))
+
+        # preempted after the state of step 2, saved again at the end of step 3
+        train_dataset, test_dataset = load_dataset(args)
+        model = load_model(args)
+        recorder = Recorder(preempt_at=2)
+        fit_with_checkpoint(model, train_dataset, test_dataset, [InputStallMonitor(args.input_stall), recorder], args)
+        self.assertEqual(recorder.batches, [0, 1, 2])
+        self.assertEqual(recorder.epoch_logs, [])
+        weights = model.get_weights()
+
+        latest = tf.train.latest_checkpoint(args.checkpoint.path)
+        self.assertTrue(latest.endswith("-3"))
+        names = [name for name, _ in tf.train.list_variables(latest)]
+        self.assertTrue(any(name.startswith("iterator") for name in names))
+
+        # a new process, the rest of the epoch
+        train_dataset, test_dataset = load_dataset(args)
+        model = load_model(args)
+        recorder = Recorder()
+        restored = []
+
+        class Restored(keras.callbacks.Callback):
+            def on_train_begin(self, logs=None):
+                restored.extend(self.model.get_weights())
+
+        fit_with_checkpoint(
+            model, train_dataset, test_dataset, [InputStallMonitor(args.input_stall), recorder, Restored()], args
+        )
+        for weight, restored_weight in zip(weights, restored):
+            np.testing.assert_array_equal(weight, restored_weight)
+        self.assertEqual(int(model.optimizer.iterations), steps_per_epoch)
+        self.assertEqual(recorder.batches, [3])
+        (logs,) = recorder.epoch_logs
+        self.assertIn("val_loss", logs)
+        self.assertTrue(os.path.exists(tf.train.latest_checkpoint(args.checkpoint.path) + ".index"))
+
+        # a finished state is moved aside, and the training starts from the beginning
+        recorder = Recorder()
+        fit_with_checkpoint(load_model(args), *load_dataset(args), [recorder], args)
+        self.assertEqual(recorder.batches, list(range(steps_per_epoch)))
+        self.assertEqual(len(glob.glob(f"{args.checkpoint.path}_finished_*")), 1)
+
+        # a state of another configuration is not restored
+        args.optim.lr *= 2
+        with self.assertRaisesRegex(ValueError, "another configuration"):
+            fit_with_checkpoint(load_model(args), *load_dataset(args), [], args)
+
+
+class InputBenchmarkSanityCheck(unittest.TestCase):
+    def test_bench_input(self):
+        """python -m unittest -v test.test_dataset.InputBenchmarkSanityCheck.test_bench_input"""
+        from types import SimpleNamespace
+        from src.bench_input import bench_input
+
+        args = _dataset_args(os.path.join(save_path, "bench_input"), num_files=(8, 2))
+        args.bench = SimpleNamespace(steps=4, warmup=1)
+
+        latency, seconds = bench_input(args)
+        self.assertEqual(list(latency), ["read", "batch", "parse", "stft"])
+        for value in latency.values():
+            self.assertGreaterEqual(value, 0.0)
+        self.assertGreater(seconds, 0.0)
+
+    def test_input_stall_monitor(self):
+        """Training waits on a slow input, and doesn't on an input in memory
+
+        python -m unittest -v test.test_dataset.InputBenchmarkSanityCheck.test_input_stall_monitor
+        """
+        import time
+        import keras
+        import tensorflow as tf
+        from src.distrib import InputStallMonitor
+
+        steps, delay = 8, 0.05
+        inputs = np.random.randn(steps * 4, 16).astype(np.float32)
+        targets = np.random.randn(steps * 4, 1).astype(np.float32)
+
+        def slow_batches():
+            for start in range(0, len(inputs), 4):
+                time.sleep(delay)
+                yield inputs[start : start + 4], targets[start : start + 4]
+
+        signature = (tf.TensorSpec([None, 16], tf.float32), tf.TensorSpec([None, 1], tf.float32))
+        datasets = {
+            "slow": tf.data.Dataset.from_generator(slow_batches, output_signature=signature),
+            "memory": tf.data.Dataset.from_tensor_slices((inputs, targets)).batch(4).cache().prefetch(steps),
+        }
+        ratios = {}
+        for name, dataset in datasets.items():
+            model = keras.Sequential([keras.Input([16]), keras.layers.Dense(1)])
+            model.compile(optimizer="adam", loss="mse")
+            monitor = InputStallMonitor(threshold=0.5, warmup=2)
+            history = model.fit(dataset, epochs=2, callbacks=[monitor], verbose=0)
+
+            ratios[name] = history.history["input_wait"][-1]
+            self.assertGreater(monitor.step_time, 0.0)
+            self.assertLessEqual(monitor.wait_time, monitor.step_time)
+            if name == "slow":
+                # all steps of the last epoch wait on the generator
+                self.assertGreater(monitor.wait_time, 0.8 * delay * steps)
+        self.assertGreater(ratios["slow"], 0.5)
+        self.assertLess(ratios["memory"], ratios["slow"])
+
+
+class AudioCacheSanityCheck(unittest.TestCase):
+    def test_audio_cache(self):
+        """python -m unittest -v test.test_dataset.AudioCacheSanityCheck.test_audio_cache"""
+        import time
+        import shutil
+        import soundfile as sf
+        from src.utils import AudioCache, read_audio
+
+        folder = os.path.join(save_path, "audio_cache")
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+
+        sr, sample_rate = 48000, 16000
+        filenames = []
+        for i in range(3):
+            filename = os.path.join(folder, f"{i}.wav")
+            sf.write(filename, 0.1 * np.random.randn(sr), sr)
+            filenames.append(filename)
+
+        # 2 files of 1 sec float32 after eviction to 90% of max_size
+        size = 4 * sample_rate + 128
+        cache = AudioCache(os.path.join(folder, "cache"), max_size=2.5 * size / 1024 / 1024)
+
+        self.assertEqual(cache.get(filenames[0], sample_rate, "polyphase"), (None, None))
+        audio, audio_sr = read_audio(filenames[0], sample_rate, cache, "polyphase")
+        self.assertEqual(audio_sr, sr)
+        cached, cached_sr = cache.get(filenames[0], sample_rate, "polyphase")
+        self.assertIsInstance(cached, np.memmap)
+        self.assertEqual(cached_sr, sr)
+        np.testing.assert_array_equal(cached, audio)
+        # the key has the sample rate and the resample method
+        self.assertEqual(cache.get(filenames[0], 8000, "polyphase"), (None, None))
+        self.assertEqual(cache.get(filenames[0], sample_rate, "resampy"), (None, None))
+
+        # the least recently used file is removed over max_size
+        time.sleep(0.05)
+        read_audio(filenames[1], sample_rate, cache, "polyphase")
+        time.sleep(0.05)
+        cache.get(filenames[0], sample_rate, "polyphase")
+        time.sleep(0.05)
+        read_audio(filenames[2], sample_rate, cache, "polyphase")
+
+        cache_files = [file for file in os.listdir(cache.path) if file.endswith(".npy")]
+        self.assertEqual(len(cache_files), 2)
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(cache.path, file)) for file in cache_files), cache.max_size)
+        self.assertIsNotNone(cache.get(filenames[0], sample_rate, "polyphase")[0])
+        self.assertIsNone(cache.get(filenames[1], sample_rate, "polyphase")[0])
+        self.assertIsNotNone(cache.get(filenames[2], sample_rate, "polyphase")[0])
+
+        # a modified file is read again
+        time.sleep(0.05)
+        sf.write(filenames[2], 0.1 * np.random.randn(sr), sr)
+        self.assertIsNone(cache.get(filenames[2], sample_rate, "polyphase")[0])
+
+
+class SegmentSanityCheck(unittest.TestCase):
+    def test_segment_audio(self):
+        """Strided segments against the loop of segment_audio before the strided view
+
+        python -m unittest -v test.test_dataset.SegmentSanityCheck.test_segment_audio
+        """
+        from src.utils import segment_audio
+
+        def segment_audio_loop(audio, num_sample_segment, num_sample_hop, pad):
+            segments = []
+            for start in range(0, max(audio.shape[-1], 1), num_sample_hop):
+                segment = audio[..., start : start + num_sample_segment]
+                if segment.shape[-1] < num_sample_segment:
+                    if pad == "drop" and segments:
+                        break
+                    padding = [(0, 0)] * (audio.ndim - 1) + [(0, num_sample_segment - segment.shape[-1])]
+                    segment = np.pad(segment, padding)
+                segments.append(segment)
+                if start + num_sample_segment >= audio.shape[-1]:
+                    break
+            return np.stack(segments, axis=-2)
+
+        sample_rate, segment = 16000, 1.024
+        num_sample_segment = int(segment * sample_rate)
+        for length in (8000, num_sample_segment, 3 * num_sample_segment, 3 * num_sample_segment + 5000):
+            audio = np.random.randn(length).astype(np.float32)
+
+            # the previous default, no overlap and the last partial segment dropped
+            reference = audio
+            if length < num_sample_segment:
+                reference = np.pad(audio, (0, num_sample_segment - length))
+            nsegment = reference.shape[-1] // num_sample_segment
+            reference = reference[: nsegment * num_sample_segment].reshape(nsegment, num_sample_segment)
+            np.testing.assert_array_equal(segment_audio(audio, sample_rate, segment), reference)
+
+            for hop, pad in ((None, "zero"), (0.512, "drop"), (0.512, "zero")):
+                num_sample_hop = int(hop * sample_rate) if hop else num_sample_segment
+                for shape in ((length,), (2, length)):
+                    audio = np.random.randn(*shape).astype(np.float32)
+                    np.testing.assert_array_equal(
+                        segment_audio(audio, sample_rate, segment, hop, pad),
+                        segment_audio_loop(audio, num_sample_segment, num_sample_hop, pad),
+                    )
+
+        # zero padding of the last partial segment
+        audio = np.ones(num_sample_segment + 100, dtype=np.float32)
+        segments = segment_audio(audio, sample_rate, segment, pad="zero")
+        self.assertEqual(segments.shape, (2, num_sample_segment))
+        self.assertTrue(np.all(segments[1, :100] == 1) and np.all(segments[1, 100:] == 0))
+
+
+class FeatureExtractorSanityCheck(unittest.TestCase):
+    def test_stft_real_imag(self):
+        """Batched stft of segments against librosa.stft of each segment
+
+        python -m unittest -v test.test_dataset.FeatureExtractorSanityCheck.test_stft_real_imag
+        """
+        import librosa
+
+        n_fft, hop_length, sample_rate = 256, 128, 16000
+        segments = np.random.randn(3, 16384).astype(np.float32)
+        for center in (True, False):
+            feature_extractor = FeatureExtractor(
+                segments, windowLength=n_fft, hop_length=hop_length, sample_rate=sample_rate
+            )
+            num_frames = 16384 // hop_length + 1 if center else (16384 - n_fft) // hop_length + 1
+            self.assertEqual(
+                feature_extractor.get_stft_shape(center), (2, 3, num_frames, n_fft // 2 + 1)
+            )
+            out = np.empty(feature_extractor.get_stft_shape(center), dtype=np.float32)
+            real, imag = feature_extractor.get_stft_real_imag(center, out=out)
+            self.assertIs(real.base, out)
+
+            for segment, segment_real, segment_imag in zip(segments, real, imag):
+                reference = librosa.stft(
+                    segment,
+                    n_fft=n_fft,
+                    hop_length=hop_length,
+                    window=feature_extractor.window,
+                    center=center,
+                    pad_mode="constant",
+                ).T  # frame, freq
+                scale = np.max(np.abs(reference))
+                np.testing.assert_allclose(segment_real, reference.real, atol=1e-5 * scale)
+                np.testing.assert_allclose(segment_imag, reference.imag, atol=1e-5 * scale)
+
+
+class ResampleSanityCheck(unittest.TestCase):
+    def test_resample(self):
+        """python -m unittest -v test.test_dataset.ResampleSanityCheck.test_resample"""
+        from src.utils import resample_audio
+
+        sample_rate = 16000
+        for sr in (48000, 44100):
+            time = np.arange(sr) / sr
+            audio = np.sin(2 * np.pi * 440 * time)
+            reference = np.sin(2 * np.pi * 440 * np.arange(sample_rate) / sample_rate)
+
+            self.assertIs(resample_audio(audio, sr, sr, "polyphase"), audio)
+            for method in ("resampy", "polyphase"):
+                resampled = resample_audio(audio, sr, sample_rate, method)
+                self.assertEqual(resampled.shape[-1], sample_rate)
+                # except the edges of filter
+                error = np.abs(resampled - reference)[100:-100]
+                self.assertLess(np.max(error), 1e-2)
+
+    def test_benchmark(self):
+        """Throughput and error of polyphase against resampy on the noisy set of VoiceBankDEMAND
+
+        python -m unittest -v test.test_dataset.ResampleSanityCheck.test_benchmark
+        """
+        import time
+        import soundfile as sf
+        from src.utils import resample_audio
+        from src.preprocess.VoiceBankDEMAND import VoiceBandDEMAND
+
+        path_conf = "./conf/config.yaml"
+        args = load_yaml(path_conf)
+        sample_rate = args.dset.sample_rate
+
+        _, noisy_filenames = VoiceBandDEMAND(
+            args.dset.wav, val_dataset_percent=0
+        )._get_filenames("train")
+        noisy_filenames = noisy_filenames[:200]
+
+        audios = [sf.read(filename) for filename in noisy_filenames]
+        duration = sum(audio.shape[-1] / sr for audio, sr in audios)
+
+        results = {}
+        for method in ("resampy", "polyphase"):
+            start = time.perf_counter()
+            results[method] = [
+                resample_audio(audio, sr, sample_rate, method) for audio, sr in audios
+            ]
+            elapsed = time.perf_counter() - start
+            print(
+                f"{method:>10}: {duration / elapsed:.1f} sec of audio/sec, "
+                f"{len(audios) / elapsed:.1f} files/sec"
+            )
+
+        snr = []
+        for reference, estimation in zip(results["resampy"], results["polyphase"]):
+            length = min(reference.shape[-1], estimation.shape[-1])
+            reference, estimation = reference[:length], estimation[:length]
+            snr.append(
+                10 * np.log10(np.sum(reference**2) / (np.sum((reference - estimation) ** 2) + 1e-12))
+            )
+        print(f"polyphase against resampy, SNR mean {np.mean(snr):.1f} dB, min {np.min(snr):.1f} dB")
+
+
 if __name__ == "__main__":
     unittest.main()
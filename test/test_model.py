@@ -114,6 +114,55 @@ class ModelSanityCheck(unittest.TestCase):
 
             print(f" {i+1} Pass")
 
+    def test_optimizer_state(self):
+        """Slots and iterations of optimizer saved with the model, loaded before compile as the models do
+
+        python -m unittest -v test.test_model.ModelSanityCheck.test_optimizer_state
+        """
+        import os
+        import shutil
+        import keras
+        from src.utils import save_optimizer_state, load_optimizer_state
+
+        path = os.path.join(save_path, "optimizer_state")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        def build_model():
+            inputs = keras.Input([16])
+            outputs = keras.layers.Dense(1)(keras.layers.Dense(8, activation="relu")(inputs))
+            return keras.Model(inputs=inputs, outputs=outputs)
+
+        def get_variables(optimizer):
+            variables = optimizer.variables
+            return [variable.numpy() for variable in (variables() if callable(variables) else variables)]
+
+        inputs = np.random.randn(12, 16).astype(np.float32)
+        targets = np.random.randn(12, 1).astype(np.float32)
+        model = build_model()
+        model.compile(optimizer=keras.optimizers.Adam(1e-3), loss="mse")
+        model.fit(inputs, targets, batch_size=4, epochs=1, verbose=0)
+        self.assertEqual(int(model.optimizer.iterations), 3)
+
+        model_loaded = build_model()
+        optimizer = keras.optimizers.Adam(1e-3)
+        self.assertFalse(load_optimizer_state(path, model_loaded, optimizer))
+        save_optimizer_state(path, model)
+
+        weights = model_loaded.get_weights()
+        self.assertTrue(load_optimizer_state(path, model_loaded, optimizer))
+        model_loaded.compile(optimizer=optimizer, loss="mse")
+
+        # the weights of the model are not changed, only the optimizer
+        for weight, loaded_weight in zip(weights, model_loaded.get_weights()):
+            np.testing.assert_array_equal(weight, loaded_weight)
+        self.assertEqual(int(optimizer.iterations), 3)
+        saved, loaded = get_variables(model.optimizer), get_variables(optimizer)
+        self.assertEqual(len(saved), len(loaded))
+        self.assertTrue(any(np.any(value) for value in saved[1:]))  # moments after training
+        for value, loaded_value in zip(saved, loaded):
+            np.testing.assert_array_equal(value, loaded_value)
+
     def test_lstm(self):
         """
         python -m unittest -v test.test_model.ModelSanityCheck.test_lstm
@@ -122,6 +171,7 @@ class ModelSanityCheck(unittest.TestCase):
         from src.model.rnn import build_model_rnn
 
         config = load_yaml("./test/conf/config.yaml")
+        config.model.ema = True
         batch = config.batch_size
         channel = config.dset.channels
         segment = config.dset.segment
@@ -150,6 +200,175 @@ class ModelSanityCheck(unittest.TestCase):
             print(f"Step {step}: Input shape={input.shape}, Output shape: {output.shape}")      
             break
 
+    def test_lstm_waveform(self):
+        """
+        python -m unittest -v test.test_model.ModelSanityCheck.test_lstm_waveform
+        """
+        from src.utils import load_yaml
+        from src.model.rnn import build_model_rnn
+
+        config = load_yaml("./test/conf/config.yaml")
+        config.model.ema = True
+        config.model.frontend = "model"
+        config.dset.features = ["pcm"]
+        batch = config.batch_size
+        channel = config.dset.channels
+        sample_rate = config.dset.sample_rate
+        segment = config.dset.segment
+
+        inputs = random_normal(shape=(batch, channel, int(sample_rate*segment)))
+
+        model = build_model_rnn(config)
+        model.summary()
+
+        output = model(inputs)
+        print(f"Input shape={inputs.shape}, Output shape: {output.shape}")
+        self.assertEqual(tuple(output.shape), tuple(inputs.shape))
+
+    def test_exponential_moving_average(self):
+        """
+        python -m unittest -v test.test_model.ModelSanityCheck.test_exponential_moving_average
+        """
+        import tensorflow as tf
+        from src.model.time_frequency import ExponentialMovingAverage
+
+        alpha = 0.1
+        inputs = np.random.randn(4, 129, 16).astype(np.float32)
+        expected = np.empty_like(inputs)
+        state = np.zeros_like(inputs[:, 0])
+        for t in range(inputs.shape[1]):
+            state = (1 - alpha) * state + alpha * inputs[:, t]
+            expected[:, t] = state
+
+        outputs = ExponentialMovingAverage(alpha)(inputs)
+        np.testing.assert_allclose(outputs, expected, atol=1e-5)
+
+        # None frames
+        ema = tf.function(
+            ExponentialMovingAverage(alpha),
+            input_signature=[tf.TensorSpec([None, None, 16], tf.float32)],
+        )
+        np.testing.assert_allclose(ema(inputs), expected, atol=1e-5)
+
+        # streaming, 1 and 8 frames per call
+        for frames in (1, 8):
+            ema = ExponentialMovingAverage(alpha, stateful=True)
+            outputs = np.concatenate(
+                [ema(inputs[:, t : t + frames]) for t in range(0, inputs.shape[1], frames)], axis=1
+            )
+            np.testing.assert_allclose(outputs, expected, atol=1e-5)
+            ema.reset_states()
+            np.testing.assert_allclose(ema(inputs[:, :frames]), expected[:, :frames], atol=1e-5)
+
+    def test_exponential_moving_average_long(self):
+        """100000 frames, the dense kernel would be 40 GB, against the recurrence
+
+        python -m unittest -v test.test_model.ModelSanityCheck.test_exponential_moving_average_long
+        """
+        import tensorflow as tf
+        from src.model.time_frequency import ExponentialMovingAverage
+
+        alpha, frames = 0.1, 100000
+        inputs = np.random.randn(2, frames, 8).astype(np.float32)
+        expected = np.empty_like(inputs)
+        state = np.zeros_like(inputs[:, 0])
+        for t in range(frames):
+            state = (1 - alpha) * state + alpha * inputs[:, t]
+            expected[:, t] = state
+
+        # a chunk size which doesn't divide frames, None frames
+        ema = tf.function(
+            ExponentialMovingAverage(alpha, chunk_size=96),
+            input_signature=[tf.TensorSpec([None, None, 8], tf.float32)],
+        )
+        np.testing.assert_allclose(ema(inputs), expected, atol=1e-5)
+
+        # streaming with calls longer than a chunk, the state is carried over calls and chunks
+        ema = ExponentialMovingAverage(alpha, stateful=True, chunk_size=96)
+        outputs = np.concatenate([ema(inputs[:, t : t + 1000]) for t in range(0, 5000, 1000)], axis=1)
+        np.testing.assert_allclose(outputs, expected[:, :5000], atol=1e-5)
+
+    def test_streaming(self):
+        """
+        python -m unittest -v test.test_model.ModelSanityCheck.test_streaming
+        """
+        import tensorflow as tf
+        from src.utils import load_yaml, stft_tensorflow
+        from src.model.rnn import build_model_rnn
+        from src.model.time_frequency import InverseSTFT
+        from src.streaming import StreamingEnhancer
+
+        config = load_yaml("./test/conf/config.yaml")
+        config.model.ema = True
+        config.dset.normalize = "none"
+        n_fft, hop_length = config.dset.n_fft, config.dset.hop_length
+        model = build_model_rnn(config)
+
+        def offline(audio):
+            spectrum = stft_tensorflow(
+                tf.constant(audio[np.newaxis, np.newaxis]), n_fft, hop_length, config.dset.center, config.model.fft_normalization
+            )
+            return InverseSTFT(
+                n_fft, hop_length, len(audio), config.dset.center, config.model.fft_normalization
+            )(model(spectrum, training=False)).numpy()[0, 0]
+
+        # a segment, the number of frames of the model
+        audio = np.random.randn(int(config.dset.segment * config.dset.sample_rate)).astype(np.float32)
+        expected = offline(audio)
+
+        for frames, chunk in ((1, hop_length), (4, 1000)):
+            enhancer = StreamingEnhancer(model, config, frames=frames)
+            outputs = enhancer.enhance(audio, chunk)
+            np.testing.assert_allclose(outputs, expected, atol=1e-5)
+            # states are reset after an utterance
+            np.testing.assert_allclose(enhancer.enhance(audio, chunk), expected, atol=1e-5)
+
+            # wall-clock latency of each chunk
+            chunk_times = np.array(enhancer.chunk_times[len(enhancer.chunk_times) // 2 :]) * 1000
+            self.assertEqual(len(chunk_times), -(-len(audio) // chunk))
+            print(
+                f"frames: {frames}, model {np.mean(enhancer.frame_times) * 1000:.3f} ms/frame, "
+                f"chunk of {chunk / config.dset.sample_rate * 1000:.1f} ms {np.mean(chunk_times):.3f} ms(mean) "
+                f"{np.percentile(chunk_times, 99):.3f} ms(p99), algorithmic latency {enhancer.latency * 1000:.1f} ms"
+            )
+
+        # normalized by running statistics of each chunk, reverted by the same statistics
+        from src.utils import encode_normalize, decode_normalize
+
+        utterance = 0.1 * audio + 0.05
+        chunk = 1000
+        for normalize in ("min-max", "z-score"):
+            config.dset.normalize = normalize
+            metadata = []
+            for end in range(chunk, len(utterance) + chunk, chunk):
+                seen = utterance[:end].astype(np.float64)
+                if normalize == "z-score":
+                    metadata.append({"mean": np.mean(seen), "std": np.std(seen) + 1e-12})
+                else:
+                    metadata.append({"min": np.min(seen), "max": np.max(seen) + 1e-12})
+            chunks = [utterance[start : start + chunk] for start in range(0, len(utterance), chunk)]
+            normalized = np.concatenate(
+                [encode_normalize(x, normalize, stats) for x, stats in zip(chunks, metadata)]
+            ).astype(np.float32)
+            enhanced = offline(normalized)
+            expected = np.concatenate(
+                [
+                    decode_normalize(enhanced[start : start + chunk], normalize, stats)
+                    for start, stats in zip(range(0, len(utterance), chunk), metadata)
+                ]
+            )
+
+            enhancer = StreamingEnhancer(model, config, frames=4)
+            outputs = enhancer.enhance(utterance, chunk)
+            np.testing.assert_allclose(outputs, expected, atol=1e-5)
+
+            # causal, the output of the first chunks doesn't change with the future samples
+            future = np.concatenate([utterance[: 4 * chunk], 10 * utterance[4 * chunk :]])
+            outputs_future = enhancer.enhance(future, chunk)
+            num_samples = 4 * chunk - n_fft
+            np.testing.assert_allclose(outputs_future[:num_samples], outputs[:num_samples], atol=1e-6)
+            self.assertGreater(np.max(np.abs(outputs_future - outputs)), 1e-2)
+
     def test_crn(self):
         """
         python -m unittest -v test.test_model.ModelSanityCheck.test_crn
@@ -158,6 +377,7 @@ class ModelSanityCheck(unittest.TestCase):
         from src.model.crn import build_crn_model_tf
 
         config = load_yaml("./test/conf/config.yaml")
+        config.model.ema = True
         batch = config.batch_size
         channel = config.dset.channels
         segment = config.dset.segment
@@ -238,5 +458,335 @@ class ModelSanityCheck(unittest.TestCase):
             print(f"Step {step}: Input shape={input.shape}, Output shape: {output.shape}")      
             break
 
+class MetricSanityCheck(unittest.TestCase):
+    def test_sisdr_tensorflow(self):
+        """
+        python -m unittest -v test.test_model.MetricSanityCheck.test_sisdr_tensorflow
+        """
+        import tensorflow as tf
+        from src.model.metrics import SI_SDR, SI_SDR_tensorflow
+
+        reference = np.random.randn(8, 1, 16384).astype(np.float32)
+        estimation = reference + 0.3 * np.random.randn(*reference.shape).astype(np.float32)
+
+        sisdr = SI_SDR(reference, estimation)
+        sisdr_tensorflow = tf.function(SI_SDR_tensorflow, jit_compile=True)(reference, estimation)
+        self.assertAlmostEqual(float(sisdr_tensorflow), float(sisdr), places=4)
+
+    def test_stoi_batch(self):
+        """
+        python -m unittest -v test.test_model.MetricSanityCheck.test_stoi_batch
+        """
+        from pystoi import stoi
+        from src.model.stoi import stoi_batch
+
+        sample_rate = 16000
+        time = np.arange(2 * sample_rate) / sample_rate
+        harmonics = sum(np.sin(2 * np.pi * 150 * k * time) / k for k in range(1, 20))
+        envelope = np.abs(np.sin(2 * np.pi * 4 * time)) * (np.sin(2 * np.pi * 2 * time) > 0)
+        reference = np.stack([np.roll(harmonics * envelope, 800 * i) for i in range(4)])[:, np.newaxis]
+        estimation = reference + 0.3 * np.random.randn(*reference.shape) * np.std(reference)
+
+        for extended in (False, True):
+            scores = stoi_batch(reference, estimation, sample_rate, extended=extended)
+            self.assertEqual(scores.shape, (4, 1))
+            for i in range(4):
+                self.assertAlmostEqual(
+                    scores[i, 0],
+                    stoi(reference[i, 0], estimation[i, 0], sample_rate, extended=extended),
+                    places=3,
+                )
+
+    def test_stoi_benchmark(self):
+        """stoi_batch against pystoi on a batch of 16 x 1.024 sec
+
+        Measured on one cpu core, 2-3.5x faster than pystoi pair by pair, also for 3 sec
+        utterances. The ffts which pystoi also does are a third of stoi_batch, 10x is not reached.
+
+        python -m unittest -v test.test_model.MetricSanityCheck.test_stoi_benchmark
+        """
+        import time
+        from pystoi import stoi
+        from src.model.stoi import stoi_batch
+
+        sample_rate, repeat = 16000, 5
+        num_samples = int(1.024 * sample_rate)
+        t = np.arange(num_samples) / sample_rate
+        harmonics = sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 20))
+        envelope = np.abs(np.sin(2 * np.pi * 4 * t)) * (np.sin(2 * np.pi * 2 * t) > 0)
+        reference = np.stack([np.roll(harmonics * envelope, 400 * i) for i in range(16)])
+        estimation = reference + 0.3 * np.random.randn(*reference.shape) * np.std(reference)
+
+        for extended in (False, True):
+            stoi_batch(reference, estimation, sample_rate, extended=extended)  # the cached band matrix
+            elapsed_pystoi, elapsed = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                scores_pystoi = [stoi(ref, est, sample_rate, extended=extended) for ref, est in zip(reference, estimation)]
+                elapsed_pystoi.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                scores = stoi_batch(reference, estimation, sample_rate, extended=extended)
+                elapsed.append(time.perf_counter() - start)
+
+            speedup = min(elapsed_pystoi) / min(elapsed)
+            print(
+                f"extended={extended}: pystoi {min(elapsed_pystoi) * 1000:.1f} ms, "
+                f"stoi_batch {min(elapsed) * 1000:.1f} ms, {speedup:.1f}x"
+            )
+            np.testing.assert_allclose(scores, scores_pystoi, atol=1e-3)
+            self.assertGreater(speedup, 1.5)
+
+    def test_pesq_engine(self):
+        """
+        python -m unittest -v test.test_model.MetricSanityCheck.test_pesq_engine
+        """
+        from pesq import pesq
+        from src.model.pesq_engine import PESQEngine
+
+        sample_rate = 16000
+        time = np.arange(3 * sample_rate) / sample_rate
+        harmonics = sum(np.sin(2 * np.pi * 150 * k * time) / k for k in range(1, 20))
+        envelope = np.abs(np.sin(2 * np.pi * 4 * time)) * (np.sin(2 * np.pi * 2 * time) > 0)
+        reference = np.stack(
+            [harmonics * envelope * (i + 1) / 4 for i in range(4)]
+        ).reshape(2, 2, -1).astype(np.float32)
+        estimation = reference + 0.05 * np.random.randn(*reference.shape).astype(np.float32)
+        # no utterances
+        reference[0, 0], estimation[0, 0] = 0, 0
+
+        with PESQEngine(sample_rate, num_workers=2) as engine:
+            scores = engine.score(reference, estimation, mode="wb")
+            self.assertEqual(scores.shape, (2, 2))
+            self.assertTrue(np.isnan(scores[0, 0]))
+            for b, c in ((0, 1), (1, 0), (1, 1)):
+                self.assertAlmostEqual(
+                    scores[b, c], pesq(sample_rate, reference[b, c], estimation[b, c], "wb"), places=5
+                )
+
+            # the second call is from the cache
+            self.assertEqual(len(engine.cache), 4)
+            np.testing.assert_array_equal(engine.score(reference, estimation, mode="wb"), scores)
+
+            np.testing.assert_array_equal(engine.submit(reference, estimation, mode="wb").result(), scores)
+
+    def test_shared_pesq_engine(self):
+        """WB_PESQ and NB_PESQ in the pool of the shared engine, started once
+
+        python -m unittest -v test.test_model.MetricSanityCheck.test_shared_pesq_engine
+        """
+        from src.model.metrics import WB_PESQ, NB_PESQ
+        from src.model.pesq_engine import get_pesq_engine, pesq_batch
+
+        sample_rate = 16000
+        time = np.arange(2 * sample_rate) / sample_rate
+        harmonics = sum(np.sin(2 * np.pi * 150 * k * time) / k for k in range(1, 20))
+        envelope = np.abs(np.sin(2 * np.pi * 4 * time)) * (np.sin(2 * np.pi * 2 * time) > 0)
+        reference = np.stack([harmonics * envelope * (i + 1) / 3 for i in range(3)])[:, np.newaxis].astype(np.float32)
+        estimation = reference + 0.05 * np.random.randn(*reference.shape).astype(np.float32)
+
+        engine = get_pesq_engine(sample_rate)
+        self.assertIs(get_pesq_engine(sample_rate), engine)
+        self.assertIsNone(engine.cache)
+
+        self.assertAlmostEqual(WB_PESQ(reference, estimation, sample_rate), np.mean(pesq_batch(reference, estimation)), places=5)
+        pool = engine.pool
+        self.assertIsNotNone(pool)
+        self.assertAlmostEqual(
+            NB_PESQ(reference, estimation, sample_rate), np.mean(pesq_batch(reference, estimation, mode="nb")), places=5
+        )
+        self.assertIs(engine.pool, pool)
+
+        # no utterances
+        self.assertEqual(WB_PESQ(np.zeros_like(reference), np.zeros_like(estimation), sample_rate), 0)
+
+
+    def test_single_thread_workers(self):
+        """OMP_NUM_THREADS=1 in the environment of the workers from their start, not in the parent
+
+        python -m unittest -v test.test_model.MetricSanityCheck.test_single_thread_workers
+        """
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+        from src.utils import SingleThreadSpawnContext
+
+        environ = os.environ.pop("OMP_NUM_THREADS", None)
+        try:
+            with ProcessPoolExecutor(2, mp_context=SingleThreadSpawnContext()) as pool:
+                self.assertEqual(list(pool.map(os.getenv, ["OMP_NUM_THREADS"] * 4)), ["1"] * 4)
+            self.assertNotIn("OMP_NUM_THREADS", os.environ)
+        finally:
+            if environ is not None:
+                os.environ["OMP_NUM_THREADS"] = environ
+
+    def test_async_evaluation(self):
+        """Scores of evaluation.metric after each epoch in evaluation.json and TensorBoard, the same as the metrics
+
+        python -m unittest -v test.test_model.MetricSanityCheck.test_async_evaluation
+        """
+        import os
+        import json
+        import glob
+        import shutil
+        import keras
+        import tensorflow as tf
+        from src.model.evaluation import AsyncSpeechEvaluation
+        from src.model.metrics import WB_PESQ, STOI, SDR
+
+        path = os.path.join(save_path, "async_evaluation")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        args = load_yaml("./conf/config.yaml")
+        args.model.name = "unet"  # waveform in and out
+        args.evaluation.metric = ["wb-pesq", "stoi", "sdr"]
+        args.evaluation.batches = 2
+        sample_rate = args.dset.sample_rate
+
+        time = np.arange(sample_rate) / sample_rate
+        harmonics = sum(np.sin(2 * np.pi * 150 * k * time) / k for k in range(1, 20))
+        envelope = np.abs(np.sin(2 * np.pi * 4 * time)) * (np.sin(2 * np.pi * 2 * time) > 0)
+        clean = np.stack([harmonics * envelope * (i + 1) / 4 for i in range(4)])[:, np.newaxis].astype(np.float32)
+        noisy = clean + 0.1 * np.random.randn(*clean.shape).astype(np.float32)
+        dataset = tf.data.Dataset.from_tensor_slices((noisy, clean)).batch(2)
+
+        inputs = keras.Input([1, sample_rate])
+        outputs = keras.layers.Reshape([sample_rate, 1])(inputs)
+        outputs = keras.layers.Dense(1, use_bias=False)(outputs)
+        outputs = keras.layers.Reshape([1, sample_rate])(outputs)
+        model = keras.Model(inputs=inputs, outputs=outputs)
+        model.compile(optimizer=keras.optimizers.Adam(1e-2), loss="mse")
+
+        with self.assertRaises(ValueError):
+            args.evaluation.metric = ["pesq"]
+            AsyncSpeechEvaluation(dataset, path, args)
+        args.evaluation.metric = ["wb-pesq", "stoi", "sdr"]
+
+        evaluation = AsyncSpeechEvaluation(dataset, path, args)
+        model.fit(dataset, epochs=2, callbacks=[evaluation], verbose=0)
+        self.assertEqual(evaluation.pending, {})
+
+        with open(os.path.join(path, "evaluation.json")) as tmp:
+            results = json.load(tmp)
+        self.assertEqual(list(results), ["1", "2"])
+        self.assertEqual(sorted(results["2"]), ["sdr", "stoi", "wb-pesq"])
+        self.assertTrue(glob.glob(os.path.join(path, "logs", "evaluation", "events.*")))
+
+        # the last epoch is evaluated with the trained model
+        batches = [(np.asarray(model(noisy, training=False)), np.asarray(clean)) for noisy, clean in dataset]
+        for name, metric in (("wb-pesq", WB_PESQ), ("stoi", STOI), ("sdr", SDR)):
+            expected = np.mean([metric(clean, estimation, sample_rate) for estimation, clean in batches])
+            self.assertAlmostEqual(results["2"][name], expected, places=4)
+
+    def test_sdr_synthetic(self):
+        """SDR of a filtered reference with noise against its analytic value, without data or museval
+
+        The distortion filter is allowed in SDR v3, so it is the energy of the filtered reference
+        over the noise, up to the part of the noise in the span of the delayed references
+        (filter_length / samples of the noise energy). SNR counts the filter as an error.
+
+        python -m unittest -v test.test_model.MetricSanityCheck.test_sdr_synthetic
+        """
+        from scipy.signal import lfilter
+        from src.model.metrics import SDR, SDR_v3, SDR_v3_tensorflow
+        from src.model.sdr import sdr_batch, sdr_tensorflow
+
+        random = np.random.RandomState(0)
+        num_samples = 32000
+        reference = random.randn(3, num_samples)
+        taps = np.array([1.0, 0.5, -0.3, 0.2])
+        filtered = lfilter(taps, [1.0], reference, axis=-1)
+        noise = random.randn(*reference.shape) * np.array([[0.1], [0.3], [1.0]])
+        estimation = filtered + noise
+
+        # the span of 512 delayed references has 512 / num_samples of the white noise
+        signal, distortion = np.sum(filtered**2, axis=-1), np.sum(noise**2, axis=-1)
+        ratio = 512 / num_samples
+        expected = 10 * np.log10((signal + ratio * distortion) / ((1 - ratio) * distortion))
+        sdr = sdr_batch(reference, estimation, bsseval_sources_version=True)
+        np.testing.assert_allclose(sdr, expected, atol=0.05)
+        self.assertAlmostEqual(SDR_v3(reference, estimation), np.mean(sdr), places=6)
+        np.testing.assert_allclose(
+            sdr_tensorflow(reference, estimation, bsseval_sources_version=True).numpy(), sdr, atol=1e-2
+        )
+        self.assertAlmostEqual(float(SDR_v3_tensorflow(reference, estimation)), np.mean(sdr), places=2)
+
+        # the museval default is SNR
+        snr = 10 * np.log10(np.sum(reference**2, axis=-1) / np.sum((estimation - reference) ** 2, axis=-1))
+        np.testing.assert_allclose(sdr_batch(reference, estimation), snr, atol=1e-6)
+        self.assertAlmostEqual(SDR(reference, estimation), np.mean(snr), places=6)
+        self.assertTrue(np.all(sdr > snr + 2))
+
+        # the filter alone is not a distortion, silent pairs are NaN
+        self.assertGreater(sdr_batch(reference[0], filtered[0], bsseval_sources_version=True), 40)
+        self.assertTrue(np.isnan(sdr_batch(np.zeros(num_samples), estimation[0], bsseval_sources_version=True)))
+
+    def test_sdr(self):
+        """SDR of sdr_batch and sdr_tensorflow against museval on the test set of VoiceBankDEMAND
+
+        Skipped without museval or the dataset in dset.wav.
+
+        python -m unittest -v test.test_model.MetricSanityCheck.test_sdr
+        """
+        import os
+        import time
+        import librosa
+        from src.model.sdr import sdr_batch, sdr_tensorflow
+        from src.preprocess.VoiceBankDEMAND import VoiceBandDEMAND
+
+        try:
+            from museval.metrics import bss_eval
+        except ImportError:
+            self.skipTest("museval is not installed")
+
+        path_conf = "./conf/config.yaml"
+        args = load_yaml(path_conf)
+        if not os.path.isdir(args.dset.wav):
+            self.skipTest(f"VoiceBankDEMAND is not in {args.dset.wav}")
+        sample_rate = args.dset.sample_rate
+        num_samples = int(args.dset.segment * sample_rate)
+
+        clean_filenames, noisy_filenames = VoiceBandDEMAND(
+            args.dset.wav, val_dataset_percent=0
+        )._get_filenames("test")
+
+        # the first segment of 8 pairs
+        reference = np.stack(
+            [librosa.load(filename, sr=sample_rate)[0][:num_samples] for filename in clean_filenames[:8]]
+        )
+        estimation = np.stack(
+            [librosa.load(filename, sr=sample_rate)[0][:num_samples] for filename in noisy_filenames[:8]]
+        )
+
+        for bsseval_sources_version in (False, True):
+            start = time.perf_counter()
+            sdr_museval = np.array(
+                [
+                    bss_eval(
+                        ref[np.newaxis, :, np.newaxis],
+                        est[np.newaxis, :, np.newaxis],
+                        window=np.inf,
+                        bsseval_sources_version=bsseval_sources_version,
+                    )[0][0, 0]
+                    for ref, est in zip(reference, estimation)
+                ]
+            )
+            elapsed_museval = time.perf_counter() - start
+
+            start = time.perf_counter()
+            sdr = sdr_batch(reference, estimation, bsseval_sources_version=bsseval_sources_version)
+            elapsed = time.perf_counter() - start
+            sdr_graph = sdr_tensorflow(
+                reference, estimation, bsseval_sources_version=bsseval_sources_version
+            ).numpy()
+
+            print(
+                f"bsseval_sources_version={bsseval_sources_version}: "
+                f"museval {elapsed_museval:.3f} sec, sdr_batch {elapsed:.3f} sec"
+            )
+            np.testing.assert_allclose(sdr, sdr_museval, atol=1e-6)
+            np.testing.assert_allclose(sdr_graph, sdr_museval, atol=1e-3)
+
+
 if __name__ == "__main__":
     unittest.main()